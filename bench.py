@@ -0,0 +1,597 @@
+# Микро-бенчмарки TripBuddy.
+#   python bench.py dispatch   — стоимость маршрутизации одного текстового апдейта
+#   python bench.py submit     — коммиты и задержка записи одной заявки с вложениями
+#   python bench.py stats      — задержка /stats при росте таблиц
+#   python bench.py api        — вызовы Bot API через разные HTTP-сессии (против локальной заглушки)
+#   python bench.py api --serve — только поднять заглушку Bot API (BOT_API_URL=http://127.0.0.1:8081/bot{0}/{1})
+#   python bench.py startup    — холодный и повторный старт main.py (импорт + start_bot) против заглушки
+#   python bench.py runtime    — sync (TeleBot + Flask) против async (AsyncTeleBot + aiohttp) на одной машине
+import os
+import sys
+import json
+import socket
+import time
+import sqlite3
+import argparse
+import tempfile
+import threading
+import statistics
+import subprocess
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import telebot
+from telebot import types
+
+FAKE_TOKEN = "123456:BENCH"
+
+# Шаги в том порядке, в каком раньше регистрировались lambda-фильтры
+REQUEST_STEPS = ["type", "route", "dates", "guests", "rooms", "stars", "breakfast", "class", "baggage",
+                 "location_pref", "carriers", "budget", "contact", "fullname", "dob", "gender",
+                 "citizenship", "passport_no", "passport_exp", "attachments"]
+PAY_STEPS = ["pay_amount", "pay_date", "pay_method", "pay_attach"]
+MENU = ["📄 Оферта", "/offer", "💬 Администратор", "❌ Отмена", "📝 Оставить заявку"]
+PAY_BUTTONS = ["Пропустить ⏭️", "Отправить ✅"]
+LATE_COMMANDS = ["ping", "state", "iamadmin", "migrate", "stats", "export_csv", "find",
+                 "invoice", "confirmpaid", "pm", "senddoc"]
+
+
+def _noop(message):
+    pass
+
+
+def _legacy_bot(steps: dict):
+    """Раскладка хэндлеров до роутера: по lambda-фильтру на каждый шаг и кнопку."""
+    bot = telebot.TeleBot(FAKE_TOKEN, threaded=False)
+    for cmd in ["start", "groupid", "admin_debug"]:
+        bot.register_message_handler(_noop, commands=[cmd])
+    bot.register_message_handler(_noop, func=lambda m: m.text in ["📄 Оферта", "/offer"])
+    bot.register_message_handler(_noop, func=lambda m: m.text == "💬 Администратор")
+    bot.register_message_handler(_noop, func=lambda m: m.text == "❌ Отмена")
+    bot.register_message_handler(_noop, commands=["cancel"])
+    bot.register_message_handler(_noop, content_types=["photo", "document"])
+    bot.register_message_handler(_noop, func=lambda m: m.text == "📝 Оставить заявку")
+    for step in REQUEST_STEPS:
+        bot.register_message_handler(_noop, func=lambda m, s=step: steps.get(m.chat.id) == s)
+    bot.register_message_handler(_noop, commands=["whereami"])
+    bot.register_message_handler(_noop, func=lambda m: m.text == "✅ Я оплатил(а)")
+    for step in PAY_STEPS:
+        bot.register_message_handler(_noop, func=lambda m, s=step: steps.get(m.chat.id) == s)
+    bot.register_message_handler(_noop, func=lambda m: (m.text or "").strip() in PAY_BUTTONS)
+    for cmd in LATE_COMMANDS:
+        bot.register_message_handler(_noop, commands=[cmd])
+    bot.register_message_handler(_noop, func=lambda m: m.content_type == "text" and not (m.text or "").startswith("/"))
+    return bot
+
+
+def _import_main(tmp: str):
+    """main.py на временной БД (схема — init_db(), как при старте)."""
+    os.environ.setdefault("BOT_TOKEN", FAKE_TOKEN)
+    os.environ["DB_PATH"] = os.path.join(tmp, "bench.db")
+    os.environ["LOG_FILE"] = os.path.join(tmp, "bench.log")
+    import main
+    main.init_db()
+    return main
+
+
+def _router_bot(main, steps: dict):
+    """Хэндлеры main.bot как есть: main.route_text с фильтром из main.py и шагами в main.sessions.
+    Все функции, кроме route_text, и цели маршрутов заменены заглушкой — меряем только разбор."""
+    for table in (main.MENU_ROUTES, main.REQUEST_STEPS, main.PAY_ROUTES, main.PAY_STEPS, main.PAY_BUTTONS):
+        for key in table:
+            table[key] = _noop
+    main.fallback = _noop
+    for cid, step in steps.items():
+        main.sessions.set(cid, step, {})
+    bot = telebot.TeleBot(FAKE_TOKEN, threaded=False)
+    bot.message_handlers = [dict(h, function=h["function"] if h["function"].__wrapped__ is main.route_text else _noop)
+                            for h in main.bot.message_handlers]   # function — обёртка ThrottledTeleBot._timed
+    return bot
+
+
+def _text_message(cid: int, text: str):
+    return types.Message.de_json({
+        "message_id": 1, "date": 0, "text": text,
+        "chat": {"id": cid, "type": "private"},
+        "from": {"id": cid, "is_bot": False, "first_name": "Bench"},
+    })
+
+
+def bench_dispatch(n: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        main = _import_main(tmp)
+        # Чаты на разных шагах + кнопки меню и «ничейный» текст (fallback)
+        main_steps = list(main.REQUEST_STEPS) + list(main.PAY_STEPS)
+        messages = [_text_message(cid, "текст") for cid in range(1, len(main_steps) + 1)]
+        messages += [_text_message(10_000 + i, t) for i, t in enumerate(MENU + ["просто текст"])]
+        variants = (
+            ("lambda-фильтры", _legacy_bot({cid: step for cid, step in enumerate(REQUEST_STEPS + PAY_STEPS, 1)})),
+            ("main.route_text", _router_bot(main, {cid: step for cid, step in enumerate(main_steps, 1)})),
+        )
+        for name, bot in variants:
+            total = 0
+            t0 = time.perf_counter()
+            for _ in range(n):
+                for msg in messages:
+                    msg.__dict__.pop("_route", None)   # каждый раз как новое сообщение
+                    bot.process_new_messages([msg])
+                    total += 1
+            dt = time.perf_counter() - t0
+            print(f"{name:16s} {len(bot.message_handlers):3d} хэндлеров  {dt / total * 1e6:8.2f} мкс/апдейт")
+        total = 0
+        t0 = time.perf_counter()
+        for _ in range(n):
+            for msg in messages:
+                msg.__dict__.pop("_route", None)
+                main._resolve_route(msg)
+                total += 1
+        dt = time.perf_counter() - t0
+        print(f"{'main._resolve_route':16s}      {dt / total * 1e6:8.2f} мкс/сообщение")
+
+
+REQUESTS_DDL = """
+CREATE TABLE requests (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER, type TEXT, route TEXT, dates TEXT, guests TEXT,
+    rooms TEXT, stars TEXT, breakfast TEXT, location_pref TEXT, budget TEXT, class TEXT, baggage TEXT,
+    carriers TEXT, fullname TEXT, dob TEXT, gender TEXT, citizenship TEXT, passport_no TEXT,
+    passport_exp TEXT, contact TEXT, created_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE request_attachments (id INTEGER PRIMARY KEY AUTOINCREMENT, request_id INTEGER, kind TEXT, file_id TEXT);
+"""
+INSERT_REQUEST = """
+    INSERT INTO requests
+    (chat_id, type, route, dates, guests, rooms, stars, breakfast, location_pref, budget,
+     class, baggage, carriers, fullname, dob, gender, citizenship, passport_no, passport_exp, contact)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+INSERT_ATTACHMENT = "INSERT INTO request_attachments (request_id, kind, file_id) VALUES (?, ?, ?)"
+
+
+def _submit_legacy(conn, row, attachments):
+    """Как было: _exec() с commit() после каждого INSERT."""
+    commits = 0
+    cur = conn.cursor()
+    cur.execute(INSERT_REQUEST, row)
+    conn.commit()
+    commits += 1
+    request_id = cur.lastrowid
+    for kind, fid in attachments:
+        conn.cursor().execute(INSERT_ATTACHMENT, (request_id, kind, fid))
+        conn.commit()
+        commits += 1
+    return commits
+
+
+def _submit_batched(conn, row, attachments):
+    """Как в save_request(): одна транзакция, вложения через executemany."""
+    conn.execute("BEGIN IMMEDIATE")
+    request_id = conn.execute(INSERT_REQUEST, row).lastrowid
+    conn.executemany(INSERT_ATTACHMENT, [(request_id, kind, fid) for kind, fid in attachments])
+    conn.execute("COMMIT")
+    return 1
+
+
+def bench_submit(n: int, attachments: int):
+    row = (1, "Отель", "Прага", "01.09–07.09", "2 взрослых", "1 комната", "⭐️⭐️⭐️⭐️", "Да ✅", "центр",
+           "100 EUR", None, None, None, "IVAN IVANOV", "01.01.1990", None, "РФ", "123456789", "01.01.2030", "@me")
+    files = [("photo", f"AgACAgIAAxkBAAIB{i:04d}") for i in range(attachments)]
+    variants = (
+        ("commit на строку (rollback journal)", _submit_legacy, {}),
+        ("commit на строку (WAL)", _submit_legacy, {"wal": True}),
+        ("одна транзакция (WAL)", _submit_batched, {"wal": True}),
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        for i, (name, submit, opts) in enumerate(variants):
+            path = os.path.join(tmp, f"bench{i}.db")
+            if submit is _submit_batched:
+                conn = sqlite3.connect(path, isolation_level=None)
+            else:
+                conn = sqlite3.connect(path)
+            if opts.get("wal"):
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(REQUESTS_DDL)
+            commits = 0
+            t0 = time.perf_counter()
+            for _ in range(n):
+                commits += submit(conn, row, files)
+            dt = time.perf_counter() - t0
+            conn.close()
+            print(f"{name:36s} {commits / n:5.1f} commit/заявку  {dt / n * 1e3:7.3f} мс/заявку")
+
+
+STATS_LEGACY = [
+    ("SELECT COUNT(*) FROM requests WHERE datetime(created_at) >= datetime(?)", "today"),
+    ("SELECT COUNT(*) FROM requests WHERE datetime(created_at) >= datetime(?)", "week"),
+    ("SELECT COUNT(*) FROM payments WHERE datetime(created_at) >= datetime(?)", "today"),
+    ("SELECT COUNT(*) FROM payments WHERE datetime(created_at) >= datetime(?)", "week"),
+    ("SELECT amount, currency FROM payments WHERE datetime(created_at) >= datetime(?)", "week"),
+]
+STATS_SQL = """
+    SELECT 'req' AS kind, NULL AS currency,
+           SUM(created_at >= :today) AS today, COUNT(*) AS week, NULL AS sum_minor
+    FROM requests WHERE created_at >= :week
+    UNION ALL
+    SELECT 'pay', COALESCE(NULLIF(UPPER(currency), ''), 'RUB'),
+           SUM(created_at >= :today), COUNT(*), SUM(amount_minor)
+    FROM payments WHERE created_at >= :week
+    GROUP BY 2
+"""
+
+ROLLUP_STATS_SQL = """
+    SELECT metric, dim,
+           SUM(CASE WHEN day >= :today THEN cnt ELSE 0 END) AS today,
+           SUM(cnt) AS total, SUM(sum_minor) AS sum_minor
+    FROM daily_rollup WHERE day >= :since
+    GROUP BY metric, dim
+"""
+
+
+def bench_stats(sizes, repeat: int):
+    # Строки равномерно за последние 2 года; в 7-дневное окно попадает ~1%
+    params = {"today": time.strftime("%Y-%m-%d 00:00:00", time.gmtime()),
+              "week": time.strftime("%Y-%m-%d 00:00:00", time.gmtime(time.time() - 6 * 86400))}
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            conn = sqlite3.connect(os.path.join(tmp, f"stats{size}.db"))
+            conn.executescript("""
+                CREATE TABLE requests (id INTEGER PRIMARY KEY, chat_id INTEGER, created_at TEXT);
+                CREATE TABLE payments (id INTEGER PRIMARY KEY, chat_id INTEGER, amount TEXT, amount_minor INTEGER,
+                                       currency TEXT, created_at TEXT);
+            """)
+            conn.executemany("INSERT INTO requests (chat_id, created_at) VALUES (?, datetime('now', ?))",
+                             ((i, f"-{i % 730} days") for i in range(size)))
+            conn.executemany("INSERT INTO payments (chat_id, amount, amount_minor, currency, created_at) "
+                             "VALUES (?, '1000', 100000, 'RUB', datetime('now', ?))",
+                             ((i, f"-{i % 730} days") for i in range(size)))
+            conn.commit()
+
+            t0 = time.perf_counter()
+            for _ in range(repeat):
+                for sql, key in STATS_LEGACY:
+                    conn.execute(sql, (params[key],)).fetchall()
+            legacy = (time.perf_counter() - t0) / repeat
+
+            conn.executescript("""
+                CREATE INDEX idx_requests_created_at ON requests(created_at);
+                CREATE INDEX idx_payments_created_at ON payments(created_at);
+            """)
+            t0 = time.perf_counter()
+            for _ in range(repeat):
+                conn.execute(STATS_SQL, params).fetchall()
+            indexed = (time.perf_counter() - t0) / repeat
+
+            conn.executescript("""
+                CREATE TABLE daily_rollup (day TEXT NOT NULL, metric TEXT NOT NULL, dim TEXT NOT NULL,
+                    cnt INTEGER NOT NULL DEFAULT 0, sum_minor INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (day, metric, dim)) WITHOUT ROWID;
+                INSERT INTO daily_rollup SELECT date(created_at), 'requests', '', COUNT(*), 0 FROM requests GROUP BY 1;
+                INSERT INTO daily_rollup SELECT date(created_at), 'payments', currency, COUNT(*), SUM(amount_minor)
+                    FROM payments GROUP BY 1, 3;
+            """)
+            rollup = {}
+            for days in (7, 365):
+                since = time.strftime("%Y-%m-%d", time.gmtime(time.time() - (days - 1) * 86400))
+                t0 = time.perf_counter()
+                for _ in range(repeat):
+                    conn.execute(ROLLUP_STATS_SQL, {"today": params["today"][:10], "since": since}).fetchall()
+                rollup[days] = (time.perf_counter() - t0) / repeat
+            conn.close()
+            print(f"{size:8d} строк  5 запросов с datetime(): {legacy * 1e3:8.2f} мс   "
+                  f"один запрос по индексу: {indexed * 1e3:6.2f} мс   "
+                  f"daily_rollup 7д/365д: {rollup[7] * 1e3:5.2f}/{rollup[365] * 1e3:5.2f} мс")
+
+
+class StubBotApi(BaseHTTPRequestHandler):
+    """Заглушка Bot API: на любой метод отвечает ok, считает открытые TCP-соединения."""
+    protocol_version = "HTTP/1.1"   # keep-alive
+    delay = 0.0
+    connections = 0
+    webhook_url = ""
+    set_webhook_calls = 0
+    sent_by_chat = {}
+    _lock = threading.Lock()
+    _message_id = 0
+
+    def setup(self):
+        super().setup()
+        # заголовки и тело уходят разными write(): без TCP_NODELAY keep-alive упирается в delayed ACK
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with StubBotApi._lock:
+            StubBotApi.connections += 1
+
+    def _params(self, body: bytes) -> dict:
+        # sync TeleBot шлёт параметры в query string, AsyncTeleBot — в теле формы
+        params = parse_qs(urlsplit(self.path).query)
+        if body and "x-www-form-urlencoded" in (self.headers.get("Content-Type") or ""):
+            params.update(parse_qs(body.decode("utf-8", "replace")))
+        return {k: v[0] for k, v in params.items()}
+
+    def _reply(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        method = self.path.split("?", 1)[0].rsplit("/", 1)[-1]
+        params = self._params(body)
+        if self.delay:
+            time.sleep(self.delay)
+        with StubBotApi._lock:
+            StubBotApi._message_id += 1
+            mid = StubBotApi._message_id
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "stub", "username": "stub_bot"}
+        elif method == "getWebhookInfo":
+            result = {"url": StubBotApi.webhook_url, "has_custom_certificate": False, "pending_update_count": 0}
+        elif method == "setWebhook":
+            StubBotApi.webhook_url = params.get("url", "")
+            StubBotApi.set_webhook_calls += 1
+            result = True
+        elif method == "getUpdates":
+            result = []
+        elif method.startswith("send") or method.startswith("edit"):
+            chat_id = int(params.get("chat_id") or 1)
+            with StubBotApi._lock:
+                StubBotApi.sent_by_chat[chat_id] = StubBotApi.sent_by_chat.get(chat_id, 0) + 1
+            result = {"message_id": mid, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, "text": ""}
+            if method == "sendMediaGroup":
+                result = [result]
+        else:
+            result = True
+        body = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = _reply
+
+    def log_message(self, *args):
+        pass
+
+
+class _QuietServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):   # клиент ушёл сам
+            super().handle_error(request, client_address)
+
+
+def start_stub_api(port: int = 0, delay_ms: float = 0.0):
+    StubBotApi.delay = delay_ms / 1000
+    server = _QuietServer(("127.0.0.1", port), StubBotApi)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _pooled_session(pool_size: int):
+    # то же, что BotApiSession в main.py (без учёта задержек)
+    import requests
+    from requests.adapters import HTTPAdapter
+    s = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    return s
+
+
+def bench_api(threads: int, n: int, delay_ms: float):
+    from telebot import apihelper
+    server = start_stub_api(0, delay_ms)
+    apihelper.API_URL = f"http://127.0.0.1:{server.server_port}/bot{{0}}/{{1}}"
+    bot = telebot.TeleBot(FAKE_TOKEN, threaded=False)
+    modes = [
+        ("новое соединение на каждый вызов", 0, None),
+        ("telebot по умолчанию (сессия на поток)", None, None),
+        (f"общая сессия, пул {threads}", None, _pooled_session(threads)),
+    ]
+    for title, ttl, session in modes:
+        apihelper.SESSION_TIME_TO_LIVE = ttl
+        apihelper.session = session
+        StubBotApi.connections = 0
+        lat = [[] for _ in range(threads)]
+
+        def worker(out):
+            for i in range(n):
+                t0 = time.perf_counter()
+                bot.send_message(1, f"msg {i}")
+                out.append(time.perf_counter() - t0)
+
+        ths = [threading.Thread(target=worker, args=(lat[i],)) for i in range(threads)]
+        t0 = time.perf_counter()
+        for t in ths:
+            t.start()
+        for t in ths:
+            t.join()
+        wall = time.perf_counter() - t0
+        allv = sorted(x for part in lat for x in part)
+        p99 = allv[int(len(allv) * 0.99) - 1]
+        print(f"{title:40s} {len(allv) / wall:8.0f} выз./с   p50 {statistics.median(allv) * 1e3:6.2f} мс   "
+              f"p99 {p99 * 1e3:6.2f} мс   TCP-соединений: {StubBotApi.connections}")
+    server.shutdown()
+
+
+# Запускается в отдельном процессе: время импорта main и start_bot() до готовности отвечать на HTTP
+# (и отдельно — до завершения сверки вебхука в фоне)
+_STARTUP_PROBE = """
+import json, sys, threading, time
+t0 = time.perf_counter()
+import main
+t1 = time.perf_counter()
+main.start_bot()
+t2 = time.perf_counter()
+for th in threading.enumerate():
+    if th.name == "webhook-sync":
+        th.join()
+t3 = time.perf_counter()
+print(json.dumps({"import_ms": (t1 - t0) * 1e3, "start_ms": (t2 - t1) * 1e3, "webhook_ms": (t3 - t1) * 1e3,
+                  "schema": main.schema_version()}))
+"""
+
+
+def bench_startup(runs: int, target_ms: float) -> int:
+    server = start_stub_api(0)
+    workdir = tempfile.mkdtemp(prefix="tripbuddy-startup-")
+    env = dict(os.environ, BOT_TOKEN=FAKE_TOKEN, ADMIN_GROUP_ID="-100", DB_PATH=os.path.join(workdir, "bench.db"),
+               BOT_API_URL=f"http://127.0.0.1:{server.server_port}/bot{{0}}/{{1}}",
+               PUBLIC_URL="https://bench.example", LOG_FILE=os.path.join(workdir, "bench.log"))
+    here = os.path.dirname(os.path.abspath(__file__))
+    worst = 0.0
+    for i in range(runs):
+        calls = StubBotApi.set_webhook_calls
+        t0 = time.perf_counter()
+        out = subprocess.run([sys.executable, "-c", _STARTUP_PROBE], cwd=here, env=env,
+                             capture_output=True, text=True, check=True).stdout
+        wall = (time.perf_counter() - t0) * 1e3
+        r = json.loads(out.strip().splitlines()[-1])
+        ready = r["import_ms"] + r["start_ms"]
+        if i:
+            worst = max(worst, ready)
+        print(f"{'холодный' if i == 0 else 'повторный':10s} импорт {r['import_ms']:7.1f} мс   start_bot {r['start_ms']:6.1f} мс   "
+              f"вебхук готов через {r['webhook_ms']:6.1f} мс   процесс {wall:7.1f} мс   "
+              f"setWebhook: {StubBotApi.set_webhook_calls - calls}   схема v{r['schema']}")
+    server.shutdown()
+    if target_ms and worst > target_ms:
+        print(f"Повторный старт {worst:.1f} мс > цели {target_ms:.0f} мс")
+        return 1
+    return 0
+
+
+# Полная заявка на отель: на каждый шаг бот отвечает ровно одним сообщением в чат клиента
+HOTEL_DIALOG = ["/start", "📝 Оставить заявку", "🏨 Отель", "Прага", "01.05–05.05", "2 взрослых", "1 комната",
+                "⭐️⭐️⭐️", "Да ✅", "центр", "100 €", "@client", "IVANOV IVAN", "01.01.1990", "RU", "7512345",
+                "01.01.2030", "Готово ✅"]
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _threads_of(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            return next(int(line.split()[1]) for line in f if line.startswith("Threads:"))
+    except (OSError, StopIteration):
+        return 0
+
+
+def _run_dialogs(runtime: str, chats: int, senders: int, api_port: int, timeout: float):
+    import requests
+    from concurrent.futures import ThreadPoolExecutor
+    workdir = tempfile.mkdtemp(prefix=f"tripbuddy-{runtime}-")
+    port = _free_port()
+    unlimited = "1000000"
+    env = dict(os.environ, BOT_TOKEN=FAKE_TOKEN, ADMIN_GROUP_ID="-100", DB_PATH=os.path.join(workdir, "bench.db"),
+               BOT_API_URL=f"http://127.0.0.1:{api_port}/bot{{0}}/{{1}}", PUBLIC_URL="https://bench.example",
+               PORT=str(port), LOG_FILE=os.path.join(workdir, "bench.log"), WEBHOOK_QUEUE_MAX=unlimited,
+               # лимиты Telegram меряем не здесь — иначе оба режима упрутся в 1 сообщение/с на чат
+               OUTBOX_GLOBAL_RATE=unlimited, OUTBOX_CHAT_RATE=unlimited, OUTBOX_CHAT_BURST=unlimited,
+               OUTBOX_GROUP_PER_MIN=unlimited)
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.Popen([sys.executable, "main.py", "serve", "--runtime", runtime], cwd=here, env=env)
+    base = f"http://127.0.0.1:{port}"
+    try:
+        for _ in range(200):
+            try:
+                requests.get(base + "/", timeout=0.5)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.05)
+        StubBotApi.sent_by_chat = {}
+        first_chat = 10_000
+        expected = chats * len(HOTEL_DIALOG)
+        local = threading.local()
+
+        def dialog(cid):
+            # как Telegram: апдейты одного чата — по порядку, разные чаты — параллельно (senders соединений)
+            session = getattr(local, "session", None) or requests.Session()
+            local.session = session
+            for i, text in enumerate(HOTEL_DIALOG):
+                msg = {"message_id": i + 1, "date": int(time.time()), "text": text,
+                       "chat": {"id": cid, "type": "private"},
+                       "from": {"id": cid, "is_bot": False, "first_name": "Bench", "username": f"u{cid}"}}
+                if text.startswith("/"):
+                    msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+                session.post(f"{base}/webhook/{FAKE_TOKEN}", json={"update_id": cid * 100 + i, "message": msg})
+
+        peak_threads = 0
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(senders) as pool:
+            list(pool.map(dialog, range(first_chat, first_chat + chats)))
+        posted = time.perf_counter() - t0
+        while time.perf_counter() - t0 < timeout:
+            done = sum(v for k, v in StubBotApi.sent_by_chat.items() if k >= first_chat)
+            peak_threads = max(peak_threads, _threads_of(proc.pid))
+            if done >= expected:
+                break
+            time.sleep(0.02)
+        wall = time.perf_counter() - t0
+        return {"updates": expected, "done": done, "wall": wall, "posted": posted, "threads": peak_threads}
+    finally:
+        proc.terminate()
+        proc.wait(30)
+
+
+def bench_runtime(chats: int, senders: int, delay_ms: float, timeout: float):
+    server = start_stub_api(0, delay_ms)
+    print(f"{chats} диалогов × {len(HOTEL_DIALOG)} апдейтов, {senders} входящих соединений, "
+          f"задержка Bot API {delay_ms:.0f} мс")
+    for runtime in ("sync", "async"):
+        r = _run_dialogs(runtime, chats, senders, server.server_port, timeout)
+        note = "" if r["done"] >= r["updates"] else f"   (не дождались: {r['done']} из {r['updates']})"
+        print(f"{runtime:6s} {r['done'] / r['wall']:8.0f} апд./с   все ответы через {r['wall']:6.2f} с   "
+              f"вебхук принял всё за {r['posted']:6.2f} с   потоков в процессе до {r['threads']}{note}")
+    server.shutdown()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="bench.py")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("dispatch", help="маршрутизация текстового апдейта")
+    p.add_argument("-n", type=int, default=2000, help="повторов набора сообщений")
+    p = sub.add_parser("submit", help="запись заявки с вложениями")
+    p.add_argument("-n", type=int, default=200, help="сколько заявок записать")
+    p.add_argument("--attachments", type=int, default=15, help="вложений в заявке")
+    p = sub.add_parser("stats", help="задержка /stats")
+    p.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 300_000])
+    p.add_argument("--repeat", type=int, default=5)
+    p = sub.add_parser("api", help="вызовы Bot API через разные HTTP-сессии")
+    p.add_argument("--threads", type=int, default=8, help="потоков, как воркеров UPDATES")
+    p.add_argument("-n", type=int, default=300, help="вызовов на поток")
+    p.add_argument("--delay-ms", type=float, default=1.0, help="задержка ответа заглушки")
+    p.add_argument("--serve", action="store_true", help="только запустить заглушку Bot API")
+    p.add_argument("--port", type=int, default=8081, help="порт заглушки для --serve")
+    p = sub.add_parser("startup", help="время старта main.py: импорт + start_bot()")
+    p.add_argument("--runs", type=int, default=5, help="запусков (первый — на пустой базе)")
+    p.add_argument("--target-ms", type=float, default=0, help="код возврата 1, если повторный старт дольше")
+    p = sub.add_parser("runtime", help="sync против async: полные диалоги через вебхук против заглушки")
+    p.add_argument("--chats", type=int, default=200, help="одновременных диалогов")
+    p.add_argument("--senders", type=int, default=40, help="параллельных соединений вебхука (max_connections)")
+    p.add_argument("--delay-ms", type=float, default=50.0, help="задержка ответа Bot API")
+    p.add_argument("--timeout", type=float, default=300.0, help="сколько ждать все ответы")
+    args = parser.parse_args(argv)
+    if args.cmd == "dispatch":
+        bench_dispatch(args.n)
+    elif args.cmd == "submit":
+        bench_submit(args.n, args.attachments)
+    elif args.cmd == "stats":
+        bench_stats(args.sizes, args.repeat)
+    elif args.cmd == "api" and args.serve:
+        server = start_stub_api(args.port, args.delay_ms)
+        print(f"Заглушка Bot API: BOT_API_URL=http://127.0.0.1:{server.server_port}/bot{{0}}/{{1}}  (Ctrl+C — выход)")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
+    elif args.cmd == "api":
+        bench_api(args.threads, args.n, args.delay_ms)
+    elif args.cmd == "startup":
+        return bench_startup(args.runs, args.target_ms)
+    elif args.cmd == "runtime":
+        bench_runtime(args.chats, args.senders, args.delay_ms, args.timeout)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
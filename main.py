@@ -1,18 +1,196 @@
 # Импорты (кусок сверху файла)
 import os
 import re
+import io
 import csv
+import argparse
+import asyncio
+import html
+import json
+import time
+import queue
+import random
+import atexit
+import bisect
+import functools
+import hashlib
+import sys
+import pstats
+import socket
 import sqlite3
+import cProfile
+import zipfile
+import tempfile
+import threading
 from datetime import datetime, timedelta
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import asynccontextmanager, contextmanager
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 from threading import Thread
+from types import SimpleNamespace
 
 from flask import Flask, request, abort
 import logging
+import logging.handlers
+import requests
+from requests.adapters import HTTPAdapter
 import telebot
-from telebot import types
+from telebot import types, apihelper
+
+# ============ Логи ============
+# Все логгеры (наш "tripbuddy", TeleBot, werkzeug) пишут через QueueHandler: в потоке хэндлера запись
+# только фильтруется и кладётся в очередь, а форматирование в JSON и запись на диск делает
+# QueueListener в своём потоке. Одна строка — одно событие: ts, level, logger, event + поля
+# (update_id, chat_id, step, duration_ms и т.д.; update_id/chat_id/step подставляются сами из
+# контекста апдейта, который сейчас обрабатывает поток).
+# LOG_LEVEL — уровень по умолчанию; LOG_LEVELS="TeleBot=DEBUG,werkzeug=WARNING" — по логгерам.
+# LOG_SAMPLE="TeleBot=0.01,update=0.1" — какая доля DEBUG-записей категории (логгер или поле
+# category) попадает в лог; INFO и выше пишутся всегда.
+# Персональные данные (паспорт, ФИО, контакты, тексты сообщений) вырезаются до форматирования.
+LOG_LEVEL     = os.getenv("LOG_LEVEL", "INFO").strip().upper()
+LOG_LEVELS    = os.getenv("LOG_LEVELS", "TeleBot=WARNING,werkzeug=WARNING").strip()
+LOG_SAMPLE    = os.getenv("LOG_SAMPLE", "").strip()
+LOG_FILE      = os.getenv("LOG_FILE", "").strip()          # пусто — stderr
+LOG_QUEUE_MAX = int(os.getenv("LOG_QUEUE_MAX", "10000"))  # переполнение — запись отбрасывается, а не ждёт
+
+PII_FIELDS = ("passport_no", "passport_exp", "fullname", "dob", "contact", "citizenship",
+              "phone_number", "first_name", "last_name", "username", "text", "caption")
+_PII_RE = re.compile(r"""(["']?(?:%s)["']?\s*[:=]\s*)(?:"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')""" % "|".join(PII_FIELDS))
+
+log = logging.getLogger("tripbuddy")
+_log_context = threading.local()
+
+
+def _parse_pairs(raw: str) -> dict:
+    out = {}
+    for part in raw.split(","):
+        key, _, value = part.partition("=")
+        if key.strip() and value.strip():
+            out[key.strip()] = value.strip()
+    return out
+
+
+def redact(value):
+    """Вырезать PII из строки (JSON/repr словаря) или словаря полей."""
+    if isinstance(value, dict):
+        return {k: ("***" if k in PII_FIELDS else redact(v)) for k, v in value.items()}
+    if isinstance(value, str) and any(f in value for f in PII_FIELDS):
+        return _PII_RE.sub(lambda m: m.group(1) + '"***"', value)
+    return value
+
+
+@contextmanager
+def log_context(**fields):
+    """Поля, которые добавятся ко всем записям этого потока внутри блока (update_id, chat_id, step)."""
+    prev = getattr(_log_context, "fields", None)
+    _log_context.fields = dict(prev or {}, **fields)
+    try:
+        yield
+    finally:
+        _log_context.fields = prev
+
+
+def log_event(event: str, level: int = logging.INFO, **fields):
+    """Структурное событие: log_event("update", logging.DEBUG, duration_ms=3.1, category="update")."""
+    if log.isEnabledFor(level):
+        log.log(level, event, extra={"fields": fields})
+
+
+class _LogFilter(logging.Filter):
+    """На стороне хэндлера: сэмплирование DEBUG, контекст апдейта, вырезание PII."""
+
+    def __init__(self, sample: dict):
+        super().__init__()
+        self.sample = {k: float(v) for k, v in sample.items()}
+        self.sampled_out = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        fields = getattr(record, "fields", None) or {}
+        if record.levelno <= logging.DEBUG and self.sample:
+            rate = self.sample.get(fields.get("category") or record.name, self.sample.get("default", 1.0))
+            if rate < 1.0 and random.random() >= rate:
+                self.sampled_out += 1
+                return False
+        ctx = getattr(_log_context, "fields", None)
+        if ctx:
+            fields = dict(ctx, **fields)
+        record.fields = redact(fields) if fields else fields
+        if isinstance(record.msg, str):
+            record.msg = redact(record.msg)
+        if record.args:
+            record.args = tuple(redact(a) if isinstance(a, (str, dict)) else a for a in record.args) \
+                if isinstance(record.args, tuple) else redact(record.args)
+        return True
+
 
-# Включаем DEBUG-логирование TeleBot (после import telebot!)
-telebot.logger.setLevel(logging.DEBUG)
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Кладёт запись в очередь как есть (без format() в потоке хэндлера); при переполнении — отбрасывает."""
+    dropped = 0
+
+    def prepare(self, record):
+        if record.exc_info:   # traceback форматируем сразу — объекты исключения в другом потоке уже не те
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _QueueHandler.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        event = {
+            "ts": datetime.utcfromtimestamp(record.created).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.getMessage(),
+            "thread": record.threadName,
+        }
+        event.update(getattr(record, "fields", None) or {})
+        if record.exc_text:
+            event["exc"] = record.exc_text
+        return json.dumps(event, ensure_ascii=False, default=str)
+
+
+def setup_logging():
+    """Подключить очередь логов к корневому логгеру. Возвращает запущенный QueueListener."""
+    out = logging.FileHandler(LOG_FILE, encoding="utf-8") if LOG_FILE else logging.StreamHandler(sys.stderr)
+    out.setFormatter(JsonFormatter())
+    q = queue.Queue(maxsize=LOG_QUEUE_MAX)
+    handler = _QueueHandler(q)
+    handler.addFilter(LOG_FILTER)
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+    # у TeleBot свой StreamHandler в stderr — убираем, пусть идёт через очередь
+    for h in list(telebot.logger.handlers):
+        telebot.logger.removeHandler(h)
+    telebot.logger.setLevel(LOG_LEVEL)
+    for name, level in _parse_pairs(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level.upper())
+    listener = logging.handlers.QueueListener(q, out, respect_handler_level=True)
+    listener.start()
+    atexit.register(lambda: listener._thread and listener.stop())   # дописать очередь при выходе
+    return listener
+
+
+LOG_FILTER = _LogFilter(_parse_pairs(LOG_SAMPLE))
+LOG_LISTENER = None   # setup_logging() — из _start_workers()/main(), а не при импорте
+_logging_lock = threading.Lock()
+
+
+def init_logging():
+    """setup_logging() один раз на процесс."""
+    global LOG_LISTENER
+    with _logging_lock:
+        if LOG_LISTENER is None:
+            LOG_LISTENER = setup_logging()
 
 
 # ============ Flask / Webhook ============
@@ -25,12 +203,25 @@ def home():
 
 # Webhook endpoint для Telegram:
 # Telegram будет POST'ить апдейты на /webhook/<BOT_TOKEN>
+# Обработчики здесь НЕ выполняются: апдейт проверяем, кладём в очередь UPDATES
+# и сразу отвечаем 200 — иначе медленная отправка в админ-группу держит запрос
+# и Telegram начинает ретраить.
 @app.post(f"/webhook/{os.getenv('BOT_TOKEN','')}")
 def telegram_webhook():
     if request.headers.get("content-type") != "application/json":
         abort(403)
-    update = telebot.types.Update.de_json(request.get_data(as_text=True))
-    bot.process_new_updates([update])
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        abort(403)
+    try:
+        raw = json.loads(request.get_data(as_text=True))
+    except ValueError:
+        abort(400)
+    if not isinstance(raw, dict) or not isinstance(raw.get("update_id"), int):
+        abort(400)
+    if not UPDATES.accepting:
+        return "Shutting down", 503, {"Retry-After": "5"}
+    if not UPDATES.submit(raw):
+        return "Queue is full", 429, {"Retry-After": "1"}
     return "OK", 200
 # ========================================================
 
@@ -48,7 +239,1050 @@ except ValueError:
 if not BOT_TOKEN:
     raise RuntimeError("Нет BOT_TOKEN в Secrets.")
 
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML")
+# ============ Метрики (/metrics, формат Prometheus) ============
+# Счётчики и гистограммы без блокировок на горячем пути: у каждого потока свой шард (dict),
+# пишет в него только сам поток; /metrics при чтении складывает шарды всех потоков.
+# Гистограммы — с заранее заданными границами корзин, observe() — один bisect и три сложения.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "").strip()   # если задан — /metrics?token=... или Bearer
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SQL_BUCKETS     = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+class Metrics:
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []                      # (поток, шард) живых потоков; шард умершего — в _retired
+        self._shards_lock = threading.Lock()   # первое обращение нового потока и _collect
+        self._retired = {}                     # сумма шардов завершившихся потоков
+        self._meta = {}                        # name -> (type, help, buckets)
+        self._gauges = []                      # (name, help, fn) — считаются при чтении
+
+    def counter(self, name: str, help: str):
+        self._meta[name] = ("counter", help, None)
+
+    def histogram(self, name: str, help: str, buckets=LATENCY_BUCKETS):
+        self._meta[name] = ("histogram", help, tuple(buckets))
+
+    def gauge(self, name: str, help: str, fn, kind: str = "gauge"):
+        """Значение считается при чтении: fn() -> число или {tuple((label, value), ...): число}.
+        kind="counter" — для уже существующих счётчиков (UPDATES.processed и т.п.)."""
+        self._meta[name] = (kind, help, None)
+        self._gauges.append((name, fn))
+
+    def _shard(self) -> dict:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._shards_lock:
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def inc(self, name: str, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        shard = self._shard()
+        shard[key] = shard.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        shard = self._shard()
+        h = shard.get(key)
+        buckets = self._meta[name][2]
+        if h is None:
+            h = shard[key] = [0] * (len(buckets) + 3)   # корзины, +Inf, сумма, количество
+        h[bisect.bisect_left(buckets, value)] += 1
+        h[-2] += value
+        h[-1] += 1
+
+    @staticmethod
+    def _merge(total: dict, shard: dict):
+        for key, v in list(shard.items()):
+            if isinstance(v, list):
+                acc = total.get(key)
+                total[key] = list(v) if acc is None else [a + b for a, b in zip(acc, v)]
+            else:
+                total[key] = total.get(key, 0) + v
+
+    def _collect(self) -> dict:
+        with self._shards_lock:
+            # поток завершился — его шард больше не меняется: переносим в _retired и забываем
+            # (иначе каждый поток Flask/таймера оставлял бы шард навсегда)
+            alive = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    alive.append((thread, shard))
+                else:
+                    self._merge(self._retired, shard)
+            self._shards = alive
+            total = {k: list(v) if isinstance(v, list) else v for k, v in self._retired.items()}
+        for _, shard in alive:
+            self._merge(total, shard)
+        return total
+
+    @staticmethod
+    def _labels(labels, extra=()) -> str:
+        items = list(labels) + list(extra)
+        if not items:
+            return ""
+        esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}"
+
+    def render(self) -> str:
+        data = self._collect()
+        for name, fn in self._gauges:
+            try:
+                value = fn()
+            except Exception:
+                log.exception("metrics gauge %s error", name)
+                continue
+            for labels, v in (value.items() if isinstance(value, dict) else [((), value)]):
+                data[(name, tuple(labels))] = v
+        by_name = {}
+        for (name, labels), v in data.items():
+            by_name.setdefault(name, []).append((labels, v))
+        out = []
+        for name in sorted(by_name):
+            kind, help, buckets = self._meta.get(name, ("untyped", "", None))
+            out.append(f"# HELP {name} {help}")
+            out.append(f"# TYPE {name} {kind}")
+            for labels, v in sorted(by_name[name], key=lambda lv: lv[0]):
+                if kind != "histogram":
+                    out.append(f"{name}{self._labels(labels)} {v}")
+                    continue
+                cum = 0
+                for le, n in zip(list(buckets) + ["+Inf"], v):
+                    cum += n
+                    out.append(f"{name}_bucket{self._labels(labels, [('le', le)])} {cum}")
+                out.append(f"{name}_sum{self._labels(labels)} {v[-2]}")
+                out.append(f"{name}_count{self._labels(labels)} {v[-1]}")
+        return "\n".join(out) + "\n"
+
+
+METRICS = Metrics()
+METRICS.histogram("tripbuddy_update_seconds", "Обработка одного апдейта воркером UPDATES")
+METRICS.histogram("tripbuddy_handler_seconds", "Время хэндлера telebot")
+METRICS.histogram("tripbuddy_step_seconds", "Время обработки текста по шагу FSM (route_text)")
+METRICS.histogram("tripbuddy_bot_api_seconds", "Вызов Bot API по методам")
+METRICS.counter("tripbuddy_bot_api_errors_total", "Неуспешные вызовы Bot API по методам")
+METRICS.histogram("tripbuddy_sqlite_seconds", "Запросы SQLite по виду выражения", SQL_BUCKETS)
+METRICS.counter("tripbuddy_requests_submitted_total", "Сохранённые заявки")
+METRICS.counter("tripbuddy_payments_submitted_total", "Сохранённые уведомления об оплате")
+
+
+@functools.lru_cache(maxsize=1024)
+def _sql_kind(sql: str) -> str:
+    """SELECT / INSERT / UPDATE / ... — первое слово выражения (SQL у нас — константы, кэш маленький)."""
+    word = sql.lstrip().split(None, 1)
+    return word[0].upper() if word else "?"
+
+
+@app.get("/metrics")
+def metrics():
+    if METRICS_TOKEN:
+        given = request.args.get("token") or request.headers.get("Authorization", "").removeprefix("Bearer ")
+        if given != METRICS_TOKEN:
+            abort(403)
+    return METRICS.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+# ============ Профилирование по запросу (/profile) ============
+# Выключено — хэндлеры платят одну проверку PROFILER.active. Включено на N секунд:
+# - sample: отдельный поток PROFILE_SAMPLE_HZ раз в секунду снимает стеки потоков, которые сейчас
+#   выполняют хэндлер, и копит их в collapsed-формате (flamegraph.pl, speedscope);
+# - cprofile: детерминированный cProfile вокруг каждого хэндлера (у каждого потока свой профайлер,
+#   в конце они сливаются в один pstats). Точнее, но заметно замедляет хэндлеры, пока включён.
+# В обоих режимах копится время по хэндлерам. По истечении окна профилирование выключается само,
+# а zip с результатами уходит в чат, откуда его запросили (для HTTP — в админ-группу).
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "300"))
+PROFILE_SAMPLE_HZ   = float(os.getenv("PROFILE_SAMPLE_HZ", "100"))
+PROFILE_TOKEN       = os.getenv("PROFILE_TOKEN", "").strip()   # без него HTTP-маршрут выключен
+PROFILE_MODES       = ("sample", "cprofile")
+
+
+class Profiler:
+    def __init__(self):
+        self.active = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._reset("sample")
+
+    def _reset(self, mode: str):
+        self.mode = mode
+        self._busy = {}          # thread ident -> имя хэндлера
+        self._handlers = {}      # имя -> [вызовов, суммарно, максимум]
+        self._stacks = {}        # collapsed stack -> сэмплов
+        self._profiles = []      # cProfile.Profile всех потоков
+        self._generation = getattr(self, "_generation", 0) + 1
+        self.samples = 0
+        self.started = time.monotonic()
+
+    # ---- на горячем пути (только когда active) ----
+    def call(self, name: str, fn, message):
+        ident = threading.get_ident()
+        self._busy[ident] = name
+        prof = None
+        if self.mode == "cprofile":
+            if getattr(self._local, "generation", None) != self._generation:
+                self._local.generation = self._generation
+                self._local.profile = cProfile.Profile()
+                with self._lock:
+                    self._profiles.append(self._local.profile)
+            prof = self._local.profile
+        t0 = time.perf_counter()
+        try:
+            if prof is None:
+                return fn(message)
+            prof.enable()
+            try:
+                return fn(message)
+            finally:
+                prof.disable()
+        finally:
+            self._busy.pop(ident, None)
+            self.record(name, time.perf_counter() - t0)
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            st = self._handlers.get(name)
+            if st is None:
+                st = self._handlers[name] = [0, 0.0, 0.0]
+            st[0] += 1
+            st[1] += seconds
+            st[2] = max(st[2], seconds)
+
+    # ---- сэмплер ----
+    def _sample_loop(self, generation: int):
+        interval = 1.0 / max(PROFILE_SAMPLE_HZ, 1.0)
+        while self.active and self._generation == generation:
+            frames = sys._current_frames()
+            for ident, name in list(self._busy.items()):
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                key = name + ";" + ";".join(reversed(stack))
+                self._stacks[key] = self._stacks.get(key, 0) + 1
+                self.samples += 1
+            time.sleep(interval)
+
+    # ---- управление ----
+    def start(self, seconds: float, mode: str, report_chat_id) -> bool:
+        """False — уже идёт другое профилирование."""
+        with self._lock:
+            if self.active:
+                return False
+            self._reset(mode)
+            self.active = True
+            generation = self._generation
+        if mode == "sample":
+            Thread(target=self._sample_loop, args=(generation,), name="profile-sampler", daemon=True).start()
+        timer = threading.Timer(seconds, self._finish, args=(generation, report_chat_id))
+        timer.daemon = True
+        timer.start()
+        return True
+
+    def _finish(self, generation: int, report_chat_id):
+        with self._lock:
+            if not self.active or self._generation != generation:
+                return
+            self.active = False
+        try:
+            buf, summary = self.report()
+            with buf:
+                stamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+                bot.send_document(report_chat_id, buf, visible_file_name=f"profile_{self.mode}_{stamp}.zip",
+                                  caption=summary[:1000])
+        except Exception as e:
+            log.exception("profile report error")
+            try:
+                bot.send_message(report_chat_id, f"Профилирование: не удалось отправить отчёт: {e}")
+            except Exception:
+                pass
+
+    def report(self):
+        """zip (handlers.txt, stacks.collapsed.txt | profile.pstats + profile.txt) и короткая сводка."""
+        elapsed = time.monotonic() - self.started
+        rows = sorted(self._handlers.items(), key=lambda kv: -kv[1][1])
+        table = [f"{'handler':32s} {'calls':>7s} {'total_s':>9s} {'avg_ms':>9s} {'max_ms':>9s}"]
+        for name, (n, total, mx) in rows:
+            table.append(f"{name:32s} {n:7d} {total:9.3f} {total / n * 1000:9.2f} {mx * 1000:9.2f}")
+        buf = io.BytesIO()   # отчёт небольшой
+        with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr("handlers.txt", "\n".join(table) + "\n")
+            if self.mode == "sample":
+                zf.writestr("stacks.collapsed.txt",
+                            "".join(f"{k} {v}\n" for k, v in sorted(self._stacks.items(), key=lambda kv: -kv[1])))
+            elif self._profiles:
+                stats = pstats.Stats(self._profiles[0])
+                for prof in self._profiles[1:]:
+                    stats.add(prof)
+                with tempfile.NamedTemporaryFile(suffix=".pstats", delete=False) as tmp:
+                    path = tmp.name
+                try:
+                    stats.dump_stats(path)
+                    zf.write(path, "profile.pstats")
+                finally:
+                    os.unlink(path)
+                text = io.StringIO()
+                pstats.Stats(self._profiles[0], stream=text).add(*self._profiles[1:]) \
+                    .sort_stats("cumulative").print_stats(40)
+                zf.writestr("profile.txt", text.getvalue())
+        buf.seek(0)
+        top = "\n".join(f"{name}: {n} × {total / n * 1000:.1f} мс" for name, (n, total, _) in rows[:8]) or "хэндлеры не вызывались"
+        extra = f", сэмплов {self.samples}" if self.mode == "sample" else ""
+        return buf, f"Профиль ({self.mode}) за {elapsed:.0f} с{extra}\n{top}"
+
+
+PROFILER = Profiler()
+
+
+def parse_profile_args(tokens):
+    """[секунды] [sample|cprofile] -> (seconds, mode) или ValueError."""
+    seconds, mode = 30, "sample"
+    for tok in tokens:
+        if tok.isdigit():
+            seconds = int(tok)
+        elif tok.lower() in PROFILE_MODES:
+            mode = tok.lower()
+        else:
+            raise ValueError(tok)
+    if not 1 <= seconds <= PROFILE_MAX_SECONDS:
+        raise ValueError(str(seconds))
+    return seconds, mode
+
+
+@app.post("/debug/profile")
+def http_profile():
+    if not PROFILE_TOKEN:
+        abort(404)
+    given = request.args.get("token") or request.headers.get("Authorization", "").removeprefix("Bearer ")
+    if given != PROFILE_TOKEN:
+        abort(403)
+    if ADMIN_GROUP_ID_INT is None:
+        return "ADMIN_GROUP_ID is not set — nowhere to send the report", 409
+    try:
+        seconds, mode = parse_profile_args([request.args.get("seconds", "30"), request.args.get("mode", "sample")])
+    except ValueError:
+        abort(400)
+    if not PROFILER.start(seconds, mode, ADMIN_GROUP_ID_INT):
+        return "Profiling is already running", 409
+    return f"Profiling ({mode}) for {seconds}s, report goes to the admin group", 202
+
+
+# ============ Bot API: HTTP-транспорт ============
+# Один общий requests.Session на все потоки: keep-alive соединения переиспользуются, пул рассчитан
+# на число потоков, которые ходят в Bot API (воркеры UPDATES + фоновые задачи), и при нехватке
+# соединений поток ждёт свободное, а не открывает лишнее (нет «Connection pool is full»).
+# BOT_API_HTTP2=1 — HTTP/2 через httpx (pip install "httpx[http2]"), если он установлен.
+# BOT_API_URL — свой адрес Bot API, например локальный сервер или заглушка для тестов:
+#   BOT_API_URL=http://127.0.0.1:8081/bot{0}/{1}  (см. python bench.py api --serve)
+BOT_API_URL             = os.getenv("BOT_API_URL", "").strip()
+BOT_API_FILE_URL        = os.getenv("BOT_API_FILE_URL", "").strip()
+BOT_API_CONNECT_TIMEOUT = float(os.getenv("BOT_API_CONNECT_TIMEOUT", "5"))
+BOT_API_READ_TIMEOUT    = float(os.getenv("BOT_API_READ_TIMEOUT", "30"))
+BOT_API_POOL_SIZE       = int(os.getenv("BOT_API_POOL_SIZE", "0"))   # 0 — по числу потоков
+BOT_API_HTTP2           = os.getenv("BOT_API_HTTP2", "").strip() in ("1", "true", "yes")
+
+
+class ApiLatency:
+    """Вызовы Bot API по методам — в METRICS; snapshot() — сводка для /queues."""
+
+    def record(self, method: str, seconds: float, ok: bool = True):
+        METRICS.observe("tripbuddy_bot_api_seconds", seconds, method=method)
+        if not ok:
+            METRICS.inc("tripbuddy_bot_api_errors_total", method=method)
+
+    def snapshot(self) -> dict:
+        data = METRICS._collect()
+        out = {}
+        for (name, labels), v in data.items():
+            if name == "tripbuddy_bot_api_seconds" and v[-1]:
+                errors = data.get(("tripbuddy_bot_api_errors_total", labels), 0)
+                p95 = _histogram_quantile(METRICS._meta[name][2], v, 0.95)
+                out[dict(labels)["method"]] = {"calls": v[-1], "errors": errors,
+                                               "avg_ms": round(v[-2] / v[-1] * 1000, 1), "p95_ms": p95}
+        return out
+
+
+def _histogram_quantile(buckets, h, q: float):
+    """Верхняя граница корзины, в которую попадает квантиль q (мс); None — за последней границей."""
+    need, cum = q * h[-1], 0
+    for le, n in zip(buckets, h):
+        cum += n
+        if cum >= need:
+            return round(le * 1000, 1)
+    return None
+
+
+API_LATENCY = ApiLatency()
+
+
+def _api_method(url: str) -> str:
+    return url.rsplit("/", 1)[-1].split("?", 1)[0]
+
+
+class BotApiSession(requests.Session):
+    """requests.Session с пулом на pool_size соединений и учётом задержки каждого вызова."""
+
+    def __init__(self, pool_size: int):
+        super().__init__()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, *args, **kwargs):
+        t0 = time.perf_counter()
+        ok = False
+        try:
+            resp = super().request(method, url, *args, **kwargs)
+            ok = resp.status_code == 200
+            return resp
+        finally:
+            API_LATENCY.record(_api_method(url), time.perf_counter() - t0, ok)
+
+
+def _httpx_sender(pool_size: int):
+    """CUSTOM_REQUEST_SENDER для telebot поверх httpx с HTTP/2. None — если httpx/h2 не установлены."""
+    try:
+        import httpx
+        import h2  # noqa: F401  — без него httpx молча откатится на HTTP/1.1
+    except ImportError:
+        return None
+    client = httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+    )
+
+    def send(method, url, params=None, files=None, timeout=None, proxies=None):
+        connect, read = timeout or (BOT_API_CONNECT_TIMEOUT, BOT_API_READ_TIMEOUT)
+        t0 = time.perf_counter()
+        ok = False
+        try:
+            # telebot передаёт параметры query-строкой (как requests params=) — делаем так же
+            resp = client.request(method.upper(), url, params=params, files=files,
+                                  timeout=httpx.Timeout(read, connect=connect))
+            ok = resp.status_code == 200
+            return resp
+        finally:
+            API_LATENCY.record(_api_method(url), time.perf_counter() - t0, ok)
+
+    return send
+
+
+def setup_bot_api_transport(threads: int) -> str:
+    """Настроить apihelper telebot. Возвращает описание транспорта для логов."""
+    pool_size = BOT_API_POOL_SIZE or max(threads, 1)
+    apihelper.CONNECT_TIMEOUT = BOT_API_CONNECT_TIMEOUT
+    apihelper.READ_TIMEOUT = BOT_API_READ_TIMEOUT
+    if BOT_API_URL:
+        apihelper.API_URL = BOT_API_URL
+    if BOT_API_FILE_URL:
+        apihelper.FILE_URL = BOT_API_FILE_URL
+    if BOT_API_HTTP2 and apihelper.CUSTOM_REQUEST_SENDER is None:
+        sender = _httpx_sender(pool_size)
+        if sender is not None:
+            apihelper.CUSTOM_REQUEST_SENDER = sender
+            return f"httpx HTTP/2, pool={pool_size}"
+        log.warning("BOT_API_HTTP2=1, но httpx[http2] не установлен — работаем через requests (HTTP/1.1)")
+    apihelper.session = BotApiSession(pool_size)
+    return f"requests keep-alive, pool={pool_size}"
+
+
+# ============ Исходящие сообщения ============
+# Лимиты Telegram: ~30 сообщений/с на бота, ~1/с в один чат, ~20/мин в одну группу.
+# Все отправки бота проходят через OUTBOX: токен-бакеты (общий + на чат) и очередь с приоритетами —
+# ответы пользователю посреди анкеты идут раньше карточек в админ-группу и массовых рассылок.
+# На 429 чат ставится на паузу retry_after секунд, и отправка повторяется; если чат в своём лимите
+# не упирался, 429 — из-за общего лимита бота, и на паузу встаёт общий бакет.
+# Сами HTTP-вызовы выполняют потоки-отправители OUTBOX (OUTBOX_SENDERS штук), по одному вызову на чат
+# за раз, поэтому порядок сообщений в чате сохраняется. Воркер апдейтов ждёт отправку, только если ему
+# нужен результат; bot.send_message(..., defer=True) сразу возвращает PendingCall — пока чат ждёт
+# своего токена, воркер уже разбирает апдейты других чатов.
+# Лимиты считаются в процессе; при gunicorn -w N общий лимит по умолчанию делится на WEB_CONCURRENCY
+WEB_CONCURRENCY       = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+OUTBOX_GLOBAL_RATE    = float(os.getenv("OUTBOX_GLOBAL_RATE", str(30 / WEB_CONCURRENCY)))  # сообщений в секунду на бота
+OUTBOX_CHAT_RATE      = float(os.getenv("OUTBOX_CHAT_RATE", "1"))         # в секунду в личный чат
+OUTBOX_CHAT_BURST     = float(os.getenv("OUTBOX_CHAT_BURST", "3"))        # сколько можно отправить подряд в личку
+OUTBOX_GROUP_PER_MIN  = float(os.getenv("OUTBOX_GROUP_PER_MIN", "20"))    # в минуту в группу
+OUTBOX_MAX_RETRIES    = int(os.getenv("OUTBOX_MAX_RETRIES", "3"))         # повторов после 429
+OUTBOX_SENDERS        = int(os.getenv("OUTBOX_SENDERS", "8"))             # потоков, которые ходят в Bot API
+
+PRIO_USER, PRIO_ADMIN, PRIO_BULK = 0, 1, 2   # меньше — раньше
+PRIO_NAMES = {PRIO_USER: "user", PRIO_ADMIN: "admin", PRIO_BULK: "bulk"}
+
+
+class TokenBucket:
+    """Токен-бакет: rate токенов в секунду, не больше capacity. Долг (tokens < 0) допускается —
+    отправка альбома больше ёмкости просто отодвигает следующие."""
+    __slots__ = ("rate", "capacity", "tokens", "stamp", "paused_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self, cost: float, now: float) -> float:
+        """Сколько секунд ждать, пока можно списать cost (0 — можно сейчас)."""
+        self._refill(now)
+        need = min(cost, self.capacity)
+        wait = 0.0 if self.tokens >= need else (need - self.tokens) / self.rate
+        return max(wait, self.paused_until - now)
+
+    def take(self, cost: float):
+        self.tokens -= cost
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.paused_until
+
+
+class PendingCall:
+    """Результат отправки, которая выполняется в фоне. Ждём (и получаем исключение) только при обращении."""
+    __slots__ = ("_future",)
+
+    def __init__(self, future):
+        self._future = future
+
+    def result(self, timeout=None):
+        return self._future.result(timeout)
+
+    def __getattr__(self, name):
+        return getattr(self._future.result(), name)
+
+    def __iter__(self):
+        return iter(self._future.result())
+
+    def __len__(self):
+        return len(self._future.result())
+
+
+def _log_pending_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        log.warning("background Bot API call failed: %s", future.exception())
+
+
+class Outbox:
+    """
+    Планировщик исходящих вызовов Bot API.
+    - submit(chat_id, fn, cost) ставит вызов в очередь и возвращает Future; fn() выполнит
+      поток-отправитель, когда подойдёт очередь и будут токены. call() — то же с ожиданием результата.
+    - В один чат одновременно идёт не больше одного вызова, порядок отправок в чате сохраняется.
+    - Из ожидающих первым идёт вызов с меньшим приоритетом (PRIO_*), затем — пришедший раньше;
+      чат, у которого кончились токены, не задерживает остальные чаты.
+    - Приоритет по умолчанию: админ-группа — PRIO_ADMIN, остальные — PRIO_USER;
+      внутри with outbox.priority(PRIO_BULK): — заданный.
+    """
+    MAX_BUCKETS = 10000
+
+    def __init__(self, global_rate, chat_rate, chat_burst, group_per_min, max_retries=3, senders=8):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_per_min / 60
+        self.group_burst = group_per_min
+        self.max_retries = max_retries
+        self.senders = max(1, senders)
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._waiting = []          # [(prio, seq, chat_id, cost, fn, future, попытка, log-контекст, t0)]
+        self._busy = set()          # чаты, в которые вызов выполняется прямо сейчас
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self._threads = []
+        self.sent = 0
+        self.retries = 0
+        self.failed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @contextmanager
+    def priority(self, prio: int):
+        prev = getattr(self._local, "prio", None)
+        self._local.prio = prio
+        try:
+            yield
+        finally:
+            self._local.prio = prev
+
+    def _default_priority(self, chat_id) -> int:
+        prio = getattr(self._local, "prio", None)
+        if prio is not None:
+            return prio
+        return PRIO_ADMIN if ADMIN_GROUP_ID_INT is not None and chat_id == ADMIN_GROUP_ID_INT else PRIO_USER
+
+    def _bucket(self, chat_id) -> TokenBucket:
+        b = self._chats.get(chat_id)
+        if b is None:
+            if len(self._chats) >= self.MAX_BUCKETS:   # забываем чаты с полным бакетом
+                now = time.monotonic()
+                self._chats = {k: v for k, v in self._chats.items() if not v.idle(now)}
+            is_group = isinstance(chat_id, int) and chat_id < 0 or isinstance(chat_id, str)
+            b = TokenBucket(self.group_rate, self.group_burst) if is_group else TokenBucket(self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = b
+        return b
+
+    def _next_ticket(self):
+        """Под self._cond: (ticket, 0) — его можно выполнять; (None, сколько подождать до следующей проверки)."""
+        now = time.monotonic()
+        blocked, soonest = set(self._busy), 1.0
+        for t in sorted(self._waiting, key=lambda t: (t[0], t[1])):
+            chat_id, cost = t[2], t[3]
+            if chat_id in blocked:
+                continue
+            d = self._bucket(chat_id).delay(cost, now)
+            if d > 0:
+                blocked.add(chat_id)   # следующие сообщения этого чата ждут за ним
+                soonest = min(soonest, d)
+                continue
+            d = self._global.delay(cost, now)
+            return (t, 0.0) if d <= 0 else (None, d)
+        return None, soonest
+
+    def _sender(self):
+        while True:
+            with self._cond:
+                while True:
+                    t, wait = self._next_ticket()
+                    if t is not None:
+                        break
+                    self._cond.wait(min(wait, 1.0))
+                prio, seq, chat_id, cost, fn, future, attempt, fields, t0 = t
+                self._waiting.remove(t)
+                self._busy.add(chat_id)
+                self._global.take(cost)
+                bucket = self._bucket(chat_id)
+                bucket.take(cost)
+                chat_limited = bucket.tokens < 0 or bucket.paused_until > time.monotonic()
+                if not attempt:
+                    waited = time.monotonic() - t0
+                    self.wait_total += waited
+                    self.wait_max = max(self.wait_max, waited)
+            retry = False
+            try:
+                if attempt or future.set_running_or_notify_cancel():
+                    with log_context(**fields):
+                        future.set_result(fn())
+                    with self._cond:
+                        self.sent += 1
+            except telebot.apihelper.ApiTelegramException as e:
+                retry = self._retry_after(chat_id, e, attempt, chat_limited)
+                if not retry:
+                    future.set_exception(e)
+            except BaseException as e:
+                future.set_exception(e)
+            with self._cond:
+                self._busy.discard(chat_id)
+                if retry:   # тот же seq — остаётся первым в очереди своего чата
+                    self._waiting.append((prio, seq, chat_id, cost, fn, future, attempt + 1, fields, t0))
+                self._cond.notify_all()
+
+    def _pause(self, chat_id, seconds: float, chat_limited: bool = True):
+        with self._cond:
+            # чат в своём лимите не упирался — значит, упёрлись в общий лимит бота
+            b = self._bucket(chat_id) if chat_limited else self._global
+            b.paused_until = max(b.paused_until, time.monotonic() + seconds)
+
+    def _retry_after(self, chat_id, e: telebot.apihelper.ApiTelegramException, attempt: int,
+                     chat_limited: bool = True) -> bool:
+        """429 и повторы не кончились — ставим чат (или всех) на паузу и возвращаем True; иначе считаем ошибку."""
+        retry_after = ((e.result_json or {}).get("parameters") or {}).get("retry_after")
+        with self._cond:
+            if e.error_code != 429 or attempt >= self.max_retries:
+                self.failed += 1
+                return False
+            self.retries += 1
+        self._pause(chat_id, float(retry_after or 1), chat_limited)
+        return True
+
+    def submit(self, chat_id, fn, cost: float = 1, prio: int = None) -> Future:
+        """Поставить вызов в очередь; Future получит результат fn() или его исключение."""
+        prio = self._default_priority(chat_id) if prio is None else prio
+        future = Future()
+        fields = getattr(_log_context, "fields", None) or {}
+        with self._cond:
+            if not self._threads:
+                for i in range(self.senders):
+                    thread = Thread(target=self._sender, name=f"outbox-{i}", daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+            self._seq += 1
+            self._waiting.append((prio, self._seq, chat_id, cost, fn, future, 0, fields, time.monotonic()))
+            self._cond.notify_all()
+        return future
+
+    def call(self, chat_id, fn, cost: float = 1, prio: int = None):
+        """submit() с ожиданием: результат fn() (или её исключение) — в потоке вызывающего."""
+        return self.submit(chat_id, fn, cost, prio).result()
+
+    def shutdown(self, timeout: float = 10):
+        """Дождаться уже поставленных в очередь отправок (не дольше timeout)."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while (self._waiting or self._busy) and time.monotonic() < deadline:
+                self._cond.wait(min(0.1, max(0.0, deadline - time.monotonic())))
+            if self._waiting:
+                log.warning("Outbox: остановка по таймауту, не отправлено %d вызов(ов)", len(self._waiting))
+
+    def try_acquire(self, chat_id, cost: float = 1) -> float:
+        """Без ожидания: 0 — токены взяты; иначе через сколько секунд попробовать снова (для async-режима)."""
+        now = time.monotonic()
+        with self._cond:
+            wait = max(self._bucket(chat_id).delay(cost, now), self._global.delay(cost, now))
+            if wait <= 0:
+                self._global.take(cost)
+                self._bucket(chat_id).take(cost)
+            return wait
+
+    async def acall(self, chat_id, fn, cost: float = 1):
+        """call() для корутин: ждём токены через asyncio.sleep, fn() — корутина-фабрика.
+        Приоритеты здесь не учитываются: async-вызовы берут токены, как только они есть."""
+        attempt = 0
+        t0 = time.monotonic()
+        while True:
+            while (wait := self.try_acquire(chat_id, cost)) > 0:
+                await asyncio.sleep(min(wait, 1.0))
+            with self._cond:
+                bucket = self._bucket(chat_id)
+                chat_limited = bucket.tokens < 0 or bucket.paused_until > time.monotonic()
+            waited = time.monotonic() - t0
+            try:
+                result = await fn()
+            except telebot.apihelper.ApiTelegramException as e:
+                if not self._retry_after(chat_id, e, attempt, chat_limited):
+                    raise
+                attempt += 1
+                continue
+            with self._cond:
+                self.sent += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+            return result
+
+    def stats(self) -> dict:
+        with self._cond:
+            depth = {name: 0 for name in PRIO_NAMES.values()}
+            for t in self._waiting:
+                depth[PRIO_NAMES.get(t[0], str(t[0]))] += 1
+            return {
+                "depth": depth, "sent": self.sent, "retries": self.retries, "failed": self.failed,
+                "chats": len(self._chats),
+                "wait_avg_ms": round(self.wait_total / self.sent * 1000, 1) if self.sent else 0.0,
+                "wait_max_ms": round(self.wait_max * 1000, 1),
+            }
+
+
+OUTBOX = Outbox(OUTBOX_GLOBAL_RATE, OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST, OUTBOX_GROUP_PER_MIN, OUTBOX_MAX_RETRIES,
+                OUTBOX_SENDERS)
+atexit.register(OUTBOX.shutdown)   # после UPDATES и admin_fanout (atexit — в обратном порядке)
+
+
+# Хэндлер, запущенный async-режимом (AsyncRuntime), выполняется в потоке, помеченном здесь:
+# его отправки уходят в event loop через AsyncTeleBot, а не синхронным HTTP из этого потока.
+_async_local = threading.local()
+
+def async_runtime():
+    """AsyncRuntime, если текущий поток выполняет хэндлер async-режима, иначе None."""
+    return getattr(_async_local, "runtime", None)
+
+
+class ThrottledTeleBot(telebot.TeleBot):
+    """
+    TeleBot, у которого все отправки в чаты идут через Outbox (reply_to — через send_message).
+    defer=True — не ждать отправку: сразу вернуть PendingCall, ошибка попадёт только в лог.
+    Только там, где результат и исключение вызывающему не нужны (реплики анкеты).
+    """
+
+    def __init__(self, token, outbox: Outbox, **kwargs):
+        super().__init__(token, **kwargs)
+        self.outbox = outbox
+
+    def _send(self, name: str, chat_id, args: tuple, kwargs: dict, cost: float = 1):
+        defer = kwargs.pop("defer", False)
+        rt = async_runtime()
+        if rt is not None:
+            return rt.call_from_thread(name, chat_id, args, kwargs, cost, defer)
+        method = getattr(super(ThrottledTeleBot, self), name)
+        future = self.outbox.submit(chat_id, lambda: method(*args, **kwargs), cost=cost)
+        if not defer or any(hasattr(v, "read") for v in (*args, *kwargs.values())):   # файл закроют после возврата
+            return future.result()
+        future.add_done_callback(_log_pending_error)
+        return PendingCall(future)
+
+    def send_message(self, chat_id, *args, **kwargs):
+        return self._send("send_message", chat_id, (chat_id, *args), kwargs)
+
+    def send_document(self, chat_id, *args, **kwargs):
+        return self._send("send_document", chat_id, (chat_id, *args), kwargs)
+
+    def send_photo(self, chat_id, *args, **kwargs):
+        return self._send("send_photo", chat_id, (chat_id, *args), kwargs)
+
+    def copy_message(self, chat_id, *args, **kwargs):
+        return self._send("copy_message", chat_id, (chat_id, *args), kwargs)
+
+    def send_media_group(self, chat_id, media, *args, **kwargs):
+        # альбом из N файлов Telegram считает как N сообщений
+        return self._send("send_media_group", chat_id, (chat_id, media, *args), kwargs, cost=len(media))
+
+    def edit_message_text(self, text, chat_id=None, *args, **kwargs):
+        return self._send("edit_message_text", chat_id, (text, chat_id, *args), kwargs)
+
+
+# Потоки, которые ходят в Bot API: отправители OUTBOX, воркеры UPDATES (getFile, answerCallbackQuery…),
+# поллер, запас
+BOT_API_TRANSPORT = setup_bot_api_transport(OUTBOX_SENDERS + int(os.getenv("WEBHOOK_WORKERS", "4")) + 4)
+
+class InstrumentedTeleBot(ThrottledTeleBot):
+    """Каждый зарегистрированный хэндлер сообщений/callback'ов пишет своё время в tripbuddy_handler_seconds."""
+
+    @staticmethod
+    def _timed(handler_dict: dict) -> dict:
+        fn = handler_dict["function"]
+        name = fn.__name__
+
+        @functools.wraps(fn)
+        def timed(message):
+            t0 = time.perf_counter()
+            try:
+                if PROFILER.active:
+                    return PROFILER.call(name, fn, message)
+                return fn(message)
+            finally:
+                METRICS.observe("tripbuddy_handler_seconds", time.perf_counter() - t0, handler=name)
+
+        return dict(handler_dict, function=timed)
+
+    def add_message_handler(self, handler_dict):
+        super().add_message_handler(self._timed(handler_dict))
+
+    def add_callback_query_handler(self, handler_dict):
+        super().add_callback_query_handler(self._timed(handler_dict))
+
+
+# threaded=False: хэндлеры выполняет наш пул UPDATES (см. ниже), а не внутренний пул telebot
+bot = InstrumentedTeleBot(BOT_TOKEN, OUTBOX, parse_mode="HTML", threaded=False)
+
+# ============ Очередь апдейтов ============
+WEBHOOK_WORKERS       = int(os.getenv("WEBHOOK_WORKERS", "4"))         # сколько потоков разбирают апдейты
+WEBHOOK_QUEUE_MAX     = int(os.getenv("WEBHOOK_QUEUE_MAX", "1000"))    # больше — отвечаем Telegram 429
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "25"))  # сколько ждём разбор очереди при остановке
+WEBHOOK_SECRET        = os.getenv("WEBHOOK_SECRET", "").strip()        # secret_token для set_webhook (необязательно)
+# Telegram повторно шлёт апдейт, если не дождался ответа, — один и тот же update_id разбираем один раз
+UPDATE_DEDUPE_TTL     = float(os.getenv("UPDATE_DEDUPE_TTL", "86400"))   # сколько секунд помним update_id
+UPDATE_DEDUPE_MAX     = int(os.getenv("UPDATE_DEDUPE_MAX", "100000"))    # и не больше стольких в памяти
+# + таблица processed_updates; по умолчанию включена, если процессов несколько (WEB_CONCURRENCY > 1)
+UPDATE_DEDUPE_PERSIST = os.getenv("UPDATE_DEDUPE_PERSIST", "1" if WEB_CONCURRENCY > 1 else "").strip() in ("1", "true", "yes")
+
+
+def _update_chat_id(update):
+    """chat_id апдейта (dict из webhook или telebot Update) — по нему выбираем воркера."""
+    if isinstance(update, dict):
+        for key in ("message", "edited_message", "channel_post", "edited_channel_post"):
+            chat = (update.get(key) or {}).get("chat")
+            if chat:
+                return chat.get("id")
+        cq = update.get("callback_query") or {}
+        return ((cq.get("message") or {}).get("chat") or {}).get("id") or (cq.get("from") or {}).get("id")
+    for obj in (update.message, update.edited_message, update.channel_post, update.edited_channel_post):
+        if obj is not None:
+            return obj.chat.id
+    if update.callback_query is not None:
+        cq = update.callback_query
+        return cq.message.chat.id if cq.message else cq.from_user.id
+    return None
+
+
+class UpdateDedupe:
+    """
+    Окно уже принятых update_id: не больше max_size штук и не старше ttl секунд.
+    seen(update_id) -> True, если такой апдейт уже был (повтор), иначе запоминает его.
+    Если задан database — id пишутся ещё и в processed_updates (INSERT OR IGNORE): повторы ловятся
+    после перезапуска и между несколькими процессами.
+    """
+    PRUNE_EVERY = 1000
+
+    def __init__(self, max_size: int, ttl: float, database=None):
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        self.database = database
+        self._seen = OrderedDict()   # update_id -> time.time(), в порядке поступления
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _evict(self, now: float):
+        while self._seen and (len(self._seen) > self.max_size or next(iter(self._seen.values())) < now - self.ttl):
+            self._seen.popitem(last=False)
+
+    def seen(self, update_id: int) -> bool:
+        now = time.time()
+        with self._lock:
+            ts = self._seen.get(update_id)
+            dup = ts is not None and ts >= now - self.ttl
+            if not dup:
+                self._seen[update_id] = now
+                self._evict(now)
+        if not dup and self.database is not None:
+            dup = self.database.execute(
+                "INSERT OR IGNORE INTO processed_updates (update_id, seen_at) VALUES (?, ?)", (update_id, now)
+            ).rowcount == 0
+        with self._lock:
+            if dup:
+                self.hits += 1
+            else:
+                self.misses += 1
+                prune = self.database is not None and self.misses % self.PRUNE_EVERY == 0
+        if not dup and prune:
+            self.database.execute("DELETE FROM processed_updates WHERE seen_at < ?", (now - self.ttl,))
+        return dup
+
+    def size(self) -> int:
+        return len(self._seen)
+
+
+class UpdatePool:
+    """
+    Ограниченная очередь входящих апдейтов + пул воркеров.
+    - Апдейты одного чата всегда попадают к одному воркеру, поэтому шаги FSM идут по порядку.
+    - Общая глубина ограничена max_depth: submit() без блокировки вернёт False, если мест нет.
+    - shutdown() перестаёт принимать новые апдейты и дожидается разбора уже принятых.
+    - run_in_chat() ставит отложенную работу чата (альбомы) в ту же очередь, что и его апдейты.
+    """
+    _STOP = object()
+
+    def __init__(self, workers: int, max_depth: int, dedupe: UpdateDedupe = None):
+        self.max_depth = max(1, max_depth)
+        self.dedupe = dedupe
+        self._queues = [queue.Queue() for _ in range(max(1, workers))]
+        self._slots = threading.BoundedSemaphore(self.max_depth)
+        self._threads = []
+        self._lock = threading.Lock()
+        self.accepting = True
+        self.processed = 0
+        self.rejected = 0
+        self.failed = 0
+
+    def start(self):
+        if self._threads:
+            return
+        for i, q in enumerate(self._queues):
+            t = Thread(target=self._worker, args=(q,), name=f"updates-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def submit(self, update, block: bool = False, timeout=None) -> bool:
+        """False — очередь полна (или остановлена). Повтор уже принятого update_id молча отбрасываем (True)."""
+        if not self.accepting or not self._slots.acquire(blocking=block, timeout=timeout):
+            with self._lock:
+                self.rejected += 1
+            return False
+        # update_id запоминаем, только когда место в очереди уже есть: отклонённый апдейт Telegram
+        # пришлёт снова, и повтор не должен выглядеть дублем
+        if self.dedupe is not None:
+            update_id = update["update_id"] if isinstance(update, dict) else update.update_id
+            if self.dedupe.seen(update_id):
+                self._slots.release()
+                return True
+        key = _update_chat_id(update)
+        if key is None:
+            key = update["update_id"] if isinstance(update, dict) else update.update_id
+        self._queues[hash(key) % len(self._queues)].put(update)
+        return True
+
+    def run_in_chat(self, chat_id, fn) -> bool:
+        """fn() у воркера чата — между его апдейтами, а не параллельно им. False — пул не запущен или остановлен."""
+        if not self.accepting or not self._threads:
+            return False
+        self._queues[hash(chat_id) % len(self._queues)].put(fn)   # место в очереди не занимает
+        return True
+
+    def _worker(self, q: queue.Queue):
+        while True:
+            item = q.get()
+            if item is self._STOP:
+                q.task_done()
+                return
+            if callable(item):   # из run_in_chat
+                try:
+                    item()
+                except Exception:
+                    log.exception("chat task error")
+                finally:
+                    q.task_done()
+                continue
+            try:
+                t0 = time.perf_counter()
+                if isinstance(item, dict):
+                    item = telebot.types.Update.de_json(item)
+                with log_context(update_id=item.update_id, chat_id=_update_chat_id(item)):
+                    bot.process_new_updates([item])
+                    elapsed = time.perf_counter() - t0
+                    log_event("update", logging.DEBUG, category="update", duration_ms=round(elapsed * 1000, 2))
+                METRICS.observe("tripbuddy_update_seconds", elapsed)
+                with self._lock:
+                    self.processed += 1
+            except Exception:
+                with self._lock:
+                    self.failed += 1
+                log.exception("update processing error")
+            finally:
+                self._slots.release()
+                q.task_done()
+
+    def shutdown(self, timeout: float = WEBHOOK_DRAIN_TIMEOUT):
+        self.accepting = False
+        threads, self._threads = self._threads, []
+        if not threads:
+            return
+        deadline = time.monotonic() + timeout
+        while self.depth() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        left = self.depth()
+        if left:
+            log.warning("UpdatePool: остановка по таймауту, в очереди осталось %d апдейт(ов)", left)
+        for q in self._queues:
+            q.put(self._STOP)
+        for t in threads:
+            t.join(max(0.0, deadline - time.monotonic()))
+
+
+UPDATES = UpdatePool(WEBHOOK_WORKERS, WEBHOOK_QUEUE_MAX, UpdateDedupe(UPDATE_DEDUPE_MAX, UPDATE_DEDUPE_TTL))
+atexit.register(UPDATES.shutdown)
+
+
+def run_polling(skip_pending: bool = True):
+    """Long polling, который кладёт апдейты в тот же пул UPDATES, что и webhook."""
+    offset = None
+    if skip_pending:
+        try:
+            pending = bot.get_updates(offset=-1, timeout=1)
+            if pending:
+                offset = pending[-1].update_id + 1
+        except Exception as e:
+            log.info("skip pending error (ok to ignore): %s", e)
+    while UPDATES.accepting:
+        try:
+            updates = bot.get_updates(offset=offset, timeout=30, long_polling_timeout=30)
+        except Exception as e:
+            log.error("get_updates error: %s", e)
+            time.sleep(3)
+            continue
+        for u in updates:
+            offset = u.update_id + 1
+            while not UPDATES.submit(u, block=True, timeout=1):  # при переполнении просто ждём
+                if not UPDATES.accepting:
+                    return
 
 # ============ Платёжный шаблон ============
 PAYMENT_INSTRUCTIONS = (
@@ -65,30 +1299,108 @@ PAYMENT_INSTRUCTIONS = (
 )
 
 # ============ SQLite ============
-DB_PATH = "tripbuddy.db"
-conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-conn.row_factory = sqlite3.Row
+DB_PATH            = os.getenv("DB_PATH", "tripbuddy.db")
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
 
-def _exec(sql, params=None):
-    cur = conn.cursor()
-    cur.execute(sql, params or [])
-    conn.commit()
-    return cur
+
+class Database:
+    """
+    Доступ к SQLite из нескольких потоков (пул апдейтов, Flask, фоновые задачи).
+    - У каждого потока своё соединение: курсоры разных хэндлеров не перемешиваются.
+    - WAL + busy_timeout: читатели не блокируют писателя, конкурентная запись ждёт, а не падает.
+    - transaction() — блок с одним COMMIT (или ROLLBACK при исключении); вложенные блоки
+      выполняются в рамках внешней транзакции.
+    - Вне transaction() каждый execute() — отдельный автокоммит.
+    - Подготовленные выражения переиспользуются: у соединения кэш на statement_cache SQL-строк,
+      поэтому SQL пишем константами, а значения передаём параметрами.
+    """
+    def __init__(self, path: str, busy_timeout_ms: int = 5000, statement_cache: int = 256):
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        self.statement_cache = statement_cache
+        self._local = threading.local()
+        self.commits = 0
+        self.rollbacks = 0
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.path,
+                timeout=self.busy_timeout_ms / 1000,
+                isolation_level=None,              # транзакциями управляем сами
+                cached_statements=self.statement_cache,
+            )
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+            conn.execute("PRAGMA synchronous=NORMAL")  # в WAL безопасно и без fsync на каждый коммит
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self.connection()
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            self.rollbacks += 1
+            raise
+        t0 = time.perf_counter()
+        conn.execute("COMMIT")
+        METRICS.observe("tripbuddy_sqlite_seconds", time.perf_counter() - t0, kind="COMMIT")
+        self.commits += 1
+
+    def execute(self, sql: str, params=()) -> sqlite3.Cursor:
+        conn = self.connection()
+        autocommit = not conn.in_transaction
+        changes = conn.total_changes
+        t0 = time.perf_counter()
+        cur = conn.execute(sql, params)
+        METRICS.observe("tripbuddy_sqlite_seconds", time.perf_counter() - t0, kind=_sql_kind(sql))
+        if autocommit and conn.total_changes != changes:
+            self.commits += 1
+        return cur
+
+    def executemany(self, sql: str, seq_of_params) -> sqlite3.Cursor:
+        t0 = time.perf_counter()
+        cur = self.connection().executemany(sql, seq_of_params)
+        METRICS.observe("tripbuddy_sqlite_seconds", time.perf_counter() - t0, kind=_sql_kind(sql))
+        return cur
+
+    def query(self, sql: str, params=()) -> list:
+        t0 = time.perf_counter()
+        rows = self.connection().execute(sql, params).fetchall()
+        METRICS.observe("tripbuddy_sqlite_seconds", time.perf_counter() - t0, kind=_sql_kind(sql))
+        return rows
+
+    def query_one(self, sql: str, params=()):
+        t0 = time.perf_counter()
+        row = self.connection().execute(sql, params).fetchone()
+        METRICS.observe("tripbuddy_sqlite_seconds", time.perf_counter() - t0, kind=_sql_kind(sql))
+        return row
+
+
+db = Database(DB_PATH, DB_BUSY_TIMEOUT_MS)
 
 def table_info(name: str):
-    cur = _exec(f"PRAGMA table_info({name})")
-    return [dict(row) for row in cur.fetchall()]
+    return [dict(row) for row in db.query(f"PRAGMA table_info({name})")]
 
 def has_table(name: str):
-    cur = _exec(
+    row = db.query_one(
         "SELECT name FROM sqlite_master WHERE type='table' AND name=?",
         (name,)
     )
-    return cur.fetchone() is not None
+    return row is not None
 
 def ensure_tables():
     # requests
-    _exec("""
+    db.execute("""
     CREATE TABLE IF NOT EXISTS requests (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         chat_id INTEGER,
@@ -115,7 +1427,7 @@ def ensure_tables():
     )
     """)
     # request_attachments
-    _exec("""
+    db.execute("""
     CREATE TABLE IF NOT EXISTS request_attachments (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         request_id INTEGER,
@@ -124,7 +1436,7 @@ def ensure_tables():
     )
     """)
     # payments
-    _exec("""
+    db.execute("""
     CREATE TABLE IF NOT EXISTS payments (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         chat_id INTEGER,
@@ -136,7 +1448,7 @@ def ensure_tables():
     )
     """)
     # payment_files
-    _exec("""
+    db.execute("""
     CREATE TABLE IF NOT EXISTS payment_files (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         payment_id INTEGER,
@@ -144,6 +1456,92 @@ def ensure_tables():
         file_id TEXT
     )
     """)
+    # admin_messages — что бот отправил в админ-группу (карточка, фото, документы) и к какой
+    # заявке/оплате это относится: /find, /invoice, /confirmpaid ответом на любое из этих сообщений
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS admin_messages (
+        admin_chat_id INTEGER NOT NULL,
+        message_id INTEGER NOT NULL,
+        kind TEXT,                 -- card / photo / doc
+        chat_id INTEGER,           -- клиент
+        request_id INTEGER,
+        payment_id INTEGER,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (admin_chat_id, message_id)
+    ) WITHOUT ROWID
+    """)
+    # static_assets — file_id уже загруженных в Telegram статических файлов (оферта и т.п.)
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS static_assets (
+        sha256 TEXT PRIMARY KEY,
+        path TEXT,
+        file_id TEXT,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    # export_marks — до какого id каждый админ уже выгрузил таблицу (/export_csv since:last)
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS export_marks (
+        admin_id INTEGER NOT NULL,
+        tbl TEXT NOT NULL,
+        last_id INTEGER NOT NULL DEFAULT 0,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (admin_id, tbl)
+    ) WITHOUT ROWID
+    """)
+    # daily_rollup — дневные агрегаты для /stats (обновляются в транзакции каждой записи)
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS daily_rollup (
+        day TEXT NOT NULL,          -- 'YYYY-MM-DD' (UTC, как created_at)
+        metric TEXT NOT NULL,       -- 'requests' | 'payments'
+        dim TEXT NOT NULL,          -- тип заявки ('Отель' | 'Билеты') или валюта оплаты
+        cnt INTEGER NOT NULL DEFAULT 0,
+        sum_minor INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, metric, dim)
+    ) WITHOUT ROWID
+    """)
+    # fsm_sessions — состояние незавершённых диалогов (см. SessionStore)
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS fsm_sessions (
+        chat_id INTEGER PRIMARY KEY,
+        step TEXT,
+        data TEXT,          -- JSON
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    # processed_updates — принятые update_id (UPDATE_DEDUPE_PERSIST=1, см. UpdateDedupe)
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS processed_updates (
+        update_id INTEGER PRIMARY KEY,
+        seen_at REAL NOT NULL
+    )
+    """)
+    # broadcasts / broadcast_recipients — рассылки /broadcast и статус доставки каждому получателю
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        created_by INTEGER,
+        report_chat_id INTEGER,
+        text TEXT,
+        source_chat_id INTEGER,       -- если рассылаем копию сообщения (ответ командой на него)
+        source_message_id INTEGER,
+        filters TEXT,                 -- JSON
+        status TEXT NOT NULL DEFAULT 'draft',   -- draft / running / paused / done
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        started_at TEXT,
+        finished_at TEXT
+    )
+    """)
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS broadcast_recipients (
+        broadcast_id INTEGER NOT NULL,
+        chat_id INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',  -- pending / sent / blocked / failed
+        error TEXT,
+        sent_at TEXT,
+        PRIMARY KEY (broadcast_id, chat_id)
+    ) WITHOUT ROWID
+    """)
 
 def add_missing_columns():
     # requests — проверим обязательные поля (если вдруг таблица старая)
@@ -159,18 +1557,20 @@ def add_missing_columns():
         cols = {c["name"] for c in table_info("requests")}
         for name, typ in must_requests.items():
             if name not in cols:
-                _exec(f"ALTER TABLE requests ADD COLUMN {name} {typ}")
+                db.execute(f"ALTER TABLE requests ADD COLUMN {name} {typ}")
 
     # payments — добавим отсутствующие поля (вот тут обычно проблема)
     must_payments = {
         "chat_id":"INTEGER", "amount":"TEXT", "currency":"TEXT",
-        "pay_method":"TEXT", "pay_date":"TEXT", "created_at":"TEXT"
+        "pay_method":"TEXT", "pay_date":"TEXT", "created_at":"TEXT",
+        "amount_minor":"INTEGER",   # сумма в копейках/центах (см. to_minor_units)
+        "confirmed_at":"TEXT",      # когда админ подтвердил оплату (/confirmpaid)
     }
     if has_table("payments"):
         cols = {c["name"] for c in table_info("payments")}
         for name, typ in must_payments.items():
             if name not in cols:
-                _exec(f"ALTER TABLE payments ADD COLUMN {name} {typ}")
+                db.execute(f"ALTER TABLE payments ADD COLUMN {name} {typ}")
 
     # request_attachments
     must_req_att = {"request_id":"INTEGER", "kind":"TEXT", "file_id":"TEXT"}
@@ -178,7 +1578,7 @@ def add_missing_columns():
         cols = {c["name"] for c in table_info("request_attachments")}
         for name, typ in must_req_att.items():
             if name not in cols:
-                _exec(f"ALTER TABLE request_attachments ADD COLUMN {name} {typ}")
+                db.execute(f"ALTER TABLE request_attachments ADD COLUMN {name} {typ}")
 
     # payment_files
     must_pay_files = {"payment_id":"INTEGER", "kind":"TEXT", "file_id":"TEXT"}
@@ -186,21 +1586,652 @@ def add_missing_columns():
         cols = {c["name"] for c in table_info("payment_files")}
         for name, typ in must_pay_files.items():
             if name not in cols:
-                _exec(f"ALTER TABLE payment_files ADD COLUMN {name} {typ}")
-
-def init_db():
+                db.execute(f"ALTER TABLE payment_files ADD COLUMN {name} {typ}")
+
+def ensure_indexes():
+    # created_at сравниваем как строку ('YYYY-MM-DD HH:MM:SS' из CURRENT_TIMESTAMP) —
+    # без datetime(...) вокруг колонки, иначе индекс не используется
+    db.execute("CREATE INDEX IF NOT EXISTS idx_requests_created_at ON requests(created_at)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_requests_chat_id ON requests(chat_id)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_payments_created_at ON payments(created_at)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_requests_type_created_at ON requests(type, created_at)")
+
+# Полнотекстовый поиск по заявкам (/search): FTS5-индекс с внешним содержимым — сам текст
+# хранится только в requests, индекс поддерживают триггеры. Если SQLite собран без FTS5 — HAS_FTS=False.
+FTS_COLUMNS = ("route", "dates", "fullname", "contact", "citizenship", "passport_no")
+HAS_FTS = False
+
+def ensure_search_index() -> bool:
+    cols = ", ".join(FTS_COLUMNS)
+    new = ", ".join(f"new.{c}" for c in FTS_COLUMNS)
+    old = ", ".join(f"old.{c}" for c in FTS_COLUMNS)
+    try:
+        db.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS requests_fts USING fts5(
+            {cols}, content='requests', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+        )
+        """)
+    except sqlite3.OperationalError as e:
+        log.warning("FTS5 недоступен, /search отключён: %s", e)
+        return False
+    db.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS requests_fts_ai AFTER INSERT ON requests BEGIN
+        INSERT INTO requests_fts (rowid, {cols}) VALUES (new.id, {new});
+    END
+    """)
+    db.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS requests_fts_ad AFTER DELETE ON requests BEGIN
+        INSERT INTO requests_fts (requests_fts, rowid, {cols}) VALUES ('delete', old.id, {old});
+    END
+    """)
+    db.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS requests_fts_au AFTER UPDATE OF {cols} ON requests BEGIN
+        INSERT INTO requests_fts (requests_fts, rowid, {cols}) VALUES ('delete', old.id, {old});
+        INSERT INTO requests_fts (rowid, {cols}) VALUES (new.id, {new});
+    END
+    """)
+    # Индекс пуст или отстал (заявки были до миграции) — перестроим по requests
+    last_req = db.query_one("SELECT MAX(id) AS id FROM requests")["id"]
+    last_fts = db.query_one("SELECT MAX(id) AS id FROM requests_fts_docsize")["id"]
+    if last_req != last_fts:
+        db.execute("INSERT INTO requests_fts (requests_fts) VALUES ('rebuild')")
+    return True
+
+# Больше — не сумма оплаты, а опечатка; заодно суммы в daily_rollup далеки от предела INTEGER (2^63)
+MAX_MINOR_UNITS = 10 ** 15
+
+def to_minor_units(amount_str) -> int:
+    """'60000' -> 6000000, '70,5' -> 7050. Нечисловое значение или |сумма| > MAX_MINOR_UNITS — 0."""
+    try:
+        value = Decimal(str(amount_str).replace("\u00A0", "").replace(" ", "").replace(",", "."))
+        minor = int((value * 100).quantize(Decimal("1"), rounding=ROUND_HALF_UP))
+    except (InvalidOperation, ValueError, OverflowError):
+        return 0
+    return minor if -MAX_MINOR_UNITS <= minor <= MAX_MINOR_UNITS else 0
+
+def backfill_amount_minor():
+    # Старые оплаты: заполним amount_minor из текстового amount
+    rows = db.query("SELECT id, amount FROM payments WHERE amount_minor IS NULL")
+    if rows:
+        db.executemany("UPDATE payments SET amount_minor=? WHERE id=?",
+                       [(to_minor_units(r["amount"] or "0"), r["id"]) for r in rows])
+
+def rebuild_daily_rollup():
+    """Пересчитать daily_rollup целиком из requests/payments (для истории до появления таблицы)."""
+    with db.transaction():
+        db.execute("DELETE FROM daily_rollup")
+        db.execute("""
+            INSERT INTO daily_rollup (day, metric, dim, cnt, sum_minor)
+            SELECT date(created_at), 'requests', COALESCE(type, ''), COUNT(*), 0
+            FROM requests WHERE created_at IS NOT NULL
+            GROUP BY 1, 3
+        """)
+        db.execute("""
+            INSERT INTO daily_rollup (day, metric, dim, cnt, sum_minor)
+            SELECT date(created_at), 'payments', COALESCE(NULLIF(UPPER(currency), ''), 'RUB'),
+                   COUNT(*), COALESCE(SUM(amount_minor), 0)
+            FROM payments WHERE created_at IS NOT NULL
+            GROUP BY 1, 3
+        """)
+
+# ============ Миграции схемы ============
+# Версия схемы — в PRAGMA user_version (0 — база до версионирования). При старте выполняются только
+# миграции новее неё: каждая в своей транзакции вместе с подъёмом версии, поэтому падение посреди
+# миграции ничего не оставляет наполовину. Если схема актуальна, init_db() — это одно чтение PRAGMA.
+# Меняем схему только новой функцией в конце MIGRATIONS; уже выпущенные миграции не правим.
+
+def migration_baseline():
+    """Всё, что раньше проверялось на каждом старте: таблицы, колонки старых баз, индексы, amount_minor."""
     ensure_tables()
     add_missing_columns()
+    ensure_indexes()
+    backfill_amount_minor()
+    # daily_rollup только что появилась, а данные уже есть — заполним историю
+    if db.query_one("SELECT 1 FROM daily_rollup LIMIT 1") is None and (
+            db.query_one("SELECT 1 FROM requests LIMIT 1") or db.query_one("SELECT 1 FROM payments LIMIT 1")):
+        rebuild_daily_rollup()
+
+def migration_search_index():
+    """FTS5-индекс для /search (без FTS5 в сборке SQLite пропускается, /search выключен)."""
+    ensure_search_index()
+
+def migration_app_meta():
+    """app_meta — служебные пары ключ/значение (например, с какими параметрами выставлен вебхук)."""
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS app_meta (
+        key TEXT PRIMARY KEY,
+        value TEXT,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+    ) WITHOUT ROWID
+    """)
+
+def migration_broadcast_lease():
+    """Кто из процессов ведёт рассылку и до какого времени (см. start_broadcast)."""
+    db.execute("ALTER TABLE broadcasts ADD COLUMN owner TEXT")
+    db.execute("ALTER TABLE broadcasts ADD COLUMN lease_until REAL")
+
+def migration_file_unique_id():
+    """file_unique_id вложений: повторно присланный файл (тот же чек ко второй оплате) узнаём по нему."""
+    db.execute("ALTER TABLE request_attachments ADD COLUMN file_unique_id TEXT")
+    db.execute("ALTER TABLE payment_files ADD COLUMN file_unique_id TEXT")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_payment_files_unique ON payment_files(file_unique_id)")
+
+def migration_payment_files_payment_id():
+    """Индекс файлов по оплате: /export_csv from:/to: ищет чеки оплат за период по нему."""
+    db.execute("CREATE INDEX IF NOT EXISTS idx_payment_files_payment_id ON payment_files(payment_id)")
+
+MIGRATIONS = [migration_baseline, migration_search_index, migration_app_meta, migration_broadcast_lease,
+              migration_file_unique_id, migration_payment_files_payment_id]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def schema_version() -> int:
+    return db.query_one("PRAGMA user_version")[0]
+
+def migrate() -> list:
+    """Применить недостающие миграции. Возвращает номера применённых версий."""
+    applied = []
+    version = schema_version()
+    if version > SCHEMA_VERSION:
+        log.warning("schema version %d is newer than this build (%d), skipping migrations", version, SCHEMA_VERSION)
+        return applied
+    while version < SCHEMA_VERSION:
+        with db.transaction():
+            # BEGIN IMMEDIATE: другой процесс мог успеть мигрировать, пока мы ждали блокировку
+            version = schema_version()
+            if version >= SCHEMA_VERSION:
+                break
+            t0 = time.perf_counter()
+            MIGRATIONS[version]()
+            version += 1
+            db.execute(f"PRAGMA user_version = {version}")
+        applied.append(version)
+        log.info("schema migrated to v%d (%s) in %.1f ms", version, MIGRATIONS[version - 1].__name__,
+                 (time.perf_counter() - t0) * 1000)
+    return applied
 
-init_db()
+def init_db():
+    global HAS_FTS
+    migrate()
+    HAS_FTS = has_table("requests_fts")
+    if UPDATE_DEDUPE_PERSIST:
+        UPDATES.dedupe.database = db
+
+def get_meta(key: str):
+    row = db.query_one("SELECT value FROM app_meta WHERE key=?", (key,))
+    return row["value"] if row else None
+
+def set_meta(key: str, value: str):
+    db.execute("""
+        INSERT INTO app_meta (key, value) VALUES (?, ?)
+        ON CONFLICT(key) DO UPDATE SET value=excluded.value, updated_at=CURRENT_TIMESTAMP
+    """, (key, value))
+
+# ============ Запись заявок и оплат ============
+# Строка заявки/оплаты, все её вложения и счётчик в daily_rollup пишутся одной
+# транзакцией: вложения — одним executemany, коммит — один на всю отправку.
+# Ошибка откатывает всё целиком, «осиротевших» вложений без заявки не остаётся.
+ROLLUP_REQUEST_SQL = """
+    INSERT INTO daily_rollup (day, metric, dim, cnt, sum_minor)
+    SELECT date(created_at), 'requests', COALESCE(type, ''), 1, 0 FROM requests WHERE id=?
+    ON CONFLICT(day, metric, dim) DO UPDATE SET cnt = cnt + 1
+"""
+ROLLUP_PAYMENT_SQL = """
+    INSERT INTO daily_rollup (day, metric, dim, cnt, sum_minor)
+    SELECT date(created_at), 'payments', COALESCE(NULLIF(UPPER(currency), ''), 'RUB'), 1, amount_minor
+    FROM payments WHERE id=?
+    ON CONFLICT(day, metric, dim) DO UPDATE SET cnt = cnt + 1, sum_minor = sum_minor + excluded.sum_minor
+"""
+REQUEST_FIELDS = ("type", "route", "dates", "guests", "rooms", "stars", "breakfast", "location_pref", "budget",
+                  "class", "baggage", "carriers", "fullname", "dob", "gender", "citizenship", "passport_no",
+                  "passport_exp", "contact")
+
+def _attachment_rows(parent_id, attachments) -> list:
+    """Вложение из сессии — [kind, file_id, file_unique_id] (в старых сессиях — без file_unique_id)."""
+    return [(parent_id, kind, fid, rest[0] if rest else None) for kind, fid, *rest in attachments]
+
+def save_request(cid, d: dict) -> int:
+    with db.transaction():
+        cur = db.execute("""
+            INSERT INTO requests
+            (chat_id, type, route, dates, guests, rooms, stars, breakfast, location_pref, budget,
+             class, baggage, carriers, fullname, dob, gender, citizenship, passport_no, passport_exp, contact)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (cid, *(d.get(k) for k in REQUEST_FIELDS)))
+        request_id = cur.lastrowid
+        attachments = d.get("attachments", [])
+        if attachments:
+            db.executemany(
+                "INSERT INTO request_attachments (request_id, kind, file_id, file_unique_id) VALUES (?, ?, ?, ?)",
+                _attachment_rows(request_id, attachments)
+            )
+        db.execute(ROLLUP_REQUEST_SQL, (request_id,))
+    METRICS.inc("tripbuddy_requests_submitted_total", type=d.get("type") or "")
+    return request_id
+
+def save_payment(cid, amount, currency, pay_method, pay_date, attachments) -> int:
+    with db.transaction():
+        cur = db.execute("""
+            INSERT INTO payments (chat_id, amount, amount_minor, currency, pay_method, pay_date)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (cid, amount, to_minor_units(amount or "0"), currency, pay_method, pay_date))
+        payment_id = cur.lastrowid
+        if attachments:
+            db.executemany(
+                "INSERT INTO payment_files (payment_id, kind, file_id, file_unique_id) VALUES (?, ?, ?, ?)",
+                _attachment_rows(payment_id, attachments)
+            )
+        db.execute(ROLLUP_PAYMENT_SQL, (payment_id,))
+    METRICS.inc("tripbuddy_payments_submitted_total", currency=currency or "")
+    return payment_id
+
+def earlier_payments_with_files(attachments) -> list:
+    """id оплат, к которым уже приложен хотя бы один из этих файлов (по file_unique_id)."""
+    uids = [rest[0] for _, _, *rest in attachments if rest]
+    if not uids:
+        return []
+    marks = ",".join("?" * len(uids))
+    return [r[0] for r in db.query(
+        f"SELECT DISTINCT payment_id FROM payment_files WHERE file_unique_id IN ({marks}) ORDER BY payment_id", uids)]
+
+# ============ Статические файлы ============
+class StaticAssets:
+    """
+    Отправка статических файлов (оферта и т.п.) через кэш file_id.
+    Файл загружается в Telegram один раз; file_id хранится в static_assets по sha256
+    содержимого, поэтому изменённый файл автоматически загрузится заново.
+    Если Telegram отклонил сохранённый file_id — тоже загружаем заново.
+    """
+    def __init__(self):
+        self._digests = {}   # path -> (mtime_ns, size, sha256) — чтобы не читать файл каждый раз
+
+    def _digest(self, path: str) -> str:
+        st = os.stat(path)
+        cached = self._digests.get(path)
+        if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+            return cached[2]
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 16), b""):
+                h.update(chunk)
+        digest = h.hexdigest()
+        self._digests[path] = (st.st_mtime_ns, st.st_size, digest)
+        return digest
+
+    def send_document(self, chat_id, path: str, visible_file_name: str = None, **kwargs):
+        digest = self._digest(path)
+        row = db.query_one("SELECT file_id FROM static_assets WHERE sha256=?", (digest,))
+        if row and row["file_id"]:
+            try:
+                return bot.send_document(chat_id, row["file_id"], **kwargs)
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code != 400:
+                    raise
+                log.info("static asset %s: cached file_id rejected (%s), re-uploading", path, e.description)
+        with open(path, "rb") as f:
+            sent = bot.send_document(chat_id, f, visible_file_name=visible_file_name, **kwargs)
+        if sent.document:
+            db.execute("""
+                INSERT INTO static_assets (sha256, path, file_id, updated_at)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(sha256) DO UPDATE SET
+                    path=excluded.path, file_id=excluded.file_id, updated_at=excluded.updated_at
+            """, (digest, path, sent.document.file_id))
+        return sent
+
+
+static_assets = StaticAssets()
+
+# ============ Уведомления в админ-группу ============
+# Карточка заявки/оплаты и вложения уходят в админ-группу фоновым потоком: пользователь получает
+# «Спасибо!» сразу, а не после N последовательных загрузок. Фото и документы идут альбомами
+# по ADMIN_ALBUM_SIZE (Telegram принимает 2–10 файлов в альбоме), все — ответом на карточку.
+ADMIN_ALBUM_SIZE     = min(10, max(2, int(os.getenv("ADMIN_ALBUM_SIZE", "10"))))
+ADMIN_FANOUT_TIMEOUT = float(os.getenv("ADMIN_FANOUT_TIMEOUT", "60"))   # сколько ждём отправку очереди при остановке
+
+
+def _chunks(items: list, size: int):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def record_admin_messages(admin_id, sent: list, ref: dict):
+    """sent — [(kind, Message)]; ref — {"chat_id", "request_id", "payment_id"}. Одной транзакцией."""
+    with db.transaction():
+        db.executemany("""
+            INSERT OR REPLACE INTO admin_messages (admin_chat_id, message_id, kind, chat_id, request_id, payment_id)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, [(admin_id, msg.message_id, kind, ref.get("chat_id"), ref.get("request_id"), ref.get("payment_id"))
+              for kind, msg in sent])
+
+
+def resolve_admin_reply(message: types.Message):
+    """
+    К какому клиенту/заявке/оплате относится сообщение, на которое админ ответил командой.
+    Сначала — по admin_messages (один поиск по первичному ключу, работает и для ответа на фото
+    из альбома), для старых карточек — по тексту «(id 123)». None — если не нашли.
+    """
+    rm = message.reply_to_message
+    if rm is None:
+        return None
+    row = db.query_one("""
+        SELECT chat_id, request_id, payment_id FROM admin_messages WHERE admin_chat_id=? AND message_id=?
+    """, (message.chat.id, rm.message_id))
+    if row:
+        return dict(row)
+    m = re.search(r"id (\-?\d+)\)", rm.text or rm.caption or "")
+    if m:
+        return {"chat_id": int(m.group(1)), "request_id": None, "payment_id": None}
+    return None
+
+
+def send_admin_card(admin_id, body: str, attachments: list, ref: dict = None):
+    """Карточка + вложения ответом на неё. Возвращает отправленную карточку (Message).
+    Если задан ref — все отправленные сообщения записываются в admin_messages."""
+    card = bot.send_message(admin_id, body)
+    sent = [("card", card)]
+    reply = {"reply_to_message_id": card.message_id}
+    photos = [fid for kind, fid, *_ in attachments if kind == "photo"]
+    docs   = [fid for kind, fid, *_ in attachments if kind == "doc"]
+    for kind, files in (("photo", photos), ("doc", docs)):
+        for chunk in _chunks(files, ADMIN_ALBUM_SIZE):
+            if len(chunk) == 1:   # альбом из одного файла Telegram не принимает
+                if kind == "photo":
+                    msgs = [bot.send_photo(admin_id, chunk[0], **reply)]
+                else:
+                    msgs = [bot.send_document(admin_id, chunk[0], **reply)]
+            elif kind == "photo":
+                msgs = bot.send_media_group(admin_id, [types.InputMediaPhoto(fid) for fid in chunk], **reply)
+            else:
+                msgs = bot.send_media_group(admin_id, [types.InputMediaDocument(fid) for fid in chunk], **reply)
+            sent.extend((kind, m) for m in msgs)
+    if ref:
+        record_admin_messages(admin_id, sent, ref)
+    return card
+
+
+class AdminFanout:
+    """
+    Один фоновый поток, который по очереди отправляет карточки в админ-группу
+    (один поток — карточки в группе идут в том же порядке, что и заявки).
+    Если отправить не удалось, пользователю уходит error_text.
+    После shutdown() новые задания выполняются сразу в потоке вызывающего — ничего не теряется.
+    """
+    _STOP = object()
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.accepting = True
+        self.sent = 0
+        self.failed = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None and self.accepting:
+                self._thread = Thread(target=self._worker, name="admin-fanout", daemon=True)
+                self._thread.start()
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def submit(self, body: str, attachments: list, user_chat_id=None, error_text: str = None, ref: dict = None):
+        if ADMIN_GROUP_ID_INT is None:
+            return
+        job = (body, list(attachments or []), user_chat_id, error_text, ref)
+        rt = async_runtime()
+        if rt is not None:   # async-режим: карточка — задача в event loop, вложения параллельно (asyncio.gather)
+            return rt.submit_admin_card(job)
+        if not self.accepting:
+            return self._run(job)
+        self.start()
+        self._queue.put(job)
+
+    def _run(self, job):
+        body, attachments, user_chat_id, error_text, ref = job
+        try:
+            send_admin_card(ADMIN_GROUP_ID_INT, body, attachments, ref)
+            with self._lock:
+                self.sent += 1
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+            log.exception("admin fan-out error")
+            if user_chat_id is not None and error_text:
+                try:
+                    bot.send_message(user_chat_id, f"{error_text}: {e}")
+                except Exception:
+                    pass
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is self._STOP:
+                    return
+                self._run(job)
+            finally:
+                self._queue.task_done()
+
+    def shutdown(self, timeout: float = ADMIN_FANOUT_TIMEOUT):
+        self.accepting = False
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._queue.put(self._STOP)
+        thread.join(timeout)
+        if thread.is_alive():
+            log.warning("AdminFanout: остановка по таймауту, не отправлено %d карточек", self.depth())
+
+
+admin_fanout = AdminFanout()
+atexit.register(admin_fanout.shutdown)
+
+# ============ FSM (SQLite + кэш в памяти) ============
+SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", "0.5"))  # сек между пакетными записями в БД
+# Несколько процессов (WEB_CONCURRENCY > 1): апдейты одного чата Telegram раскидывает по разным
+# процессам, поэтому кэша нет — каждое чтение идёт в БД, а update()/extend() читают и пишут одной
+# транзакцией BEGIN IMMEDIATE, и процессы не затирают изменения друг друга.
+SESSION_SHARED         = os.getenv("SESSION_SHARED", "1" if WEB_CONCURRENCY > 1 else "").strip() in ("1", "true", "yes")
+SESSION_CACHE_MAX      = int(os.getenv("SESSION_CACHE_MAX", "10000"))     # сколько чатов держим в кэше
+
+
+class SessionStore:
+    """
+    Состояние диалогов (шаг + данные анкеты) с хранением в таблице fsm_sessions.
+    - Чтение идёт из кэша в памяти (промах — один SELECT по первичному ключу). В кэше не больше
+      max_entries чатов: давно не активные вытесняются (LRU). Чат без сессии тоже кэшируется
+      (step и data — None), пока его не заменит запись через set()/update()/extend().
+    - Запись сразу попадает в кэш, а в БД уходит пачкой фоновым потоком (write-behind)
+      раз в SESSION_FLUSH_INTERVAL, одной транзакцией.
+    - shared=True (несколько процессов): без кэша и write-behind, всё сразу в БД; update()/extend() —
+      чтение и запись в одной транзакции BEGIN IMMEDIATE (WAL + busy_timeout: процессы ждут друг друга).
+    Словарь из get_data() — только для чтения, менять данные нужно через update()/append().
+    """
+    _MISSING = object()
+    UPSERT_SQL = """
+        INSERT INTO fsm_sessions (chat_id, step, data, updated_at)
+        VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(chat_id) DO UPDATE SET
+            step=excluded.step, data=excluded.data, updated_at=excluded.updated_at
+    """
 
-# ============ FSM (в памяти) ============
-user_step = {}   # chat_id -> step
-user_data = {}   # chat_id -> dict
+    def __init__(self, database: Database, flush_interval: float, shared: bool = False, max_entries: int = 10000):
+        self.db = database
+        self.flush_interval = flush_interval
+        self.shared = shared
+        self.max_entries = max(1, max_entries)
+        self._lock = threading.Lock()      # кэш и список «грязных» записей
+        self._cache = OrderedDict()        # chat_id -> [step, data, loaded_at], от давно не нужных к свежим
+        self._dirty = {}                   # chat_id -> True (записать) | None (удалить)
+        self._flusher = None
+        self._wakeup = threading.Event()
+
+    # ---- чтение ----
+    def _load(self, cid):
+        row = self.db.query_one("SELECT step, data FROM fsm_sessions WHERE chat_id=?", (cid,))
+        if row is None:
+            return [None, None, time.monotonic()]
+        return [row[0], json.loads(row[1]) if row[1] else {}, time.monotonic()]
+
+    def _entry(self, cid):
+        if self.shared:
+            return self._load(cid)
+        with self._lock:
+            e = self._cache.get(cid)
+            if e is not None:
+                self._cache.move_to_end(cid)
+                return e
+        e = self._load(cid)
+        with self._lock:
+            if cid in self._dirty:          # пока читали — успели записать локально
+                return self._cache[cid]
+            self._remember(cid, e)          # и «сессии нет» тоже: следующее сообщение чата — без SELECT
+        return e
+
+    def _remember(self, cid, e):
+        """Под self._lock: положить в кэш и вытеснить лишние чистые записи (грязные ещё не записаны)."""
+        self._cache[cid] = e
+        self._cache.move_to_end(cid)
+        self._trim()
+
+    def _trim(self):
+        excess = len(self._cache) - self.max_entries
+        if excess <= 0:
+            return
+        victims = []
+        for key in self._cache:
+            if len(victims) >= excess:
+                break
+            if key not in self._dirty:
+                victims.append(key)
+        for key in victims:
+            del self._cache[key]
+
+    def get_step(self, cid):
+        return self._entry(cid)[0]
+
+    def get_data(self, cid) -> dict:
+        return self._entry(cid)[1] or {}
+
+    def has(self, cid) -> bool:
+        return self._entry(cid)[1] is not None
+
+    # ---- запись ----
+    def _put(self, cid, step, data):
+        if self.shared:
+            if data is None:
+                self.db.execute("DELETE FROM fsm_sessions WHERE chat_id=?", (cid,))
+            else:
+                self.db.execute(self.UPSERT_SQL, (cid, step, json.dumps(data, ensure_ascii=False)))
+            return
+        with self._lock:
+            self._dirty[cid] = True if data is not None else None
+            self._remember(cid, [step, data, time.monotonic()])
+        self._wakeup.set()
+
+    @contextmanager
+    def _mutation(self):
+        """Чтение и запись в update()/extend() — атомарно (для shared — одна транзакция на все процессы)."""
+        if self.shared:
+            with self.db.transaction():
+                yield
+        else:
+            yield
+
+    def set(self, cid, step, data: dict):
+        """Полностью заменить состояние чата."""
+        self._put(cid, step, dict(data))
+
+    def update(self, cid, step=_MISSING, fields: dict = None):
+        """Дописать поля анкеты и (если передан) перейти на новый шаг."""
+        with self._mutation():
+            cur_step, cur_data, _ = self._entry(cid)
+            data = dict(cur_data or {})
+            if fields:
+                data.update(fields)
+            self._put(cid, cur_step if step is self._MISSING else step, data)
+
+    def append(self, cid, bucket: str, item):
+        self.extend(cid, bucket, [item])
+
+    def extend(self, cid, bucket: str, items):
+        """Дописать несколько элементов в список bucket одной записью."""
+        with self._mutation():
+            cur_step, cur_data, _ = self._entry(cid)
+            data = dict(cur_data or {})
+            data[bucket] = list(data.get(bucket, [])) + [list(item) for item in items]
+            self._put(cid, cur_step, data)
+
+    def reset(self, cid):
+        self._put(cid, None, None)
+
+    # ---- сброс в БД ----
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, {}
+            upserts = [(cid, self._cache[cid][0], json.dumps(self._cache[cid][1], ensure_ascii=False))
+                       for cid, op in dirty.items() if op]
+            deletes = [(cid,) for cid, op in dirty.items() if op is None]
+        try:
+            with self.db.transaction():
+                if upserts:
+                    self.db.executemany(self.UPSERT_SQL, upserts)
+                if deletes:
+                    self.db.executemany("DELETE FROM fsm_sessions WHERE chat_id=?", deletes)
+            with self._lock:
+                self._trim()                # записанное стало чистым — его тоже можно вытеснить
+        except Exception:
+            log.exception("SessionStore flush error")
+            with self._lock:                # вернём в очередь — запишем в следующий раз
+                for cid, op in dirty.items():
+                    self._dirty.setdefault(cid, op)
+
+    def _flush_loop(self):
+        while True:
+            self._wakeup.wait()
+            time.sleep(self.flush_interval)   # копим изменения в пачку
+            self._wakeup.clear()
+            self.flush()
+
+    def start(self):
+        if self._flusher is None:
+            self._flusher = Thread(target=self._flush_loop, name="fsm-flush", daemon=True)
+            self._flusher.start()
+
+
+sessions = SessionStore(db, SESSION_FLUSH_INTERVAL, SESSION_SHARED, SESSION_CACHE_MAX)   # start() — в _start_workers
+atexit.register(sessions.flush)
+
+
+def _session_steps() -> dict:
+    """Незавершённые диалоги по шагам FSM (из fsm_sessions, после сброса кэша)."""
+    sessions.flush()
+    return {(("step", r["step"] or "-"),): r["n"]
+            for r in db.query("SELECT step, COUNT(*) AS n FROM fsm_sessions GROUP BY step")}
+
+
+METRICS.gauge("tripbuddy_sessions_active", "Незавершённые диалоги по шагам FSM", _session_steps)
+METRICS.gauge("tripbuddy_updates_queue_depth", "Апдейты в очереди UPDATES (async-режим: в работе)",
+              lambda: UPDATES.depth() + ASYNC_RUNTIME.inflight)
+METRICS.gauge("tripbuddy_outbox_waiting", "Исходящие вызовы, ждущие своей очереди",
+              lambda: {(("priority", k),): v for k, v in OUTBOX.stats()["depth"].items()})
+METRICS.gauge("tripbuddy_admin_fanout_queue_depth", "Карточки в очереди на отправку в админ-группу",
+              admin_fanout.depth)
+METRICS.gauge("tripbuddy_updates_total", "Апдейты: обработано / отклонено / ошибка / повтор",
+              lambda: {(("result", "processed"),): UPDATES.processed, (("result", "rejected"),): UPDATES.rejected,
+                       (("result", "failed"),): UPDATES.failed, (("result", "duplicate"),): UPDATES.dedupe.hits},
+              kind="counter")
+METRICS.gauge("tripbuddy_outbox_retries_total", "Повторы отправки после 429", lambda: OUTBOX.retries, kind="counter")
+METRICS.gauge("tripbuddy_sqlite_commits_total", "Коммиты SQLite", lambda: db.commits, kind="counter")
+METRICS.gauge("tripbuddy_log_records_skipped_total", "Записи лога, не попавшие в вывод: сэмплирование / переполнение очереди",
+              lambda: {(("reason", "sampled"),): LOG_FILTER.sampled_out, (("reason", "queue_full"),): _QueueHandler.dropped},
+              kind="counter")
 
 def reset_flow(cid):
-    user_step.pop(cid, None)
-    user_data.pop(cid, None)
+    sessions.reset(cid)
 
 # ============ Утилиты ============
 def is_admin(message: types.Message) -> bool:
@@ -222,6 +2253,7 @@ def is_admin(message: types.Message) -> bool:
     return False
 
 def admin_only(func):
+    @functools.wraps(func)
     def wrapper(message: types.Message):
         if not is_admin(message):
             return bot.reply_to(message, "Команда доступна только администратору.")
@@ -240,72 +2272,75 @@ def parse_amount_currency(raw: str):
     if cur == "РУБ": cur = "RUB"
     return (amount, cur)
 
-def to_num(amount_str: str) -> float:
-    try:
-        return float(amount_str.replace(",", "."))
-    except Exception:
-        return 0.0
-
 # ============ Клавиатуры ============
-def main_menu():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add("📝 Оставить заявку", "✅ Я оплатил(а)")
-    kb.add("📄 Оферта", "💬 Администратор")
-    return kb
+class KeyboardRegistry:
+    """
+    Готовые клавиатуры: каждая собирается один раз при старте, и хранится уже её JSON.
+    telebot передаёт строку в reply_markup как есть — без новых объектов и повторной
+    сериализации на каждое сообщение. Локализованные варианты регистрируются с lang=...;
+    если варианта нет — отдаём клавиатуру языка по умолчанию.
+    """
+    def __init__(self, default_lang: str = "ru"):
+        self.default_lang = default_lang
+        self._payloads = {}   # (name, lang) -> JSON
 
-def type_menu():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    kb.add("🏨 Отель", "✈️ Билеты")
-    kb.add("❌ Отмена")
-    return kb
+    def register(self, name: str, rows, lang: str = None, **options):
+        kb = types.ReplyKeyboardMarkup(**options)
+        for row in rows:
+            kb.add(*row)
+        self._payloads[(name, lang or self.default_lang)] = kb.to_json()
 
-def cancel_menu():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    kb.add("❌ Отмена")
-    return kb
+    def get(self, name: str, lang: str = None) -> str:
+        payload = self._payloads.get((name, lang or self.default_lang))
+        if payload is None:
+            payload = self._payloads[(name, self.default_lang)]
+        return payload
 
-def yes_no_menu():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    kb.add("Да ✅", "Нет ❌")
-    kb.add("❌ Отмена")
-    return kb
 
-def class_menu():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    kb.add("Эконом", "Премиум-эконом")
-    kb.add("Бизнес", "Первый")
-    kb.add("❌ Отмена")
-    return kb
+KEYBOARDS = KeyboardRegistry()
+_ONE_TIME = {"resize_keyboard": True, "one_time_keyboard": True}
+KEYBOARDS.register("main", [["📝 Оставить заявку", "✅ Я оплатил(а)"], ["📄 Оферта", "💬 Администратор"]],
+                   resize_keyboard=True)
+KEYBOARDS.register("type", [["🏨 Отель", "✈️ Билеты"], ["❌ Отмена"]], **_ONE_TIME)
+KEYBOARDS.register("cancel", [["❌ Отмена"]], **_ONE_TIME)
+KEYBOARDS.register("yes_no", [["Да ✅", "Нет ❌"], ["❌ Отмена"]], **_ONE_TIME)
+KEYBOARDS.register("class", [["Эконом", "Премиум-эконом"], ["Бизнес", "Первый"], ["❌ Отмена"]], **_ONE_TIME)
+KEYBOARDS.register("rooms", [["1 комната", "2 комнаты", "3+ комнат"], ["❌ Отмена"]], **_ONE_TIME)
+KEYBOARDS.register("stars", [["⭐️", "⭐️⭐️", "⭐️⭐️⭐️", "⭐️⭐️⭐️⭐️", "⭐️⭐️⭐️⭐️⭐️"], ["❌ Отмена"]], **_ONE_TIME)
+KEYBOARDS.register("gender", [["М", "Ж"], ["❌ Отмена"]], **_ONE_TIME)
+KEYBOARDS.register("attachments", [["Пропустить ⏭️", "Готово ✅"], ["❌ Отмена"]], **_ONE_TIME)
+KEYBOARDS.register("pay_finish", [["Пропустить ⏭️", "Отправить ✅"], ["❌ Отмена"]], **_ONE_TIME)
+KEYBOARDS.register("pay_only", [["✅ Я оплатил(а)"]], resize_keyboard=True)   # под инвойсом
 
-def rooms_menu():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    kb.add("1 комната", "2 комнаты", "3+ комнат")
-    kb.add("❌ Отмена")
-    return kb
+def main_menu(lang: str = None):
+    return KEYBOARDS.get("main", lang)
 
-def stars_menu():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    kb.add("⭐️", "⭐️⭐️", "⭐️⭐️⭐️", "⭐️⭐️⭐️⭐️", "⭐️⭐️⭐️⭐️⭐️")
-    kb.add("❌ Отмена")
-    return kb
+def type_menu(lang: str = None):
+    return KEYBOARDS.get("type", lang)
 
-def gender_menu():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    kb.add("М", "Ж")
-    kb.add("❌ Отмена")
-    return kb
+def cancel_menu(lang: str = None):
+    return KEYBOARDS.get("cancel", lang)
 
-def attachments_menu():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    kb.add("Пропустить ⏭️", "Готово ✅")
-    kb.add("❌ Отмена")
-    return kb
+def yes_no_menu(lang: str = None):
+    return KEYBOARDS.get("yes_no", lang)
 
-def pay_finish_menu():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    kb.add("Пропустить ⏭️", "Отправить ✅")
-    kb.add("❌ Отмена")
-    return kb
+def class_menu(lang: str = None):
+    return KEYBOARDS.get("class", lang)
+
+def rooms_menu(lang: str = None):
+    return KEYBOARDS.get("rooms", lang)
+
+def stars_menu(lang: str = None):
+    return KEYBOARDS.get("stars", lang)
+
+def gender_menu(lang: str = None):
+    return KEYBOARDS.get("gender", lang)
+
+def attachments_menu(lang: str = None):
+    return KEYBOARDS.get("attachments", lang)
+
+def pay_finish_menu(lang: str = None):
+    return KEYBOARDS.get("pay_finish", lang)
 
 # ============ БАЗОВЫЕ КОМАНДЫ ============
 @bot.message_handler(commands=['start'])
@@ -314,12 +2349,12 @@ def start_command(message: types.Message):
     bot.send_message(
         message.chat.id,
         "Привет! Это <b>TripBuddy</b> — ваш помощник по путешествиям ✈️\nВыберите действие:",
-        reply_markup=main_menu()
+        reply_markup=main_menu(), defer=True
     )
 
 @bot.message_handler(commands=['groupid'])
 def send_group_id(message: types.Message):
-    bot.send_message(message.chat.id, f"ID этой переписки: {message.chat.id}")
+    bot.send_message(message.chat.id, f"ID этой переписки: {message.chat.id}", defer=True)
 
 @bot.message_handler(commands=['admin_debug'])
 def admin_debug(message: types.Message):
@@ -328,217 +2363,378 @@ def admin_debug(message: types.Message):
         f"Эта переписка chat_id: {message.chat.id}\n"
         f"ADMIN_GROUP_ID_INT: {ADMIN_GROUP_ID_INT}\n"
         f"ADMIN_USERNAME: {ADMIN_USERNAME or '—'}\n"
-        f"Group Privacy должен быть Disabled в BotFather."
+        f"Group Privacy должен быть Disabled в BotFather.", defer=True
     )
 
-@bot.message_handler(func=lambda m: m.text in ["📄 Оферта", "/offer"])
 def send_offer(message: types.Message):
     pdf_path = "public_offer_tripbuddy.pdf"
     if os.path.exists(pdf_path):
-        with open(pdf_path, "rb") as f:
-            bot.send_document(message.chat.id, f, visible_file_name="TripBuddy_Offer.pdf")
-        bot.send_message(message.chat.id, "Оплачивая услугу, вы подтверждаете согласие с условиями публичной оферты.")
+        static_assets.send_document(message.chat.id, pdf_path, visible_file_name="TripBuddy_Offer.pdf")
+        bot.send_message(message.chat.id, "Оплачивая услугу, вы подтверждаете согласие с условиями публичной оферты.", defer=True)
     else:
-        bot.send_message(message.chat.id, "Не нашла файл оферты. Загрузите <b>public_offer_tripbuddy.pdf</b> в корень проекта.")
+        bot.send_message(message.chat.id, "Не нашла файл оферты. Загрузите <b>public_offer_tripbuddy.pdf</b> в корень проекта.", defer=True)
 
-@bot.message_handler(func=lambda m: m.text == "💬 Администратор")
 def admin_flow(message: types.Message):
     who = ADMIN_USERNAME or "—"
-    bot.send_message(message.chat.id, f"Связаться с администратором: {who}\nОтветим быстро 🙂")
+    bot.send_message(message.chat.id, f"Связаться с администратором: {who}\nОтветим быстро 🙂", defer=True)
 
 @bot.message_handler(commands=['cancel'])
-@bot.message_handler(func=lambda m: m.text == "❌ Отмена")
 def cancel_flow(message: types.Message):
     reset_flow(message.chat.id)
-    bot.send_message(message.chat.id, "Окей, остановила. Чем ещё помочь?", reply_markup=main_menu())
+    bot.send_message(message.chat.id, "Окей, остановила. Чем ещё помочь?", reply_markup=main_menu(), defer=True)
+
+# ============ МАРШРУТИЗАЦИЯ ТЕКСТА ============
+# Вместо двух десятков фильтров вида lambda m: step == "..." — один хэндлер:
+# шаг чата читаем один раз и по словарям сразу находим нужную функцию. Найденная пара
+# (шаг, функция) запоминается в message._route: фильтр, сам route_text и метка метрики
+# берут её оттуда, а в async-режиме её заранее считает AsyncRuntime.process в пуле потоков.
+# Порядок проверок повторяет прежний порядок регистрации хэндлеров:
+#   1) MENU_ROUTES   — кнопки меню и «❌ Отмена» (работают на любом шаге);
+#   2) REQUEST_STEPS — шаги заявки;
+#   3) PAY_ROUTES    — «✅ Я оплатил(а)»;
+#   4) PAY_STEPS     — шаги оплаты;
+#   5) PAY_BUTTONS   — «Отправить ✅» / «Пропустить ⏭️» без шага (pay_finish_fallback);
+#   6) fallback      — любой прочий текст, кроме команд.
+# Таблицы заполняются ниже, в разделах со своими хэндлерами.
+
+def _resolve_route(message: types.Message):
+    """(шаг, функция) для текста; функция None — команда без шага/кнопки. Считается один раз на сообщение."""
+    route = getattr(message, "_route", None)
+    if route is not None:
+        return route
+    text = message.text or ""
+    step = sessions.get_step(message.chat.id)
+    handler = MENU_ROUTES.get(text) or REQUEST_STEPS.get(step) or PAY_ROUTES.get(text) \
+        or PAY_STEPS.get(step) or PAY_BUTTONS.get(text.strip())
+    if handler is None and not text.startswith("/"):
+        handler = fallback
+    route = message._route = (step, handler)
+    return route
+
+# Команды без шага/кнопки (None) пропускаем дальше — к хэндлерам commands=[...]
+@bot.message_handler(func=lambda m: _resolve_route(m)[1] is not None)
+def route_text(message: types.Message):
+    step, handler = _resolve_route(message)
+    step = step or "-"
+    t0 = time.perf_counter()
+    try:
+        with log_context(step=step):
+            return handler(message)
+    finally:
+        elapsed = time.perf_counter() - t0
+        METRICS.observe("tripbuddy_step_seconds", elapsed, step=step, handler=handler.__name__)
+        if PROFILER.active:
+            PROFILER.record(f"route_text → {handler.__name__}", elapsed)
 
 # ============ ПРИЁМ ВЛОЖЕНИЙ (общий) ============
+# Альбом (несколько фото/документов разом) Telegram присылает отдельными апдейтами с общим
+# media_group_id. Файлы альбома копим, пока не пройдёт ALBUM_WINDOW секунд без новых, и кладём
+# в сессию одной записью с одним ответом «Принято N файлов». Одиночный файл принимаем сразу.
+# Вложение в сессии — [kind, file_id, file_unique_id]: file_id у одного и того же файла бывает
+# разным, а file_unique_id — нет, по нему повторно присланный скриншот второй раз не сохраняем.
+# «Готово ✅» / «Отправить ✅» сначала дописывают недособранный альбом (ATTACHMENTS.flush).
+ALBUM_WINDOW = float(os.getenv("ALBUM_WINDOW", "1.5"))
+
+
+def _attachment_of(message: types.Message):
+    if message.photo:
+        photo = message.photo[-1]
+        return ["photo", photo.file_id, photo.file_unique_id]
+    if message.document:
+        return ["doc", message.document.file_id, message.document.file_unique_id]
+    return None
+
+
+def _files_word(n: int) -> str:
+    if n % 10 == 1 and n % 100 != 11:
+        return "файл"
+    if 2 <= n % 10 <= 4 and not 12 <= n % 100 <= 14:
+        return "файла"
+    return "файлов"
+
+
+def _call_later(delay: float, fn, message: types.Message):
+    """
+    fn(message) через delay секунд — по очереди с апдейтами этого чата (как хэндлер), чтобы не
+    пересекаться с ними в сессии: в async-режиме — в его lane AsyncRuntime, иначе — в его воркере
+    UPDATES. Если пул не запущен, fn выполняется прямо в потоке таймера.
+    """
+    rt = async_runtime()
+    if rt is not None:
+        return rt.call_later(delay, fn, message)
+
+    def run():
+        with log_context(chat_id=message.chat.id):
+            fn(message)
+
+    def fire():
+        if not UPDATES.run_in_chat(message.chat.id, run):
+            run()
+    timer = threading.Timer(delay, fire)
+    timer.daemon = True
+    timer.start()
+
+
+class AttachmentIntake:
+    def __init__(self, window: float):
+        self.window = window
+        self._lock = threading.Lock()   # _albums, _chats и счётчики; сессию под ним не трогаем
+        self._albums = {}               # (chat_id, media_group_id) -> {"bucket", "items", "deadline"}
+        self._chats = {}                # chat_id -> [Lock, сколько ждут]: запись вложений в сессию чата
+        self.albums = 0
+        self.stored = 0
+        self.duplicates = 0
+
+    @contextmanager
+    def _chat_lock(self, cid):
+        """Запись в сессию одного чата — по очереди; другие чаты (и их запись в SQLite) не ждут."""
+        with self._lock:
+            lane = self._chats.get(cid)
+            if lane is None:
+                lane = self._chats[cid] = [threading.Lock(), 0]
+            lane[1] += 1
+        try:
+            with lane[0]:
+                yield
+        finally:
+            with self._lock:
+                lane[1] -= 1
+                if not lane[1]:
+                    del self._chats[cid]
+
+    def _store(self, cid, bucket: str, items: list) -> tuple:
+        """Под _chat_lock(cid): дописать в bucket файлы, которых там ещё нет. -> (добавлено, повторов)"""
+        seen = {a[2] for a in sessions.get_data(cid).get(bucket, []) if len(a) > 2}
+        fresh = []
+        for item in items:
+            if item[2] not in seen:
+                seen.add(item[2])
+                fresh.append(item)
+        if fresh:
+            sessions.extend(cid, bucket, fresh)
+        with self._lock:
+            self.stored += len(fresh)
+            self.duplicates += len(items) - len(fresh)
+        return len(fresh), len(items) - len(fresh)
+
+    @staticmethod
+    def _ack(added: int, duplicates: int) -> str:
+        if not added:
+            return "Эти файлы уже добавлены ✅"
+        text = f"📎 Принято {added} {_files_word(added)} ✅"
+        if duplicates:
+            text += f", повторы пропущены: {duplicates}"
+        return text
+
+    def receive(self, message: types.Message, bucket: str):
+        cid, item = message.chat.id, _attachment_of(message)
+        if message.media_group_id is None:
+            with self._chat_lock(cid):
+                added, _ = self._store(cid, bucket, [item])
+            if not added:
+                bot.send_message(cid, "Этот файл уже добавлен ✅", defer=True)
+            else:
+                bot.send_message(cid, "📸 Фото принято ✅" if item[0] == "photo" else "📎 Документ принят ✅", defer=True)
+            return
+        key = (cid, message.media_group_id)
+        with self._lock:
+            album = self._albums.get(key)
+            first = album is None
+            if first:
+                album = self._albums[key] = {"bucket": bucket, "items": []}
+            album["items"].append(item)
+            album["deadline"] = time.monotonic() + self.window
+        if first:
+            _call_later(self.window, self._on_timer, message)
+
+    def _on_timer(self, message: types.Message):
+        key = (message.chat.id, message.media_group_id)
+        try:
+            with self._lock:
+                album = self._albums.get(key)
+                left = album["deadline"] - time.monotonic() if album else 0
+            if album is None:
+                return   # уже дописан через flush()
+            if left > 0:   # альбом ещё приходит — ждём остаток окна
+                return _call_later(left, self._on_timer, message)
+            self._finish(message.chat.id, [key])
+        except Exception:
+            log.exception("album flush error")
+
+    def _finish(self, cid, keys: list, ack: bool = True):
+        done = []
+        with self._lock:
+            albums = [self._albums.pop(key, None) for key in keys]
+        with self._chat_lock(cid):
+            for album in albums:
+                if album is None or sessions.get_step(cid) is None:
+                    continue   # уже дописан или диалог отменили, пока альбом собирался
+                done.append(self._store(cid, album["bucket"], album["items"]))
+                with self._lock:
+                    self.albums += 1
+        if ack:
+            for added, duplicates in done:
+                bot.send_message(cid, self._ack(added, duplicates), defer=True)
+
+    def flush(self, cid):
+        """Дописать в сессию альбомы чата, которые ещё собираются (перед отправкой заявки/оплаты)."""
+        with self._lock:
+            keys = [key for key in self._albums if key[0] == cid]
+        if keys:
+            self._finish(cid, keys)
+
+    def flush_all(self):
+        """При остановке: сохранить всё собранное без ответов — Bot API может быть уже недоступен."""
+        with self._lock:
+            keys = list(self._albums)
+        for cid in {key[0] for key in keys}:
+            self._finish(cid, [key for key in keys if key[0] == cid], ack=False)
+
+
+ATTACHMENTS = AttachmentIntake(ALBUM_WINDOW)
+atexit.register(ATTACHMENTS.flush_all)   # раньше sessions.flush (atexit — в обратном порядке)
+METRICS.gauge("tripbuddy_attachments_total", "Принятые вложения: сохранено / повтор по file_unique_id",
+              lambda: {(("result", "stored"),): ATTACHMENTS.stored, (("result", "duplicate"),): ATTACHMENTS.duplicates},
+              kind="counter")
+
+
 @bot.message_handler(content_types=['photo', 'document'])
 def handle_any_attachments(message: types.Message):
-    step = user_step.get(message.chat.id)
+    step = sessions.get_step(message.chat.id)
     if step is None:
         return  # вне сценария — игнор
-    data = user_data.setdefault(message.chat.id, {})
     bucket = "attachments" if not str(step).startswith("pay_") else "pay_attachments"
-    data.setdefault(bucket, [])
-    if message.photo:
-        data[bucket].append(("photo", message.photo[-1].file_id))
-        bot.send_message(message.chat.id, "📸 Фото принято ✅")
-    elif message.document:
-        data[bucket].append(("doc", message.document.file_id))
-        bot.send_message(message.chat.id, "📎 Документ принят ✅")
+    ATTACHMENTS.receive(message, bucket)
 
 # ============ ЗАЯВКА ============
-@bot.message_handler(func=lambda m: m.text == "📝 Оставить заявку")
 def request_start(message: types.Message):
-    reset_flow(message.chat.id)
-    user_data[message.chat.id] = {"attachments": []}
-    user_step[message.chat.id] = "type"
-    bot.send_message(message.chat.id, "Какой тип заявки? Выберите, пожалуйста:", reply_markup=type_menu())
+    sessions.set(message.chat.id, "type", {"attachments": []})
+    bot.send_message(message.chat.id, "Какой тип заявки? Выберите, пожалуйста:", reply_markup=type_menu(), defer=True)
 
-@bot.message_handler(func=lambda m: user_step.get(m.chat.id) == "type")
 def step_type(message: types.Message):
     t = (message.text or "").strip()
     if t not in ["🏨 Отель", "✈️ Билеты", "❌ Отмена"]:
-        return bot.send_message(message.chat.id, "Пожалуйста, выберите на клавиатуре.", reply_markup=type_menu())
+        return bot.send_message(message.chat.id, "Пожалуйста, выберите на клавиатуре.", reply_markup=type_menu(), defer=True)
     if t == "❌ Отмена": return cancel_flow(message)
-    user_data[message.chat.id]["type"] = "Отель" if "Отель" in t else "Билеты"
-    user_step[message.chat.id] = "route"
-    prompt = "🏙️ Город/страна назначения:" if user_data[message.chat.id]["type"] == "Отель" else "🛫 Маршрут (откуда → куда):"
-    bot.send_message(message.chat.id, prompt, reply_markup=cancel_menu())
+    sessions.update(message.chat.id, "route", {"type": "Отель" if "Отель" in t else "Билеты"})
+    prompt = "🏙️ Город/страна назначения:" if sessions.get_data(message.chat.id)["type"] == "Отель" else "🛫 Маршрут (откуда → куда):"
+    bot.send_message(message.chat.id, prompt, reply_markup=cancel_menu(), defer=True)
 
-@bot.message_handler(func=lambda m: user_step.get(m.chat.id) == "route")
 def step_route(message: types.Message):
     if message.text == "❌ Отмена": return cancel_flow(message)
-    user_data[message.chat.id]["route"] = message.text.strip()
-    user_step[message.chat.id] = "dates"
-    bot.send_message(message.chat.id, "🗓️ Даты (например 01.09–07.09 или «гибко ±2 дня»):", reply_markup=cancel_menu())
+    sessions.update(message.chat.id, "dates", {"route": message.text.strip()})
+    bot.send_message(message.chat.id, "🗓️ Даты (например 01.09–07.09 или «гибко ±2 дня»):", reply_markup=cancel_menu(), defer=True)
 
-@bot.message_handler(func=lambda m: user_step.get(m.chat.id) == "dates")
 def step_dates(message: types.Message):
     if message.text == "❌ Отмена": return cancel_flow(message)
-    user_data[message.chat.id]["dates"] = message.text.strip()
-    if user_data[message.chat.id]["type"] == "Отель":
-        user_step[message.chat.id] = "guests"
-        bot.send_message(message.chat.id, "👥 Кол-во гостей и детей (например «2 взрослых, 1 ребёнок 5 лет»):", reply_markup=cancel_menu())
+    if sessions.get_data(message.chat.id).get("type") == "Отель":
+        sessions.update(message.chat.id, "guests", {"dates": message.text.strip()})
+        bot.send_message(message.chat.id, "👥 Кол-во гостей и детей (например «2 взрослых, 1 ребёнок 5 лет»):", reply_markup=cancel_menu(), defer=True)
     else:
-        user_step[message.chat.id] = "class"
-        bot.send_message(message.chat.id, "🪑 Класс перелёта:", reply_markup=class_menu())
+        sessions.update(message.chat.id, "class", {"dates": message.text.strip()})
+        bot.send_message(message.chat.id, "🪑 Класс перелёта:", reply_markup=class_menu(), defer=True)
 
 # --- Отель ---
-@bot.message_handler(func=lambda m: user_step.get(m.chat.id) == "guests")
 def step_guests(message: types.Message):
     if message.text == "❌ Отмена": return cancel_flow(message)
-    user_data[message.chat.id]["guests"] = message.text.strip()
-    user_step[message.chat.id] = "rooms"
-    bot.send_message(message.chat.id, "🛏️ Нужное кол-во комнат:", reply_markup=rooms_menu())
+    sessions.update(message.chat.id, "rooms", {"guests": message.text.strip()})
+    bot.send_message(message.chat.id, "🛏️ Нужное кол-во комнат:", reply_markup=rooms_menu(), defer=True)
 
-@bot.message_handler(func=lambda m: user_step.get(m.chat.id) == "rooms")
 def step_rooms(message: types.Message):
     if message.text == "❌ Отмена": return cancel_flow(message)
-    user_data[message.chat.id]["rooms"] = message.text.strip()
-    user_step[message.chat.id] = "stars"
-    bot.send_message(message.chat.id, "⭐️ Предпочитаемая звёздность:", reply_markup=stars_menu())
+    sessions.update(message.chat.id, "stars", {"rooms": message.text.strip()})
+    bot.send_message(message.chat.id, "⭐️ Предпочитаемая звёздность:", reply_markup=stars_menu(), defer=True)
 
-@bot.message_handler(func=lambda m: user_step.get(m.chat.id) == "stars")
 def step_stars(message: types.Message):
     if message.text == "❌ Отмена": return cancel_flow(message)
-    user_data[message.chat.id]["stars"] = message.text.strip()
-    user_step[message.chat.id] = "breakfast"
-    bot.send_message(message.chat.id, "🍳 Нужен ли завтрак?", reply_markup=yes_no_menu())
+    sessions.update(message.chat.id, "breakfast", {"stars": message.text.strip()})
+    bot.send_message(message.chat.id, "🍳 Нужен ли завтрак?", reply_markup=yes_no_menu(), defer=True)
 
-@bot.message_handler(func=lambda m: user_step.get(m.chat.id) == "breakfast")
 def step_breakfast(message: types.Message):
     if message.text == "❌ Отмена": return cancel_flow(message)
-    user_data[message.chat.id]["breakfast"] = message.text.strip()
-    user_step[message.chat.id] = "location_pref"
-    bot.send_message(message.chat.id, "📍 Пожелания по расположению (центр, у моря, район):", reply_markup=cancel_menu())
+    sessions.update(message.chat.id, "location_pref", {"breakfast": message.text.strip()})
+    bot.send_message(message.chat.id, "📍 Пожелания по расположению (центр, у моря, район):", reply_markup=cancel_menu(), defer=True)
 
 # --- Билеты ---
-@bot.message_handler(func=lambda m: user_step.get(m.chat.id) == "class")
 def step_class(message: types.Message):
     if message.text == "❌ Отмена": return cancel_flow(message)
-    user_data[message.chat.id]["class"] = message.text.strip()
-    user_step[message.chat.id] = "baggage"
-    bot.send_message(message.chat.id, "🧳 Нужен багаж?", reply_markup=yes_no_menu())
+    sessions.update(message.chat.id, "baggage", {"class": message.text.strip()})
+    bot.send_message(message.chat.id, "🧳 Нужен багаж?", reply_markup=yes_no_menu(), defer=True)
 
-@bot.message_handler(func=lambda m: user_step.get(m.chat.id) == "baggage")
 def step_baggage(message: types.Message):
     if message.text == "❌ Отмена": return cancel_flow(message)
-    user_data[message.chat.id]["baggage"] = message.text.strip()
-    user_step[message.chat.id] = "carriers"
-    bot.send_message(message.chat.id, "✈️ Предпочтительные авиакомпании (если есть):", reply_markup=cancel_menu())
+    sessions.update(message.chat.id, "carriers", {"baggage": message.text.strip()})
+    bot.send_message(message.chat.id, "✈️ Предпочтительные авиакомпании (если есть):", reply_markup=cancel_menu(), defer=True)
 
 # --- Общие шаги ---
-@bot.message_handler(func=lambda m: user_step.get(m.chat.id) == "location_pref")
 def step_location_pref(message: types.Message):
     if message.text == "❌ Отмена": return cancel_flow(message)
-    user_data[message.chat.id]["location_pref"] = message.text.strip()
-    user_step[message.chat.id] = "budget"
-    bot.send_message(message.chat.id, "💰 Бюджет (за ночь / общий):", reply_markup=cancel_menu())
+    sessions.update(message.chat.id, "budget", {"location_pref": message.text.strip()})
+    bot.send_message(message.chat.id, "💰 Бюджет (за ночь / общий):", reply_markup=cancel_menu(), defer=True)
 
-@bot.message_handler(func=lambda m: user_step.get(m.chat.id) == "carriers")
 def step_carriers(message: types.Message):
     if message.text == "❌ Отмена": return cancel_flow(message)
-    user_data[message.chat.id]["carriers"] = message.text.strip()
-    user_step[message.chat.id] = "budget"
-    bot.send_message(message.chat.id, "💰 Бюджет на перелёт:", reply_markup=cancel_menu())
+    sessions.update(message.chat.id, "budget", {"carriers": message.text.strip()})
+    bot.send_message(message.chat.id, "💰 Бюджет на перелёт:", reply_markup=cancel_menu(), defer=True)
 
-@bot.message_handler(func=lambda m: user_step.get(m.chat.id) == "budget")
 def step_budget(message: types.Message):
     if message.text == "❌ Отмена": return cancel_flow(message)
-    user_data[message.chat.id]["budget"] = message.text.strip()
-    user_step[message.chat.id] = "contact"
-    bot.send_message(message.chat.id, "📞 Как с вами связаться? (телеграм @ник или номер):", reply_markup=cancel_menu())
+    sessions.update(message.chat.id, "contact", {"budget": message.text.strip()})
+    bot.send_message(message.chat.id, "📞 Как с вами связаться? (телеграм @ник или номер):", reply_markup=cancel_menu(), defer=True)
 
-@bot.message_handler(func=lambda m: user_step.get(m.chat.id) == "contact")
 def step_contact(message: types.Message):
     if message.text == "❌ Отмена": return cancel_flow(message)
-    user_data[message.chat.id]["contact"] = message.text.strip()
-    user_step[message.chat.id] = "fullname"
-    bot.send_message(message.chat.id, "🪪 ФИО латиницей (как в паспорте):", reply_markup=cancel_menu())
+    sessions.update(message.chat.id, "fullname", {"contact": message.text.strip()})
+    bot.send_message(message.chat.id, "🪪 ФИО латиницей (как в паспорте):", reply_markup=cancel_menu(), defer=True)
 
-@bot.message_handler(func=lambda m: user_step.get(m.chat.id) == "fullname")
 def step_fullname(message: types.Message):
     if message.text == "❌ Отмена": return cancel_flow(message)
-    user_data[message.chat.id]["fullname"] = message.text.strip()
-    user_step[message.chat.id] = "dob"
-    bot.send_message(message.chat.id, "🎂 Дата рождения (ДД.ММ.ГГГГ):", reply_markup=cancel_menu())
+    sessions.update(message.chat.id, "dob", {"fullname": message.text.strip()})
+    bot.send_message(message.chat.id, "🎂 Дата рождения (ДД.ММ.ГГГГ):", reply_markup=cancel_menu(), defer=True)
 
-@bot.message_handler(func=lambda m: user_step.get(m.chat.id) == "dob")
 def step_dob(message: types.Message):
     if message.text == "❌ Отмена": return cancel_flow(message)
-    user_data[message.chat.id]["dob"] = message.text.strip()
-    if user_data[message.chat.id]["type"] == "Билеты":
-        user_step[message.chat.id] = "gender"
-        bot.send_message(message.chat.id, "👤 Пол:", reply_markup=gender_menu())
+    if sessions.get_data(message.chat.id).get("type") == "Билеты":
+        sessions.update(message.chat.id, "gender", {"dob": message.text.strip()})
+        bot.send_message(message.chat.id, "👤 Пол:", reply_markup=gender_menu(), defer=True)
     else:
-        user_step[message.chat.id] = "citizenship"
-        bot.send_message(message.chat.id, "🌍 Гражданство:", reply_markup=cancel_menu())
+        sessions.update(message.chat.id, "citizenship", {"dob": message.text.strip()})
+        bot.send_message(message.chat.id, "🌍 Гражданство:", reply_markup=cancel_menu(), defer=True)
 
-@bot.message_handler(func=lambda m: user_step.get(m.chat.id) == "gender")
 def step_gender(message: types.Message):
     if message.text == "❌ Отмена": return cancel_flow(message)
-    user_data[message.chat.id]["gender"] = message.text.strip()
-    user_step[message.chat.id] = "citizenship"
-    bot.send_message(message.chat.id, "🌍 Гражданство:", reply_markup=cancel_menu())
+    sessions.update(message.chat.id, "citizenship", {"gender": message.text.strip()})
+    bot.send_message(message.chat.id, "🌍 Гражданство:", reply_markup=cancel_menu(), defer=True)
 
-@bot.message_handler(func=lambda m: user_step.get(m.chat.id) == "citizenship")
 def step_citizenship(message: types.Message):
     if message.text == "❌ Отмена": return cancel_flow(message)
-    user_data[message.chat.id]["citizenship"] = message.text.strip()
-    user_step[message.chat.id] = "passport_no"
-    bot.send_message(message.chat.id, "🔢 Номер паспорта:", reply_markup=cancel_menu())
+    sessions.update(message.chat.id, "passport_no", {"citizenship": message.text.strip()})
+    bot.send_message(message.chat.id, "🔢 Номер паспорта:", reply_markup=cancel_menu(), defer=True)
 
-@bot.message_handler(func=lambda m: user_step.get(m.chat.id) == "passport_no")
 def step_passport_no(message: types.Message):
     if message.text == "❌ Отмена": return cancel_flow(message)
-    user_data[message.chat.id]["passport_no"] = message.text.strip()
-    user_step[message.chat.id] = "passport_exp"
-    bot.send_message(message.chat.id, "📅 Срок действия паспорта (ДД.ММ.ГГГГ):", reply_markup=cancel_menu())
+    sessions.update(message.chat.id, "passport_exp", {"passport_no": message.text.strip()})
+    bot.send_message(message.chat.id, "📅 Срок действия паспорта (ДД.ММ.ГГГГ):", reply_markup=cancel_menu(), defer=True)
 
-@bot.message_handler(func=lambda m: user_step.get(m.chat.id) == "passport_exp")
 def step_passport_exp(message: types.Message):
     if message.text == "❌ Отмена": return cancel_flow(message)
-    user_data[message.chat.id]["passport_exp"] = message.text.strip()
-    user_step[message.chat.id] = "attachments"
+    sessions.update(message.chat.id, "attachments", {"passport_exp": message.text.strip()})
     bot.send_message(
         message.chat.id,
-        "📎 Прикрепите скриншоты/документы (паспорт, примеры билетов/отелей) — по одному за сообщение.\n"
+        "📎 Прикрепите скриншоты/документы (паспорт, примеры билетов/отелей) — можно несколько сразу.\n"
         "Когда закончите, нажмите <b>«Готово ✅»</b> или «Пропустить ⏭️».",
-        reply_markup=attachments_menu()
+        reply_markup=attachments_menu(), defer=True
     )
 
-@bot.message_handler(func=lambda m: user_step.get(m.chat.id) == "attachments")
 def finish_attachments(message: types.Message):
     t = (message.text or "").strip()
 
     # 🔹 Анти-дубли: если уже отправляли эту заявку — игнорируем повтор
-    if user_data.get(message.chat.id, {}).get("submitted_request"):
+    if sessions.get_data(message.chat.id).get("submitted_request"):
         return bot.send_message(
             message.chat.id,
             "Эта заявка уже была отправлена ✅",
-            reply_markup=main_menu()
+            reply_markup=main_menu(), defer=True
         )
 
     if t == "❌ Отмена":
@@ -547,49 +2743,20 @@ def finish_attachments(message: types.Message):
         return bot.send_message(
             message.chat.id,
             "Добавьте файл(ы) или нажмите «Готово ✅» / «Пропустить ⏭️».",
-            reply_markup=attachments_menu()
+            reply_markup=attachments_menu(), defer=True
         )
 
     cid = message.chat.id
-    d = user_data.get(cid, {})
+    ATTACHMENTS.flush(cid)
+    d = sessions.get_data(cid)
     username = f"@{message.from_user.username}" if message.from_user.username else "—"
 
-    # Сохраним в БД
-    cur = _exec("""
-        INSERT INTO requests
-        (chat_id, type, route, dates, guests, rooms, stars, breakfast, location_pref, budget,
-         class, baggage, carriers, fullname, dob, gender, citizenship, passport_no, passport_exp, contact)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
-        cid,
-        d.get("type"),
-        d.get("route"),
-        d.get("dates"),
-        d.get("guests"),
-        d.get("rooms"),
-        d.get("stars"),
-        d.get("breakfast"),
-        d.get("location_pref"),
-        d.get("budget"),
-        d.get("class"),
-        d.get("baggage"),
-        d.get("carriers"),
-        d.get("fullname"),
-        d.get("dob"),
-        d.get("gender"),
-        d.get("citizenship"),
-        d.get("passport_no"),
-        d.get("passport_exp"),
-        d.get("contact"),
-    ))
-    request_id = cur.lastrowid
-
-    # attachments -> request_attachments
-    for kind, fid in d.get("attachments", []):
-        _exec(
-            "INSERT INTO request_attachments (request_id, kind, file_id) VALUES (?, ?, ?)",
-            (request_id, kind, fid)
-        )
+    # Сохраним в БД (заявка и вложения — атомарно, см. save_request)
+    request_id = None
+    try:
+        request_id = save_request(cid, d)
+    except Exception as e:
+        bot.send_message(cid, f"⚠️ Не удалось сохранить заявку в БД: {e}", defer=True)
 
     # Сообщение в админ-группу
     if d.get("type") == "Отель":
@@ -632,87 +2799,100 @@ def finish_attachments(message: types.Message):
             f"От пользователя: {username} (id {message.from_user.id})"
         )
 
-    if ADMIN_GROUP_ID_INT is not None:
-        try:
-            admin_id = ADMIN_GROUP_ID_INT
-            sent = bot.send_message(admin_id, body)
-            photos = [fid for kind, fid in d.get("attachments", []) if kind == "photo"]
-            docs   = [fid for kind, fid in d.get("attachments", []) if kind == "doc"]
-            if photos:
-                media = [types.InputMediaPhoto(fid) for fid in photos[:10]]
-                bot.send_media_group(admin_id, media, reply_to_message_id=sent.message_id)
-            for fid in docs:
-                bot.send_document(admin_id, fid, reply_to_message_id=sent.message_id)
-        except Exception as e:
-            bot.send_message(cid, f"Не удалось отправить заявку в админ-группу: {e}")
+    admin_fanout.submit(body, d.get("attachments", []), cid, "Не удалось отправить заявку в админ-группу",
+                        ref={"chat_id": cid, "request_id": request_id})
 
-    bot.send_message(cid, "Спасибо! Заявка отправлена. Мы скоро свяжемся 🤝", reply_markup=main_menu())
+    bot.send_message(cid, "Спасибо! Заявка отправлена. Мы скоро свяжемся 🤝", reply_markup=main_menu(), defer=True)
 
     # ✅ помечаем как отправленную — чтобы второй раз не ушла
-    user_data.setdefault(cid, {})["submitted_request"] = True
+    sessions.update(cid, fields={"submitted_request": True})
     reset_flow(cid)
 
+MENU_ROUTES = {
+    "📄 Оферта": send_offer,
+    "/offer": send_offer,
+    "💬 Администратор": admin_flow,
+    "❌ Отмена": cancel_flow,
+    "📝 Оставить заявку": request_start,
+}
+
+REQUEST_STEPS = {
+    "type": step_type,
+    "route": step_route,
+    "dates": step_dates,
+    # Отель
+    "guests": step_guests,
+    "rooms": step_rooms,
+    "stars": step_stars,
+    "breakfast": step_breakfast,
+    # Билеты
+    "class": step_class,
+    "baggage": step_baggage,
+    # Общие шаги
+    "location_pref": step_location_pref,
+    "carriers": step_carriers,
+    "budget": step_budget,
+    "contact": step_contact,
+    "fullname": step_fullname,
+    "dob": step_dob,
+    "gender": step_gender,
+    "citizenship": step_citizenship,
+    "passport_no": step_passport_no,
+    "passport_exp": step_passport_exp,
+    "attachments": finish_attachments,
+}
+
 # ============ ОПЛАТА ============
 # ============ ОПЛАТА ============
 
 @bot.message_handler(commands=['whereami'])
 def cmd_whereami(message: types.Message):
-    step = user_step.get(message.chat.id)
-    d = user_data.get(message.chat.id)
+    step = sessions.get_step(message.chat.id)
+    d = sessions.get_data(message.chat.id)
     bot.reply_to(message, f"Текущий шаг: {step or '—'}\nКлючи user_data: {list(d.keys()) if d else '—'}")
 
-@bot.message_handler(func=lambda m: m.text == "✅ Я оплатил(а)")
 def pay_start(message: types.Message):
     # старт оплаты
-    reset_flow(message.chat.id)
-    user_data[message.chat.id] = {"pay_attachments": []}
-    user_step[message.chat.id] = "pay_amount"
+    sessions.set(message.chat.id, "pay_amount", {"pay_attachments": []})
     bot.send_message(
         message.chat.id,
         "💳 Укажите сумму и валюту (например: 60000 RUB):",
-        reply_markup=cancel_menu()
+        reply_markup=cancel_menu(), defer=True
     )
 
-@bot.message_handler(func=lambda m: user_step.get(m.chat.id) == "pay_amount")
 def pay_amount(message: types.Message):
     if (message.text or "") == "❌ Отмена":
         return cancel_flow(message)
-    user_data[message.chat.id]["pay_amount_raw"] = (message.text or "").strip()
-    user_step[message.chat.id] = "pay_date"
+    sessions.update(message.chat.id, "pay_date", {"pay_amount_raw": (message.text or "").strip()})
     bot.send_message(
         message.chat.id,
         "📅 Дата/время оплаты (например 17.08.2025 15:40):",
-        reply_markup=cancel_menu()
+        reply_markup=cancel_menu(), defer=True
     )
 
-@bot.message_handler(func=lambda m: user_step.get(m.chat.id) == "pay_date")
 def pay_date(message: types.Message):
     if (message.text or "") == "❌ Отмена":
         return cancel_flow(message)
-    user_data[message.chat.id]["pay_date"] = (message.text or "").strip()
-    user_step[message.chat.id] = "pay_method"
+    sessions.update(message.chat.id, "pay_method", {"pay_date": (message.text or "").strip()})
     bot.send_message(
         message.chat.id,
         "🏦 Способ: Т-Банк перевод / другой банк / наличные / иное:",
-        reply_markup=cancel_menu()
+        reply_markup=cancel_menu(), defer=True
     )
 
-@bot.message_handler(func=lambda m: user_step.get(m.chat.id) == "pay_method")
 def pay_method(message: types.Message):
     if (message.text or "") == "❌ Отмена":
         return cancel_flow(message)
-    user_data[message.chat.id]["pay_method"] = (message.text or "").strip()
-    user_step[message.chat.id] = "pay_attach"
+    sessions.update(message.chat.id, "pay_attach", {"pay_method": (message.text or "").strip()})
     bot.send_message(
         message.chat.id,
         "📎 Прикрепите чек/скрин перевода (можно несколько). Когда закончите — нажмите «Отправить ✅» или «Пропустить ⏭️».",
-        reply_markup=pay_finish_menu()
+        reply_markup=pay_finish_menu(), defer=True
     )
 
 # Приём файлов (фото/док) у вас общий — он уже кладёт во "pay_attachments", когда step начинается с "pay_".
 # Здесь завершаем оплату.
 
-@bot.message_handler(func=lambda m: user_step.get(m.chat.id) == "pay_attach")
 def pay_finish(message: types.Message):
     t = (message.text or "").strip()
 
@@ -723,54 +2903,64 @@ def pay_finish(message: types.Message):
         return bot.send_message(
             message.chat.id,
             "Пришлите файл(ы) или нажмите «Отправить ✅» / «Пропустить ⏭️».",
-            reply_markup=pay_finish_menu()
+            reply_markup=pay_finish_menu(), defer=True
         )
 
     return _complete_payment(message)
 
 # «Страховка»: если по какой-то причине шаг потерялся, но человек нажал «Отправить ✅»/«Пропустить ⏭️» —
 # попробуем всё равно завершить оплату.
-@bot.message_handler(func=lambda m: (m.text or "").strip() in ["Пропустить ⏭️", "Отправить ✅"])
 def pay_finish_fallback(message: types.Message):
-    step = user_step.get(message.chat.id)
+    step = sessions.get_step(message.chat.id)
     if step == "pay_attach":
         # основной обработчик выше отработает, сюда не попадём
         return
     # если шаг потерян, но в user_data есть следы оплаты — завершим
-    d = user_data.get(message.chat.id) or {}
+    d = sessions.get_data(message.chat.id)
     if any(k.startswith("pay_") for k in d.keys()):
         return _complete_payment(message)
     # иначе ничего не делаем — пусть сработает fallback ниже
 
 
+PAY_ROUTES = {"✅ Я оплатил(а)": pay_start}
+
+PAY_STEPS = {
+    "pay_amount": pay_amount,
+    "pay_date": pay_date,
+    "pay_method": pay_method,
+    "pay_attach": pay_finish,
+}
+
+PAY_BUTTONS = {"Пропустить ⏭️": pay_finish_fallback, "Отправить ✅": pay_finish_fallback}
+
+
 def _complete_payment(message: types.Message):
     cid = message.chat.id
-    d = user_data.get(cid, {})
+    ATTACHMENTS.flush(cid)
+    d = sessions.get_data(cid)
     username = f"@{message.from_user.username}" if message.from_user.username else "—"
 
     # Анти-дубли: если уже завершали оплату в этом диалоге
     if d.get("_pay_done"):
-        bot.send_message(cid, "Уведомление об оплате уже отправлено ✅", reply_markup=main_menu())
+        bot.send_message(cid, "Уведомление об оплате уже отправлено ✅", reply_markup=main_menu(), defer=True)
         return
 
     # Разбор суммы/валюты
     amt, cur = parse_amount_currency(d.get("pay_amount_raw", ""))
 
-    # Сохранение в БД
+    # Тот же чек уже приложен к другой оплате — подсветим админам
+    seen_in = []
     try:
-        curc = _exec("""
-            INSERT INTO payments (chat_id, amount, currency, pay_method, pay_date)
-            VALUES (?, ?, ?, ?, ?)
-        """, (cid, amt, cur, d.get("pay_method"), d.get("pay_date")))
-        payment_id = curc.lastrowid
-
-        for kind, fid in d.get("pay_attachments", []):
-            _exec(
-                "INSERT INTO payment_files (payment_id, kind, file_id) VALUES (?, ?, ?)",
-                (payment_id, kind, fid)
-            )
+        seen_in = earlier_payments_with_files(d.get("pay_attachments", []))
+    except Exception:
+        log.exception("receipt lookup error")
+
+    # Сохранение в БД (оплата и чеки — атомарно, см. save_payment)
+    payment_id = None
+    try:
+        payment_id = save_payment(cid, amt, cur, d.get("pay_method"), d.get("pay_date"), d.get("pay_attachments", []))
     except Exception as e:
-        bot.send_message(cid, f"⚠️ Не удалось сохранить оплату в БД: {e}")
+        bot.send_message(cid, f"⚠️ Не удалось сохранить оплату в БД: {e}", defer=True)
 
     # Сообщение в админ-группу
     body = (
@@ -780,26 +2970,17 @@ def _complete_payment(message: types.Message):
         f"Способ: {d.get('pay_method','—')}\n\n"
         f"От пользователя: {username} (id {message.from_user.id})"
     )
+    if seen_in:
+        body += "\n⚠️ Этот чек уже присылали к оплате " + ", ".join(f"#{pid}" for pid in seen_in)
 
-    if ADMIN_GROUP_ID_INT is not None:
-        try:
-            admin_id = ADMIN_GROUP_ID_INT
-            sent = bot.send_message(admin_id, body)
-            photos = [fid for kind, fid in d.get("pay_attachments", []) if kind == "photo"]
-            docs   = [fid for kind, fid in d.get("pay_attachments", []) if kind == "doc"]
-            if photos:
-                media = [types.InputMediaPhoto(fid) for fid in photos[:10]]
-                bot.send_media_group(admin_id, media, reply_to_message_id=sent.message_id)
-            for fid in docs:
-                bot.send_document(admin_id, fid, reply_to_message_id=sent.message_id)
-        except Exception as e:
-            bot.send_message(cid, f"Не удалось отправить уведомление в админ-группу: {e}")
+    admin_fanout.submit(body, d.get("pay_attachments", []), cid, "Не удалось отправить уведомление в админ-группу",
+                        ref={"chat_id": cid, "payment_id": payment_id})
 
-    d["_pay_done"] = True
+    sessions.update(cid, fields={"_pay_done": True})
     bot.send_message(
         cid,
         "Спасибо! Получили уведомление об оплате. Проверим и вернёмся с подтверждением 🙌",
-        reply_markup=main_menu()
+        reply_markup=main_menu(), defer=True
     )
     reset_flow(cid)
 
@@ -840,6 +3021,7 @@ def is_admin(message: types.Message) -> bool:
 
 def admin_only(func):
     """Декоратор для команд только для админа."""
+    @functools.wraps(func)
     def wrapper(message: types.Message):
         if not is_admin(message):
             return bot.reply_to(message, "Команда доступна только администратору.")
@@ -853,11 +3035,51 @@ def cmd_ping(message: types.Message):
     bot.reply_to(message, "pong")
 
 
+# /queues — глубина очереди входящих апдейтов и исходящих сообщений
+@bot.message_handler(commands=['queues'])
+@admin_only
+def cmd_queues(message: types.Message):
+    st = OUTBOX.stats()
+    depth = ", ".join(f"{k} {v}" for k, v in st["depth"].items())
+    calls = sorted(API_LATENCY.snapshot().items(), key=lambda kv: -kv[1]["calls"])[:8]
+    api = "\n".join(f"  {m}: {v['calls']} выз., ошибок {v['errors']}, среднее {v['avg_ms']} мс, p95 ≤ {v['p95_ms']} мс"
+                    for m, v in calls) or "  —"
+    bot.reply_to(
+        message,
+        f"Входящие: в очереди {UPDATES.depth()}, обработано {UPDATES.processed}, "
+        f"отклонено {UPDATES.rejected}, ошибок {UPDATES.failed}\n"
+        f"Повторы update_id: отброшено {UPDATES.dedupe.hits}, новых {UPDATES.dedupe.misses}, "
+        f"в окне {UPDATES.dedupe.size()}{' (+ БД)' if UPDATES.dedupe.database is not None else ''}\n"
+        + ("Async-режим: в работе {inflight} апдейт(ов), чатов {chats}, фоновых задач {tasks}\n".format(
+            **ASYNC_RUNTIME.stats()) if ASYNC_RUNTIME.accepting else "")
+        + f"Карточки в админ-группу: в очереди {admin_fanout.depth()}, отправлено {admin_fanout.sent}, "
+        f"ошибок {admin_fanout.failed}\n"
+        f"Исходящие: ждут {depth}\n"
+        f"Отправлено {st['sent']}, повторов после 429: {st['retries']}, ошибок {st['failed']}\n"
+        f"Ожидание: среднее {st['wait_avg_ms']} мс, макс {st['wait_max_ms']} мс; чатов в учёте {st['chats']}\n"
+        f"Bot API ({BOT_API_TRANSPORT}):\n{api}"
+    )
+
+
+# /profile [секунды] [sample|cprofile] — профилирование хэндлеров на время окна, отчёт придёт сюда же
+@bot.message_handler(commands=['profile'])
+@admin_only
+def cmd_profile(message: types.Message):
+    try:
+        seconds, mode = parse_profile_args(message.text.split()[1:])
+    except ValueError as e:
+        return bot.reply_to(message, f"Не поняла «{e}». Пример: /profile 30 или /profile 60 cprofile "
+                                     f"(до {PROFILE_MAX_SECONDS} с)")
+    if not PROFILER.start(seconds, mode, message.chat.id):
+        return bot.reply_to(message, "Профилирование уже идёт — дождитесь отчёта.")
+    bot.reply_to(message, f"Профилирую ({mode}) {seconds} с — отчёт пришлю сюда.")
+
+
 # Короткий просмотр внутреннего состояния FSM (аналог /whereami)
 @bot.message_handler(commands=['state'])
 def cmd_state(message: types.Message):
-    step = user_step.get(message.chat.id)
-    d = user_data.get(message.chat.id)
+    step = sessions.get_step(message.chat.id)
+    d = sessions.get_data(message.chat.id)
     bot.reply_to(
         message,
         f"Текущий шаг: {step or '—'}\nКлючи user_data: {list(d.keys()) if d else '—'}"
@@ -882,106 +3104,609 @@ def cmd_iamadmin(message: types.Message):
 @admin_only
 def cmd_migrate(message: types.Message):
     try:
-        add_missing_columns()
+        with db.transaction():
+            add_missing_columns()
         bot.reply_to(message, "Миграция: ок ✅")
     except Exception as e:
         bot.reply_to(message, f"Миграция: ошибка: {e}")
 
 
-# /stats — статистика
+# /stats [дней] — статистика по daily_rollup: /stats, /stats 30, /stats 90, /stats 365
+STATS_SQL = """
+    SELECT metric, dim,
+           SUM(CASE WHEN day >= :today THEN cnt ELSE 0 END) AS today,
+           SUM(cnt) AS total, SUM(sum_minor) AS sum_minor
+    FROM daily_rollup WHERE day >= :since
+    GROUP BY metric, dim
+"""
+
 @bot.message_handler(commands=['stats'])
 @admin_only
 def cmd_stats(message: types.Message):
+    parts = message.text.split(maxsplit=1)
+    days = 7
+    if len(parts) == 2 and parts[1].strip():
+        if not parts[1].strip().isdigit() or not 1 <= int(parts[1]) <= 3650:
+            return bot.reply_to(message, "Пример: /stats 30 — за последние 30 дней (1–3650).")
+        days = int(parts[1])
     today = datetime.utcnow().date()
-    start_today = f"{today} 00:00:00"
-    start_week  = f"{(today - timedelta(days=6))} 00:00:00"
 
-    c1 = _exec("SELECT COUNT(*) as c FROM requests WHERE datetime(created_at) >= datetime(?)", (start_today,)).fetchone()["c"]
-    c2 = _exec("SELECT COUNT(*) as c FROM requests WHERE datetime(created_at) >= datetime(?)", (start_week,)).fetchone()["c"]
+    # Несколько строк агрегатов на день — стоимость не зависит от размера requests/payments
+    c1 = c2 = p1 = p2 = 0
+    by_type, sums = {}, {}
+    for r in db.query(STATS_SQL, {"today": str(today), "since": str(today - timedelta(days=days - 1))}):
+        if r["metric"] == "requests":
+            c1 += r["today"]
+            c2 += r["total"]
+            if r["dim"]:
+                by_type[r["dim"]] = r["total"]
+        else:
+            p1 += r["today"]
+            p2 += r["total"]
+            sums[r["dim"]] = r["sum_minor"] / 100
+    types_str = f" ({', '.join(f'{k} {v}' for k, v in sorted(by_type.items()))})" if by_type else ""
+    sums_str = ", ".join([f"{round(v,2)} {k}" for k, v in sorted(sums.items())]) if sums else "—"
+
+    bot.reply_to(message,
+        "<b>Статистика</b>\n\n"
+        f"Заявок: сегодня {c1} / за {days} дн. {c2}{types_str}\n"
+        f"Оплат: сегодня {p1} / за {days} дн. {p2}\n"
+        f"Сумма ({days}д): {sums_str}"
+    )
 
-    p1 = _exec("SELECT COUNT(*) as c FROM payments WHERE datetime(created_at) >= datetime(?)", (start_today,)).fetchone()["c"]
-    p2 = _exec("SELECT COUNT(*) as c FROM payments WHERE datetime(created_at) >= datetime(?)", (start_week,)).fetchone()["c"]
 
-    rows = _exec("SELECT amount, currency FROM payments WHERE datetime(created_at) >= datetime(?)", (start_week,)).fetchall()
-    sums = {}
-    for r in rows:
-        cur = (r["currency"] or "").upper() or "RUB"
-        sums.setdefault(cur, 0.0)
+# /rebuild_rollup — пересчитать daily_rollup по всей истории
+@bot.message_handler(commands=['rebuild_rollup'])
+@admin_only
+def cmd_rebuild_rollup(message: types.Message):
+    try:
+        t0 = time.monotonic()
+        rebuild_daily_rollup()
+        n = db.query_one("SELECT COUNT(*) AS c FROM daily_rollup")["c"]
+        bot.reply_to(message, f"daily_rollup пересчитана: {n} строк за {time.monotonic() - t0:.1f} с ✅")
+    except Exception as e:
+        bot.reply_to(message, f"Пересчёт daily_rollup: ошибка: {e}")
+
+
+# /export_csv [csv|jsonl] [since:<id|дата|last>] [from:<дата>] [to:<дата>] [type:Отель|Билеты]
+# Выгрузка таблиц одним zip-архивом.
+# Строки читаются курсором порциями по EXPORT_CHUNK_ROWS (таблица целиком в память не попадает),
+# архив собирается во временном буфере (в памяти до EXPORT_SPOOL_MAX байт, дальше — во временном
+# файле), а не в рабочей папке. Вся работа идёт в отдельном потоке, админу показываем прогресс.
+# Инкрементальная выгрузка: since:last — только строки с id больше, чем в прошлой выгрузке этого
+# админа (отметки в export_marks); since:<id> — id > N в каждой таблице; since:<дата> = from:<дата>.
+# since:last совмещается только с форматом: с from:/to:/type: строки вне фильтра оказались бы ниже
+# отметки и в следующую since:last уже не попали бы.
+# Все фильтры — диапазоны по первичному ключу или индексам created_at / (type, created_at); у
+# payment_files даты нет, её диапазон ищется по payments, а файлы — по индексу payment_files(payment_id).
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "1000"))
+EXPORT_SPOOL_MAX  = int(os.getenv("EXPORT_SPOOL_MAX", str(8 * 1024 * 1024)))
+EXPORT_FORMATS    = ("csv", "jsonl")
+EXPORT_USAGE = ("Формат: /export_csv [csv|jsonl] [since:<id|ДД.ММ.ГГГГ|last>] "
+                "[from:<дата>] [to:<дата>] [type:Отель|Билеты]")
+
+# (таблица, SELECT без WHERE/ORDER, колонка id, колонка created_at, колонка type,
+#  куда подставить условия по created_at, если дата — в другой таблице)
+EXPORT_QUERIES = (
+    ("requests", """
+        SELECT id, chat_id, type, route, dates, guests, rooms, stars, breakfast, location_pref, budget,
+               class, baggage, carriers, fullname, dob, gender, citizenship, passport_no, passport_exp, contact, created_at
+        FROM requests
+    """, "id", "created_at", "type", None),
+    ("payments", """
+        SELECT id, chat_id, amount, currency, pay_method, pay_date, created_at
+        FROM payments
+    """, "id", "created_at", None, None),
+    ("payment_files", """
+        SELECT pf.id, pf.payment_id, p.chat_id, pf.kind, pf.file_id, p.created_at
+        FROM payment_files pf
+        LEFT JOIN payments p ON p.id = pf.payment_id
+    """, "pf.id", "created_at", None, "pf.payment_id IN (SELECT id FROM payments WHERE {})"),
+)
+
+_export_lock = threading.Lock()   # один экспорт за раз
+
+
+def _parse_export_date(value: str):
+    for fmt in ("%Y-%m-%d", "%d.%m.%Y"):
         try:
-            sums[cur] += float((r["amount"] or "0").replace(",", "."))
-        except:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
             pass
-    sums_str = ", ".join([f"{round(v,2)} {k}" for k, v in sums.items()]) if sums else "—"
+    return None
 
-    bot.reply_to(message,
-        "<b>Статистика</b>\n\n"
-        f"Заявок: сегодня {c1} / за 7 дней {c2}\n"
-        f"Оплат: сегодня {p1} / за 7 дней {p2}\n"
-        f"Сумма (7д): {sums_str}"
-    )
+
+def _parse_filter(spec: dict, key: str, value: str) -> bool:
+    """from:/to:/type: — общие фильтры /export_csv и /broadcast. True, если токен разобран."""
+    if key in ("from", "to") and _parse_export_date(value):
+        spec["date_to" if key == "to" else "date_from"] = _parse_export_date(value)
+    elif key == "type" and value.lower() in ("отель", "hotel"):
+        spec["type"] = "Отель"
+    elif key == "type" and value.lower() in ("билеты", "flight", "tickets"):
+        spec["type"] = "Билеты"
+    else:
+        return False
+    return True
+
+
+def parse_export_args(tokens):
+    """Разбор аргументов /export_csv -> dict с параметрами выгрузки (или ValueError)."""
+    spec = {"fmt": "csv", "since_id": None, "since_last": False, "date_from": None, "date_to": None, "type": None}
+    for tok in tokens:
+        key, _, value = tok.partition(":")
+        key = key.lower()
+        if not value and key in EXPORT_FORMATS:
+            spec["fmt"] = key
+        elif key == "since" and value.lower() == "last":
+            spec["since_last"] = True
+        elif key == "since" and value.isdigit():
+            spec["since_id"] = int(value)
+        elif not _parse_filter(spec, "from" if key == "since" else key, value):
+            raise ValueError(tok)
+    return spec
+
+
+def get_export_marks(admin_id) -> dict:
+    rows = db.query("SELECT tbl, last_id FROM export_marks WHERE admin_id=?", (admin_id,))
+    return {r["tbl"]: r["last_id"] for r in rows}
+
+
+def save_export_marks(admin_id, max_ids: dict):
+    with db.transaction():
+        db.executemany("""
+            INSERT INTO export_marks (admin_id, tbl, last_id, updated_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(admin_id, tbl) DO UPDATE SET
+                last_id=MAX(last_id, excluded.last_id), updated_at=excluded.updated_at
+        """, [(admin_id, tbl, last_id) for tbl, last_id in max_ids.items() if last_id])
+
+
+def export_queries(spec: dict, marks: dict = None):
+    """SQL + параметры для каждой таблицы с учётом фильтров."""
+    queries = []
+    incremental = spec["since_last"] or spec["since_id"] is not None or spec["date_from"] or spec["date_to"]
+    for name, select, id_col, created_col, type_col, date_scope in EXPORT_QUERIES:
+        if spec["type"] and type_col is None:
+            continue   # фильтр по типу заявки — только для requests
+        where, params = [], []
+        since_id = (marks or {}).get(name, 0) if spec["since_last"] else spec["since_id"]
+        if since_id is not None:
+            where.append(f"{id_col} > ?")
+            params.append(since_id)
+        if spec["type"]:
+            where.append(f"{type_col} = ?")
+            params.append(spec["type"])
+        dates = []
+        if spec["date_from"]:
+            dates.append(f"{created_col} >= ?")
+            params.append(f"{spec['date_from']} 00:00:00")
+        if spec["date_to"]:
+            dates.append(f"{created_col} < ?")
+            params.append(f"{spec['date_to'] + timedelta(days=1)} 00:00:00")
+        if dates:
+            where.append(date_scope.format(" AND ".join(dates)) if date_scope else " AND ".join(dates))
+        sql = select + (" WHERE " + " AND ".join(where) if where else "") + \
+            f" ORDER BY {id_col} {'ASC' if incremental else 'DESC'}"
+        queries.append((name, sql, params))
+    return queries
+
+
+def build_export(fmt: str, queries, progress=None):
+    """
+    Собрать zip с таблицами в SpooledTemporaryFile. progress(table, rows) — после каждой порции.
+    Возвращает (буфер, {таблица: строк}, {таблица: максимальный id}).
+    """
+    buf = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX)
+    counts, max_ids = {}, {}
+    with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for name, sql, params in queries:
+            cur = db.connection().execute(sql, params)
+            cols = [c[0] for c in cur.description]
+            n, max_id = 0, 0
+            with zf.open(f"{name}.{fmt}", "w") as raw:
+                out = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+                w = csv.writer(out, delimiter=";")
+                if fmt == "csv":
+                    w.writerow(cols)
+                while True:
+                    rows = cur.fetchmany(EXPORT_CHUNK_ROWS)
+                    if not rows:
+                        break
+                    if fmt == "csv":
+                        w.writerows(rows)
+                    else:
+                        out.writelines(json.dumps(dict(zip(cols, r)), ensure_ascii=False) + "\n" for r in rows)
+                    n += len(rows)
+                    max_id = max(max_id, rows[0][0], rows[-1][0])
+                    if progress:
+                        progress(name, n)
+                out.flush()
+                out.detach()
+            counts[name], max_ids[name] = n, max_id
+    buf.seek(0)
+    return buf, counts, max_ids
+
+
+def _run_export(chat_id, admin_id, spec: dict):
+    last_edit = [0.0]
+
+    def progress(table, rows):
+        now = time.monotonic()
+        if now - last_edit[0] >= 2:   # не чаще раза в 2 секунды
+            last_edit[0] = now
+            try:
+                bot.edit_message_text(f"⏳ Экспорт: {table} — {rows} строк…", chat_id, status.message_id)
+            except Exception:
+                pass
+
+    try:
+        status = bot.send_message(chat_id, "⏳ Экспорт: начинаю…")
+        t0 = time.monotonic()
+        queries = export_queries(spec, get_export_marks(admin_id) if spec["since_last"] else None)
+        buf, counts, max_ids = build_export(spec["fmt"], queries, progress)
+        with buf:
+            stamp = datetime.utcnow().strftime("%Y%m%d_%H%M")
+            summary = ", ".join(f"{k}: {v}" for k, v in counts.items())
+            bot.send_document(chat_id, buf, visible_file_name=f"tripbuddy_export_{stamp}.zip",
+                              caption=f"Экспорт ({spec['fmt']}) — {summary}")
+        # Отметку двигаем только для выгрузок «всё подряд» (since:last с фильтрами cmd_export_csv не пускает)
+        if not (spec["since_id"] or spec["date_from"] or spec["date_to"] or spec["type"]):
+            save_export_marks(admin_id, max_ids)
+        bot.edit_message_text(f"✅ Экспорт готов за {time.monotonic() - t0:.1f} с", chat_id, status.message_id)
+    except Exception as e:
+        bot.send_message(chat_id, f"Ошибка экспорта: {e}")
+    finally:
+        _export_lock.release()
 
 
-# /export_csv — выгрузка таблиц
 @bot.message_handler(commands=['export_csv'])
 @admin_only
 def cmd_export_csv(message: types.Message):
     try:
-        # requests.csv
-        req_rows = _exec("""
-            SELECT id, chat_id, type, route, dates, guests, rooms, stars, breakfast, location_pref, budget,
-                   class, baggage, carriers, fullname, dob, gender, citizenship, passport_no, passport_exp, contact, created_at
-            FROM requests ORDER BY id DESC
-        """).fetchall()
-        with open("requests.csv", "w", newline="", encoding="utf-8") as f:
-            w = csv.writer(f, delimiter=";")
-            w.writerow([c for c in req_rows[0].keys()] if req_rows else
-                       ["id","chat_id","type","route","dates","guests","rooms","stars","breakfast","location_pref","budget",
-                        "class","baggage","carriers","fullname","dob","gender","citizenship","passport_no","passport_exp","contact","created_at"])
-            for r in req_rows:
-                w.writerow([r[k] for k in r.keys()])
-        with open("requests.csv", "rb") as f:
-            bot.send_document(message.chat.id, f, visible_file_name="requests.csv")
-
-        # payments.csv
-        pay_rows = _exec("""
-            SELECT id, chat_id, amount, currency, pay_method, pay_date, created_at
-            FROM payments ORDER BY id DESC
-        """).fetchall()
-        with open("payments.csv", "w", newline="", encoding="utf-8") as f:
-            w = csv.writer(f, delimiter=";")
-            w.writerow([c for c in pay_rows[0].keys()] if pay_rows else
-                       ["id","chat_id","amount","currency","pay_method","pay_date","created_at"])
-            for r in pay_rows:
-                w.writerow([r[k] for k in r.keys()])
-        with open("payments.csv", "rb") as f:
-            bot.send_document(message.chat.id, f, visible_file_name="payments.csv")
-
-        # payment_files.csv
-        pfiles = _exec("""
-            SELECT pf.id, pf.payment_id, p.chat_id, pf.kind, pf.file_id, p.created_at
-            FROM payment_files pf
-            LEFT JOIN payments p ON p.id = pf.payment_id
-            ORDER BY pf.id DESC
-        """).fetchall()
-        with open("payment_files.csv", "w", newline="", encoding="utf-8") as f:
-            w = csv.writer(f, delimiter=";")
-            w.writerow([c for c in pfiles[0].keys()] if pfiles else
-                       ["id","payment_id","chat_id","kind","file_id","created_at"])
-            for r in pfiles:
-                w.writerow([r[k] for k in r.keys()])
-        with open("payment_files.csv", "rb") as f:
-            bot.send_document(message.chat.id, f, visible_file_name="payment_files.csv")
-
+        spec = parse_export_args(message.text.split()[1:])
+    except ValueError as e:
+        return bot.reply_to(message, f"Не поняла аргумент «{e}».\n{EXPORT_USAGE}")
+    if spec["since_last"] and (spec["type"] or spec["date_from"] or spec["date_to"] or spec["since_id"] is not None):
+        return bot.reply_to(message, "since:last нельзя совмещать с type:/from:/to: — отметка общая, "
+                                     "отфильтрованные строки оказались бы ниже неё и больше не выгрузились бы.")
+    if not _export_lock.acquire(blocking=False):
+        return bot.reply_to(message, "Экспорт уже выполняется, дождитесь файла.")
+    Thread(target=_run_export, args=(message.chat.id, message.from_user.id, spec),
+           name="export", daemon=True).start()
+
+
+# /broadcast [type:Отель|Билеты] [from:<дата>] [to:<дата>] + текст со следующей строки
+# (или ответом на сообщение — тогда рассылается его копия, с фото/файлом).
+# Получатели — все chat_id из requests и payments (с фильтром — только из подходящих заявок).
+# Рассылка создаётся черновиком; /broadcast_start <id> — запуск (и продолжение после остановки),
+# /broadcast_stop <id> — пауза, /broadcast_status [id] — прогресс. Статус каждого получателя пишется в broadcast_recipients
+# сразу после отправки, поэтому после перезапуска рассылка продолжается с того же места.
+# Отправка — через OUTBOX с приоритетом PRIO_BULK и своим потолком BROADCAST_RATE сообщений/с.
+BROADCAST_RATE         = float(os.getenv("BROADCAST_RATE", "20"))
+BROADCAST_BATCH        = int(os.getenv("BROADCAST_BATCH", "200"))          # сколько получателей читаем за раз
+BROADCAST_REPORT_EVERY = float(os.getenv("BROADCAST_REPORT_EVERY", "60"))  # секунд между отчётами
+# Несколько процессов (gunicorn -w N): рассылку ведёт тот, кто взял аренду (broadcasts.owner/lease_until).
+# Аренда продлевается с каждой отправкой; если процесс умер, через BROADCAST_LEASE секунд рассылку
+# подхватывает фоновый resume_broadcasts() любого живого процесса. Рассылка, упавшая с ошибкой,
+# встаёт на паузу — её продолжают вручную (/broadcast_start).
+BROADCAST_LEASE        = float(os.getenv("BROADCAST_LEASE", "120"))
+BROADCAST_USAGE = ("Формат: /broadcast [type:Отель|Билеты] [from:<дата>] [to:<дата>]\n<текст со следующей строки>\n"
+                   "или ответом на сообщение, которое нужно разослать.")
+
+_broadcast_threads = {}
+_broadcast_lock = threading.Lock()
+
+
+def parse_broadcast_args(tokens):
+    spec = {"type": None, "date_from": None, "date_to": None}
+    for tok in tokens:
+        key, _, value = tok.partition(":")
+        if not _parse_filter(spec, key.lower(), value):
+            raise ValueError(tok)
+    return spec
+
+
+def broadcast_audience_sql(filters: dict):
+    """SELECT DISTINCT chat_id получателей (диапазонные условия — по индексам created_at / (type, created_at))."""
+    parts, params = [], []
+    for table in ("requests", "payments"):
+        if filters.get("type") and table != "requests":
+            continue
+        where = ["chat_id IS NOT NULL"]
+        if filters.get("type"):
+            where.append("type = ?")
+            params.append(filters["type"])
+        if filters.get("date_from"):
+            where.append("created_at >= ?")
+            params.append(f"{filters['date_from']} 00:00:00")
+        if filters.get("date_to"):
+            where.append("created_at < ?")
+            params.append(f"{filters['date_to'] + timedelta(days=1)} 00:00:00")
+        parts.append(f"SELECT chat_id FROM {table} WHERE " + " AND ".join(where))
+    return " UNION ".join(parts), params
+
+
+def create_broadcast(created_by, report_chat_id, text, source, filters: dict):
+    """Черновик рассылки + список получателей одной транзакцией. Возвращает (id, число получателей)."""
+    audience, params = broadcast_audience_sql(filters)
+    with db.transaction():
+        cur = db.execute("""
+            INSERT INTO broadcasts (created_by, report_chat_id, text, source_chat_id, source_message_id, filters)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (created_by, report_chat_id, text, source[0] if source else None, source[1] if source else None,
+              json.dumps(filters, ensure_ascii=False, default=str)))
+        bid = cur.lastrowid
+        n = db.execute(f"""
+            INSERT INTO broadcast_recipients (broadcast_id, chat_id)
+            SELECT DISTINCT ?, chat_id FROM ({audience})
+        """, (bid, *params)).rowcount
+    return bid, n
+
+
+def broadcast_counts(bid) -> dict:
+    rows = db.query("SELECT status, COUNT(*) AS n FROM broadcast_recipients WHERE broadcast_id=? GROUP BY status", (bid,))
+    counts = {"pending": 0, "sent": 0, "blocked": 0, "failed": 0}
+    counts.update({r["status"]: r["n"] for r in rows})
+    return counts
+
+
+def _broadcast_report(bid, title, counts, elapsed=None, sent_now=0):
+    rate = f", {sent_now / elapsed:.1f} сообщ./с" if elapsed and sent_now else ""
+    total = sum(counts.values())
+    return (f"{title} #{bid}: отправлено {counts['sent']} из {total}{rate}\n"
+            f"Заблокировали бота: {counts['blocked']}, ошибок: {counts['failed']}, осталось: {counts['pending']}")
+
+
+def _process_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"   # pid читаем каждый раз — после fork он другой
+
+
+def _broadcast_running(bid) -> bool:
+    row = db.query_one("SELECT status, owner FROM broadcasts WHERE id=?", (bid,))
+    return row is not None and row["status"] == "running" and row["owner"] == _process_id()
+
+
+def _run_broadcast(bid):
+    b = db.query_one("SELECT * FROM broadcasts WHERE id=?", (bid,))
+    report_to = ADMIN_GROUP_ID_INT if ADMIN_GROUP_ID_INT is not None else b["report_chat_id"]
+    bucket = TokenBucket(BROADCAST_RATE, 1)
+    t0 = last_report = time.monotonic()
+    sent_now, last_chat = 0, -(1 << 63)
+    try:
+        while _broadcast_running(bid):
+            # keyset по первичному ключу: читаем следующую порцию ещё не отправленных
+            batch = db.query("""
+                SELECT chat_id FROM broadcast_recipients
+                WHERE broadcast_id=? AND status='pending' AND chat_id > ?
+                ORDER BY chat_id LIMIT ?
+            """, (bid, last_chat, BROADCAST_BATCH))
+            if not batch:
+                break
+            for row in batch:
+                if not _broadcast_running(bid):   # /broadcast_stop — останавливаемся сразу, а не после порции
+                    break
+                chat_id = last_chat = row["chat_id"]
+                while True:   # свой потолок скорости, чтобы рассылка не съедала весь общий лимит
+                    wait = bucket.delay(1, time.monotonic())
+                    if wait <= 0:
+                        break
+                    time.sleep(wait)
+                bucket.take(1)
+                result, error = "sent", None
+                try:
+                    with OUTBOX.priority(PRIO_BULK):
+                        if b["source_message_id"]:
+                            bot.copy_message(chat_id, b["source_chat_id"], b["source_message_id"])
+                        else:
+                            bot.send_message(chat_id, b["text"])
+                    sent_now += 1
+                except telebot.apihelper.ApiTelegramException as e:
+                    result, error = ("blocked" if e.error_code == 403 else "failed"), e.description
+                except Exception as e:
+                    result, error = "failed", str(e)
+                with db.transaction():   # статус получателя и продление аренды — одним коммитом
+                    db.execute("""
+                        UPDATE broadcast_recipients SET status=?, error=?, sent_at=CURRENT_TIMESTAMP
+                        WHERE broadcast_id=? AND chat_id=?
+                    """, (result, error, bid, chat_id))
+                    db.execute("UPDATE broadcasts SET lease_until=? WHERE id=? AND owner=?",
+                               (time.time() + BROADCAST_LEASE, bid, _process_id()))
+                if time.monotonic() - last_report >= BROADCAST_REPORT_EVERY:
+                    last_report = time.monotonic()
+                    bot.send_message(report_to, _broadcast_report(bid, "⏳ Рассылка", broadcast_counts(bid),
+                                                                  last_report - t0, sent_now))
+        counts = broadcast_counts(bid)
+        if not counts["pending"]:
+            db.execute("UPDATE broadcasts SET status='done', finished_at=CURRENT_TIMESTAMP WHERE id=?", (bid,))
+            title = "✅ Рассылка завершена"
+        else:
+            title = "⏸ Рассылка на паузе"
+        text = _broadcast_report(bid, title, counts, time.monotonic() - t0, sent_now)
+        if counts["pending"]:
+            text += f"\nПродолжить: /broadcast_start {bid}"
+        bot.send_message(report_to, text)
     except Exception as e:
-        bot.reply_to(message, f"Ошибка экспорта: {e}")
+        log.exception("broadcast #%s error", bid)
+        try:
+            # на паузу: resume_broadcasts подхватывает только running, иначе перезапускал бы её
+            # (и слал это сообщение) каждые BROADCAST_LEASE/2 секунд
+            db.execute("UPDATE broadcasts SET status='paused' WHERE id=? AND status='running' AND owner=?",
+                       (bid, _process_id()))
+            bot.send_message(report_to, f"Рассылка #{bid} прервана: {e}. Продолжить: /broadcast_start {bid}")
+        except Exception:
+            pass
+    finally:
+        db.execute("UPDATE broadcasts SET owner=NULL, lease_until=NULL WHERE id=? AND owner=?", (bid, _process_id()))
+        with _broadcast_lock:
+            _broadcast_threads.pop(bid, None)
+
+
+def start_broadcast(bid) -> bool:
+    """Запустить (или продолжить) рассылку в фоне. False — если она уже идёт в этом или другом процессе."""
+    me, now = _process_id(), time.time()
+    with _broadcast_lock:
+        if bid in _broadcast_threads:
+            return False
+        cur = db.execute("""
+            UPDATE broadcasts SET status='running', started_at=COALESCE(started_at, CURRENT_TIMESTAMP),
+                                  owner=?, lease_until=?
+            WHERE id=? AND (owner IS NULL OR owner=? OR lease_until < ?)
+        """, (me, now + BROADCAST_LEASE, bid, me, now))
+        if not cur.rowcount:
+            return False
+        t = Thread(target=_run_broadcast, args=(bid,), name=f"broadcast-{bid}", daemon=True)
+        _broadcast_threads[bid] = t
+        t.start()
+    return True
+
+
+def resume_broadcasts():
+    """Продолжить рассылки в статусе running, которые никто не ведёт (перезапуск, упавший процесс)."""
+    rows = db.query("SELECT id FROM broadcasts WHERE status='running' AND (owner IS NULL OR lease_until < ?) "
+                    "ORDER BY id", (time.time(),))
+    for row in rows:
+        start_broadcast(row["id"])
+
+
+def _resume_broadcasts_loop():
+    while True:
+        try:
+            resume_broadcasts()
+        except Exception:
+            log.exception("resume_broadcasts error")
+        time.sleep(BROADCAST_LEASE / 2)
+
+
+@bot.message_handler(commands=['broadcast'])
+@admin_only
+def cmd_broadcast(message: types.Message):
+    first, _, text = (message.text or "").partition("\n")
+    try:
+        filters = parse_broadcast_args(first.split()[1:])
+    except ValueError as e:
+        return bot.reply_to(message, f"Не поняла аргументы «{e}».\n{BROADCAST_USAGE}")
+    rm = message.reply_to_message
+    source = (rm.chat.id, rm.message_id) if rm else None
+    if not source and not text.strip():
+        return bot.reply_to(message, BROADCAST_USAGE)
+    bid, n = create_broadcast(message.from_user.id, message.chat.id, text.strip() or None, source, filters)
+    what = "копия сообщения, на которое вы ответили" if source else f"текст:\n{text.strip()}"
+    bot.reply_to(message, f"Черновик рассылки #{bid}: получателей {n}, {what}\n\n"
+                          f"Запустить: /broadcast_start {bid}")
+
+
+@bot.message_handler(commands=['broadcast_start', 'broadcast_stop', 'broadcast_status'])
+@admin_only
+def cmd_broadcast_control(message: types.Message):
+    cmd = message.text.split()[0].split("@")[0].lstrip("/")
+    parts = message.text.split()
+    if len(parts) > 1 and parts[1].isdigit():
+        b = db.query_one("SELECT id, status FROM broadcasts WHERE id=?", (int(parts[1]),))
+    elif cmd == "broadcast_status":
+        b = db.query_one("SELECT id, status FROM broadcasts ORDER BY id DESC LIMIT 1")
+    else:
+        return bot.reply_to(message, f"Укажите номер рассылки: /{cmd} <id>")
+    if not b:
+        return bot.reply_to(message, "Рассылка не найдена.")
+    bid = b["id"]
+    if cmd == "broadcast_start":
+        if b["status"] == "done":
+            return bot.reply_to(message, f"Рассылка #{bid} уже завершена.")
+        if not start_broadcast(bid):
+            return bot.reply_to(message, f"Рассылка #{bid} уже идёт.")
+        return bot.reply_to(message, f"Рассылка #{bid} запущена. Прогресс: /broadcast_status {bid}")
+    if cmd == "broadcast_stop":
+        db.execute("UPDATE broadcasts SET status='paused' WHERE id=? AND status='running'", (bid,))
+        return bot.reply_to(message, f"Рассылка #{bid} на паузе. Продолжить: /broadcast_start {bid}")
+    bot.reply_to(message, f"Статус: {b['status']}\n" + _broadcast_report(bid, "Рассылка", broadcast_counts(bid)))
+
+
+# /search <текст> — поиск заявок по городу/маршруту, датам, ФИО, контакту, гражданству, номеру паспорта.
+# Слова ищутся по префиксу (праг → Прага, Prague не найдёт), все слова должны встретиться.
+# Результаты по релевантности (bm25), страницы — keyset по (rank, id); текст запроса берём из
+# команды, на которую отвечает сообщение с результатами, так что в callback_data только курсор.
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "10"))
+
+SEARCH_SQL = """
+    SELECT r.id, r.chat_id, r.type, r.route, r.dates, r.fullname, r.contact, r.created_at, f.rank
+    FROM requests_fts f JOIN requests r ON r.id = f.rowid
+    WHERE requests_fts MATCH :q AND (f.rank > :rank OR (f.rank = :rank AND f.rowid > :id))
+    ORDER BY f.rank, f.rowid
+    LIMIT :limit
+"""
+
+
+def fts_query(text: str) -> str:
+    """Пользовательский текст -> запрос FTS5: каждое слово в кавычках и с префиксом, через AND."""
+    words = re.findall(r"\w+", text or "")
+    return " ".join(f'"{w}"*' for w in words[:10])
+
+
+def search_page(text: str, after=(float("-inf"), 0)):
+    """Страница результатов после курсора (rank, id). Возвращает (строки, курсор следующей страницы или None)."""
+    q = fts_query(text)
+    if not q:
+        return [], None
+    rows = db.query(SEARCH_SQL, {"q": q, "rank": after[0], "id": after[1], "limit": SEARCH_PAGE_SIZE + 1})
+    more = len(rows) > SEARCH_PAGE_SIZE
+    rows = rows[:SEARCH_PAGE_SIZE]
+    return rows, ((rows[-1]["rank"], rows[-1]["id"]) if more else None)
+
+
+def _search_text(text: str, rows, page: int) -> str:
+    if not rows:
+        return "Ничего не нашла." if page == 1 else "Больше результатов нет."
+    lines = [f"<b>Поиск: {html.escape(text)}</b> — стр. {page}"]
+    for r in rows:
+        fields = [r["type"], r["route"], r["dates"], r["fullname"], r["contact"]]
+        lines.append(f"#{r['id']} · {(r['created_at'] or '')[:10]} · chat_id {r['chat_id']}\n  "
+                     + " · ".join(html.escape(str(v)) for v in fields if v))
+    return "\n".join(lines)
+
+
+def _search_markup(cursor, page: int):
+    if cursor is None:
+        return None
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("Дальше ▶️", callback_data=f"srch:{page + 1}:{cursor[0]!r}:{cursor[1]}"))
+    return kb
+
+
+@bot.message_handler(commands=['search'])
+@admin_only
+def cmd_search(message: types.Message):
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2 or not fts_query(parts[1]):
+        return bot.reply_to(message, "Пример: /search прага отель или /search ivanov, /search 7512")
+    if not HAS_FTS:
+        return bot.reply_to(message, "Поиск недоступен: SQLite собран без FTS5.")
+    rows, cursor = search_page(parts[1])
+    bot.reply_to(message, _search_text(parts[1], rows, 1), reply_markup=_search_markup(cursor, 1))
+
+
+@bot.callback_query_handler(func=lambda c: (c.data or "").startswith("srch:"))
+def cb_search_next(call: types.CallbackQuery):
+    msg = call.message
+    if not is_admin(SimpleNamespace(chat=msg.chat, from_user=call.from_user)):
+        return bot.answer_callback_query(call.id, "Только для администратора.")
+    src = msg.reply_to_message
+    parts = (src.text or "").split(maxsplit=1) if src else []
+    if len(parts) < 2:
+        return bot.answer_callback_query(call.id, "Не нашла исходный запрос — повторите /search.")
+    _, page, rank, last_id = call.data.split(":")
+    rows, cursor = search_page(parts[1], (float(rank), int(last_id)))
+    bot.edit_message_text(_search_text(parts[1], rows, int(page)), msg.chat.id, msg.message_id,
+                          reply_markup=_search_markup(cursor, int(page)))
+    bot.answer_callback_query(call.id)
 
 
 # /find <chat_id> — показать последнюю заявку по chat_id
+# (ответом на карточку заявки — именно эту заявку)
 @bot.message_handler(commands=['find'])
 @admin_only
 def cmd_find(message: types.Message):
     parts = message.text.split(maxsplit=1)
     chat_id = None
+    card = None
     if len(parts) == 2 and parts[1].strip():
         arg = parts[1].strip()
         if arg.lstrip("-").isdigit():
@@ -989,19 +3714,24 @@ def cmd_find(message: types.Message):
                 chat_id = int(arg)
             except:
                 pass
-    if chat_id is None and message.reply_to_message:
-        m = re.search(r"id (\-?\d+)\)", message.reply_to_message.text or "")
-        if m:
-            chat_id = int(m.group(1))
+    if chat_id is None:
+        card = resolve_admin_reply(message)
+        if card:
+            chat_id = card["chat_id"]
     if chat_id is None:
         return bot.reply_to(message, "Укажите chat_id числом или ответьте командой на карточку заявки.")
 
-    row = _exec("SELECT * FROM requests WHERE chat_id=? ORDER BY id DESC LIMIT 1", (chat_id,)).fetchone()
+    if card and card["request_id"]:
+        row = db.query_one("SELECT * FROM requests WHERE id=?", (card["request_id"],))
+        title = f"Заявка #{card['request_id']}"
+    else:
+        row = db.query_one("SELECT * FROM requests WHERE chat_id=? ORDER BY id DESC LIMIT 1", (chat_id,))
+        title = "Последняя заявка"
     if not row:
         return bot.reply_to(message, "Заявок не найдено.")
 
     text = (
-        "<b>Последняя заявка</b>\n"
+        f"<b>{title}</b>\n"
         f"chat_id: {row['chat_id']}\n"
         f"Тип: {row['type']}\n"
         f"Маршрут/Город: {row['route']}\n"
@@ -1014,7 +3744,11 @@ def cmd_find(message: types.Message):
 
 # /invoice — гибкий парсер:
 # 1) /invoice <chat_id> <base> [currency] [fee] [note...]
-# 2) (reply на карточку заявки) /invoice <base> [currency] [fee] [note...]
+# 2) (reply на карточку заявки) /invoice <base> [currency] [note...]
+# В ответе на карточку два и больше чисел — это форма 1 с явным chat_id (fee без chat_id
+# неотличим от «chat_id base»); если первое из них не похоже на chat_id — переспрашиваем.
+INVOICE_USAGE = ("Использование: /invoice <chat_id> <base> [currency] [fee] [note...] "
+                 "или ответом на карточку: /invoice <base> [currency] [note]")
 @bot.message_handler(commands=['invoice'])
 @admin_only
 def cmd_invoice(message: types.Message):
@@ -1036,7 +3770,7 @@ def cmd_invoice(message: types.Message):
 
     tokens = message.text.split()[1:]  # без самого "/invoice"
     if not tokens:
-        return bot.reply_to(message, "Использование: /invoice <chat_id> <base> [currency] [fee] [note...] или ответом на карточку: /invoice <base> [currency] [fee] [note]")
+        return bot.reply_to(message, INVOICE_USAGE)
 
     chat_id = None
     base_tok = None
@@ -1044,11 +3778,17 @@ def cmd_invoice(message: types.Message):
     fee_tok = None
     note_parts = []
 
+    # Ответ на карточку: клиент — из карточки, а первое (единственное) число — уже сумма
+    card = resolve_admin_reply(message)
+    explicit = card is None or sum(map(_is_number_token, tokens)) >= 2
+
     # 1) Если первый токен — chat_id (число, в т.ч. отрицательное для супергрупп)
     i = 0
-    if tokens and re.fullmatch(r"-?\d+", tokens[0]):
+    if explicit and tokens and re.fullmatch(r"-?\d+", tokens[0]):
         chat_id = int(tokens[0])
         i = 1  # дальше парсим сумму/валюту/fee/ноту
+    elif card is not None and explicit:
+        return bot.reply_to(message, INVOICE_USAGE)
     # иначе работаем в режиме reply — chat_id возьмём из карточки ниже
 
     # 2) Проходим оставшиеся токены в порядке появления:
@@ -1067,14 +3807,13 @@ def cmd_invoice(message: types.Message):
             note_parts.append(t)
         i += 1
 
-    # 3) Если chat_id не указан параметром — пробуем вытащить его из reply на карточку
+    # 3) Если chat_id не указан параметром — берём его из карточки, на которую ответили
     if chat_id is None:
         if not message.reply_to_message:
             return bot.reply_to(message, "Либо укажи: /invoice <chat_id> <base> [currency] [fee] [note], либо ответь командой на карточку заявки.")
-        m = re.search(r"id (\-?\d+)\)", message.reply_to_message.text or "")
-        if not m:
+        if not card:
             return bot.reply_to(message, "Не нашла user_id в карточке. Ответьте командой /invoice на карточку заявки.")
-        chat_id = int(m.group(1))
+        chat_id = card["chat_id"]
 
     # 4) Проверяем, что есть базовая сумма
     if not base_tok or not _is_number_token(base_tok):
@@ -1107,29 +3846,36 @@ def cmd_invoice(message: types.Message):
         bot.send_message(
             chat_id,
             "После оплаты нажмите «✅ Я оплатил(а)» и пришлите чек.",
-            reply_markup=types.ReplyKeyboardMarkup(resize_keyboard=True).add("✅ Я оплатил(а)")
+            reply_markup=KEYBOARDS.get("pay_only")
         )
-        bot.reply_to(message, f"Инвойс отправлен клиенту: {total} {currency}.")
+        for_card = card and card["request_id"] and card["chat_id"] == chat_id
+        for_request = f" (заявка #{card['request_id']})" if for_card else ""
+        bot.reply_to(message, f"Инвойс отправлен клиенту: {total} {currency}{for_request}.")
     except Exception as e:
         bot.reply_to(message, f"Не удалось отправить инвойс: {e}")
 
 
-# /confirmpaid <chat_id>  ИЛИ reply на карточку оплаты
+# /confirmpaid <chat_id>  ИЛИ reply на карточку оплаты (тогда эта оплата отмечается подтверждённой)
 @bot.message_handler(commands=['confirmpaid'])
 @admin_only
 def cmd_confirmpaid(message: types.Message):
     parts = message.text.split(maxsplit=1)
     user_id = None
+    payment_id = None
     if len(parts) == 2 and parts[1].lstrip("-").isdigit():
         user_id = int(parts[1])
     elif message.reply_to_message:
-        m = re.search(r"id (\-?\d+)\)", message.reply_to_message.text or "")
-        if m:
-            user_id = int(m.group(1))
+        card = resolve_admin_reply(message)
+        if card:
+            user_id, payment_id = card["chat_id"], card["payment_id"]
     if user_id is None:
         return bot.reply_to(message, "Укажи: /confirmpaid <chat_id> или ответь командой на карточку оплаты/заявки.")
     try:
         bot.send_message(user_id, "✅ Оплата подтверждена. Спасибо! Пришлём документы по брони в ближайшее время.")
+        if payment_id:
+            db.execute("UPDATE payments SET confirmed_at=CURRENT_TIMESTAMP WHERE id=? AND confirmed_at IS NULL",
+                       (payment_id,))
+            return bot.reply_to(message, f"Оплата #{payment_id} подтверждена, клиент уведомлён.")
         bot.reply_to(message, "Клиент уведомлён о подтверждении оплаты.")
     except Exception as e:
         bot.reply_to(message, f"Не удалось отправить клиенту: {e}")
@@ -1180,8 +3926,7 @@ def cmd_senddoc(message: types.Message):
         bot.reply_to(message, f"Не удалось отправить: {e}")
 
 
-# ============ Fallback (последним!) ============
-@bot.message_handler(func=lambda m: m.content_type == 'text' and not ((m.text or "").startswith("/")))
+# ============ Fallback (последним в route_text) ============
 def fallback(message: types.Message):
     bot.send_message(
         message.chat.id,
@@ -1189,38 +3934,485 @@ def fallback(message: types.Message):
         reply_markup=main_menu()
     )
 
+# ============ Async-режим (RUNTIME=async) ============
+# Те же хэндлеры и FSM, но ввод-вывод — в одном event loop: вебхук принимает aiohttp, апдейты
+# разбирает AsyncTeleBot (в него зеркалируются хэндлеры синхронного bot), вызовы Bot API идут через
+# его aiohttp-сессию. Сам хэндлер (FSM, SQLite) выполняется в небольшом пуле потоков
+# (asyncio.to_thread), но поток не ждёт Telegram там, где вызов помечен defer=True (ответы в чат
+# текущего апдейта): он сразу получает PendingCall, а сообщение уходит в фоне — по порядку внутри
+# чата и через лимиты OUTBOX. Без defer ждём ответ, и ошибка Bot API — исключение в месте вызова.
+# Поэтому тысячи диалогов не держат тысячи потоков. Апдейты одного чата идут строго по очереди.
+# Карточки в админ-группу — задачи в loop, вложения к карточке отправляются параллельно (asyncio.gather).
+# Запуск: RUNTIME=async python main.py (или python main.py serve --runtime async / poll --runtime async).
+RUNTIME               = os.getenv("RUNTIME", "sync").strip().lower()     # sync | async
+ASYNC_HANDLER_THREADS = int(os.getenv("ASYNC_HANDLER_THREADS", "8"))     # потоки для хэндлеров и SQLite
+ASYNC_API_CONNECTIONS = int(os.getenv("ASYNC_API_CONNECTIONS", "100"))   # соединений aiohttp к Bot API
+
+
+def _camel(name: str) -> str:
+    head, *rest = name.split("_")
+    return head + "".join(w.capitalize() for w in rest)
+
+
+class AsyncRuntime:
+    def __init__(self, sync_bot: telebot.TeleBot, threads: int, connections: int):
+        self.sync_bot = sync_bot
+        self.threads = threads
+        self.connections = connections
+        self.abot = None
+        self.loop = None
+        self.executor = None
+        self.accepting = False
+        self.inflight = 0
+        self._lanes = {}         # chat_id -> [asyncio.Lock, сколько ждут]: апдейты чата по очереди
+        self._send_lanes = {}    # то же для исходящих: порядок сообщений в чате
+        self._tasks = set()
+        self._update_id = None   # contextvars.ContextVar: update_id для логов в потоке хэндлера
+
+    # --- настройка ---
+    def _setup(self):
+        import contextvars
+        from concurrent.futures import ThreadPoolExecutor
+        from telebot import asyncio_helper
+        from telebot.async_telebot import AsyncTeleBot
+        self.loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(self.threads, thread_name_prefix="async-handler")
+        self.loop.set_default_executor(self.executor)   # asyncio.to_thread — в этот пул
+        self._update_id = contextvars.ContextVar("update_id", default=None)
+        if BOT_API_URL:
+            asyncio_helper.API_URL = BOT_API_URL
+        if BOT_API_FILE_URL:
+            asyncio_helper.FILE_URL = BOT_API_FILE_URL
+        asyncio_helper.REQUEST_LIMIT = self.connections
+        asyncio_helper.REQUEST_TIMEOUT = int(BOT_API_CONNECT_TIMEOUT + BOT_API_READ_TIMEOUT)
+        self.abot = AsyncTeleBot(BOT_TOKEN, parse_mode="HTML")
+        # те же хэндлеры в том же порядке, с теми же фильтрами; функция — обёртка над синхронной
+        for src, dst in ((self.sync_bot.message_handlers, self.abot.message_handlers),
+                         (self.sync_bot.callback_query_handlers, self.abot.callback_query_handlers)):
+            dst.extend(dict(h, function=self._wrap(h["function"])) for h in src)
+        self.accepting = True
+
+    def _wrap(self, fn):
+        async def handler(message):
+            return await asyncio.to_thread(self._call_handler, fn, message)
+        handler.__name__ = fn.__name__
+        return handler
+
+    def _call_handler(self, fn, message):
+        chat = message.message.chat if isinstance(message, types.CallbackQuery) and message.message else \
+            getattr(message, "chat", None)
+        chat_id = chat.id if chat is not None else message.from_user.id
+        _async_local.runtime, _async_local.chat_id = self, chat_id
+        try:
+            with log_context(update_id=self._update_id.get(), chat_id=chat_id):
+                return fn(message)
+        finally:
+            _async_local.runtime = _async_local.chat_id = None
+
+    @asynccontextmanager
+    async def _lane(self, lanes: dict, key):
+        if key is None:
+            yield
+            return
+        lane = lanes.get(key)
+        if lane is None:
+            lane = lanes[key] = [asyncio.Lock(), 0]
+        lane[1] += 1
+        try:
+            async with lane[0]:
+                yield
+        finally:
+            lane[1] -= 1
+            if not lane[1]:
+                del lanes[key]
+
+    # --- входящие ---
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def process(self, update):
+        if isinstance(update, dict):
+            update = types.Update.de_json(update)
+        chat_id = _update_chat_id(update)
+        try:
+            async with self._lane(self._lanes, chat_id):
+                t0 = time.perf_counter()
+                message = update.message
+                if message is not None and message.content_type == "text":
+                    # AsyncTeleBot зовёт фильтр route_text прямо в loop, а он читает шаг FSM (SELECT
+                    # при промахе кэша и всегда при SESSION_SHARED) — маршрут считаем заранее в пуле,
+                    # фильтр и хэндлер возьмут готовый message._route
+                    await asyncio.to_thread(_resolve_route, message)
+                self._update_id.set(update.update_id)
+                await self.abot.process_new_updates([update])
+                elapsed = time.perf_counter() - t0
+                METRICS.observe("tripbuddy_update_seconds", elapsed)
+                log_event("update", logging.DEBUG, category="update", update_id=update.update_id,
+                          chat_id=chat_id, duration_ms=round(elapsed * 1000, 2))
+            with UPDATES._lock:
+                UPDATES.processed += 1
+        except Exception:
+            with UPDATES._lock:
+                UPDATES.failed += 1
+            log.exception("update processing error")
+        finally:
+            self.inflight -= 1
+
+    async def submit(self, raw) -> bool:
+        """Как UpdatePool.submit: False — перегрузка или остановка; повтор update_id отбрасываем (True)."""
+        update_id = raw["update_id"] if isinstance(raw, dict) else raw.update_id
+        if not self.accepting or self.inflight >= WEBHOOK_QUEUE_MAX:
+            with UPDATES._lock:
+                UPDATES.rejected += 1
+            return False
+        self.inflight += 1   # место занято до проверки на повтор: отклонённый апдейт дублем не считается
+        dedupe = UPDATES.dedupe
+        if dedupe is not None:
+            # с UPDATE_DEDUPE_PERSIST seen() пишет в SQLite — не в loop
+            dup = await asyncio.to_thread(dedupe.seen, update_id) if dedupe.database is not None else dedupe.seen(update_id)
+            if dup:
+                self.inflight -= 1
+                return True
+        self._spawn(self.process(raw))
+        return True
+
+    # --- исходящие ---
+    async def api(self, name: str, chat_id, args: tuple, kwargs: dict, cost: float = 1, ordered: bool = True):
+        """Вызов AsyncTeleBot через лимиты OUTBOX; ordered — по очереди с другими отправками в этот чат."""
+        from telebot import asyncio_helper
+        method = getattr(self.abot, name)
+
+        async def call():
+            t0 = time.perf_counter()
+            try:
+                result = await method(*args, **kwargs)
+            except asyncio_helper.ApiTelegramException as e:
+                API_LATENCY.record(_camel(name), time.perf_counter() - t0, ok=False)
+                # синхронный код ловит исключения apihelper — отдаём ему привычный тип
+                raise telebot.apihelper.ApiTelegramException(_camel(name), e.result, e.result_json) from e
+            API_LATENCY.record(_camel(name), time.perf_counter() - t0)
+            return result
+
+        async with self._lane(self._send_lanes if ordered else {}, chat_id if ordered else None):
+            return await OUTBOX.acall(chat_id, call, cost)
+
+    def call_later(self, delay: float, fn, message):
+        """Из потока хэндлера: fn(message) через delay секунд — в пуле и в lane чата, как хэндлер (см. AttachmentIntake)."""
+        async def run_in_lane():
+            try:
+                async with self._lane(self._lanes, message.chat.id):
+                    await asyncio.to_thread(self._call_handler, fn, message)
+            except Exception:
+                log.exception("chat task error")
+
+        def run():
+            self._spawn(run_in_lane())
+        self.loop.call_soon_threadsafe(self.loop.call_later, delay, run)
+
+    def call_from_thread(self, name: str, chat_id, args: tuple, kwargs: dict, cost: float = 1,
+                         defer: bool = False):
+        """Из потока хэндлера: с ожиданием (ошибка Bot API — исключение у вызывающего);
+        с defer=True — в фоне (PendingCall), ошибка только в лог."""
+        future = asyncio.run_coroutine_threadsafe(self.api(name, chat_id, args, kwargs, cost), self.loop)
+        has_file = any(hasattr(v, "read") for v in (*args, *kwargs.values()))   # файл закроют после возврата
+        if defer and not has_file:
+            future.add_done_callback(_log_pending_error)
+            return PendingCall(future)
+        return future.result()
+
+    # --- админ-группа ---
+    def submit_admin_card(self, job):
+        self.loop.call_soon_threadsafe(self._spawn, self._admin_card(job))
+
+    async def _admin_card(self, job):
+        body, attachments, user_chat_id, error_text, ref = job
+        admin_id = ADMIN_GROUP_ID_INT
+        try:
+            card = await self.api("send_message", admin_id, (admin_id, body), {})
+            reply = {"reply_to_message_id": card.message_id}
+            calls = []
+            photos = [fid for kind, fid, *_ in attachments if kind == "photo"]
+            docs = [fid for kind, fid, *_ in attachments if kind == "doc"]
+            for kind, files in (("photo", photos), ("doc", docs)):
+                for chunk in _chunks(files, ADMIN_ALBUM_SIZE):
+                    if len(chunk) == 1:
+                        name = "send_photo" if kind == "photo" else "send_document"
+                        calls.append((kind, name, (admin_id, chunk[0]), 1))
+                    else:
+                        media = [(types.InputMediaPhoto if kind == "photo" else types.InputMediaDocument)(fid)
+                                 for fid in chunk]
+                        calls.append((kind, "send_media_group", (admin_id, media), len(media)))
+            # все альбомы — ответом на уже отправленную карточку, порядок между ними не важен
+            results = await asyncio.gather(*(self.api(name, admin_id, args, reply, cost, ordered=False)
+                                             for _, name, args, cost in calls))
+            sent = [("card", card)]
+            for (kind, *_), res in zip(calls, results):
+                sent.extend((kind, m) for m in (res if isinstance(res, list) else [res]))
+            if ref:
+                await asyncio.to_thread(record_admin_messages, admin_id, sent, ref)
+            with admin_fanout._lock:
+                admin_fanout.sent += 1
+        except Exception as e:
+            with admin_fanout._lock:
+                admin_fanout.failed += 1
+            log.exception("admin fan-out error")
+            if user_chat_id is not None and error_text:
+                try:
+                    await self.api("send_message", user_chat_id, (user_chat_id, f"{error_text}: {e}"), {})
+                except Exception:
+                    pass
+
+    # --- HTTP и запуск ---
+    def web_app(self):
+        from aiohttp import web
+
+        async def home(request):
+            return web.Response(text="<!doctype html><title>OK</title><h1>OK</h1>", content_type="text/html")
+
+        async def webhook(request):
+            if request.content_type != "application/json":
+                raise web.HTTPForbidden()
+            if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+                raise web.HTTPForbidden()
+            try:
+                raw = await request.json()
+            except ValueError:
+                raise web.HTTPBadRequest()
+            if not isinstance(raw, dict) or not isinstance(raw.get("update_id"), int):
+                raise web.HTTPBadRequest()
+            if not self.accepting:
+                return web.Response(status=503, text="Shutting down", headers={"Retry-After": "5"})
+            if not await self.submit(raw):
+                return web.Response(status=429, text="Queue is full", headers={"Retry-After": "1"})
+            return web.Response(text="OK")
+
+        async def metrics(request):
+            if METRICS_TOKEN:
+                given = request.query.get("token") or request.headers.get("Authorization", "").removeprefix("Bearer ")
+                if given != METRICS_TOKEN:
+                    raise web.HTTPForbidden()
+            text = await asyncio.to_thread(METRICS.render)
+            return web.Response(text=text, content_type="text/plain", charset="utf-8")
+
+        web_app = web.Application()
+        web_app.router.add_get("/", home)
+        web_app.router.add_post(f"/webhook/{BOT_TOKEN}", webhook)
+        web_app.router.add_get("/metrics", metrics)
+        return web_app
+
+    async def _poll(self):
+        await asyncio.to_thread(_with_retries, clear_webhook)
+        offset = None
+        try:
+            pending = await self.abot.get_updates(offset=-1, timeout=1)
+            if pending:
+                offset = pending[-1].update_id + 1
+        except Exception as e:
+            log.info("skip pending error (ok to ignore): %s", e)
+        while self.accepting:
+            try:
+                updates = await self.abot.get_updates(offset=offset, timeout=30, request_timeout=35)
+            except Exception as e:
+                log.error("get_updates error: %s", e)
+                await asyncio.sleep(3)
+                continue
+            for u in updates:
+                offset = u.update_id + 1
+                while not await self.submit(u):   # при перегрузке просто ждём
+                    if not self.accepting:
+                        return
+                    await asyncio.sleep(0.05)
+
+    async def serve(self, host: str, port: int, webhook: bool):
+        import signal
+        from aiohttp import web
+        self._setup()
+        runner = web.AppRunner(self.web_app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        if webhook:
+            log.info("Starting async runtime in WEBHOOK mode. PUBLIC_URL=%s", PUBLIC_URL)
+            self._spawn(asyncio.to_thread(_with_retries, sync_webhook, webhook_url(), WEBHOOK_SECRET))
+        else:
+            log.info("Starting async runtime in POLLING mode.")
+            self._spawn(self._poll())
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(sig, stop.set)
+        await stop.wait()
+        # остановка: новые апдейты не берём, дожидаемся начатых и фоновых отправок
+        self.accepting = False
+        await runner.cleanup()
+        pending = [t for t in self._tasks if not t.done()]
+        if pending:
+            done, left = await asyncio.wait(pending, timeout=WEBHOOK_DRAIN_TIMEOUT)
+            if left:
+                log.warning("AsyncRuntime: остановка по таймауту, не завершено %d задач", len(left))
+                for t in left:
+                    t.cancel()
+        await self.abot.close_session()
+        self.executor.shutdown(wait=True)
+
+    def stats(self) -> dict:
+        return {"inflight": self.inflight, "chats": len(self._lanes), "tasks": len(self._tasks)}
+
+
+ASYNC_RUNTIME = AsyncRuntime(bot, ASYNC_HANDLER_THREADS, ASYNC_API_CONNECTIONS)
+
 # ============ ЗАПУСК ============
+# При импорте модуль только объявляет бота, хэндлеры и Flask-приложение — ни схемы, ни сети, ни
+# фоновых потоков (очередь логов и запись сессий запускают create_app()/main()).
+# Точки входа:
+#   gunicorn "main:create_app()"  — веб-процесс: принимает вебхук, апдейты разбирает пул UPDATES.
+#                                   Вебхук НЕ регистрирует — это делает set-webhook один раз на деплой.
+#                                   Единственная точка входа для gunicorn: "main:app" ничего не
+#                                   запускает (ни схемы, ни пула) — апдейты просто не будут разбираться.
+#   python main.py set-webhook    — выставить вебхук на PUBLIC_URL (если он уже такой — ничего не делает);
+#                                   delete-webhook / webhook-info / migrate — остальные служебные команды.
+#   python main.py poll           — поллер без вебхука: long polling + /health и /metrics на PORT.
+#   python main.py                — всё в одном процессе (как раньше): вебхук при PUBLIC_URL, иначе polling.
+# Procfile: один процесс gunicorn -k gthread --threads $WEB_THREADS.
+#   - gthread: поток gunicorn только кладёт апдейт в очередь, медленный клиент не держит воркер;
+#     апдейты одного чата разбирает один воркер UPDATES — шаги FSM идут строго по порядку.
+#   - Несколько процессов (WEB_CONCURRENCY=N > 1, gunicorn берёт -w из него же) — только если одного
+#     не хватает: Telegram раскидывает апдейты одного чата по процессам, и порядок между ними уже не
+#     гарантирован. Поэтому при N > 1 по умолчанию включаются SESSION_SHARED=1 (FSM без кэша, изменения
+#     сессии — транзакцией в БД) и UPDATE_DEDUPE_PERSIST=1 (повтор апдейта может прийти в другой
+#     процесс), а лимит OUTBOX делится на N; рассылку ведёт один процесс (аренда в broadcasts),
+#     метрики и /profile — у каждого процесса свои.
+#   - без --preload: потоки пула должны стартовать в воркере, а не в мастере до fork.
 PUBLIC_URL = os.getenv("PUBLIC_URL", "").strip()
 PORT = int(os.getenv("PORT", "5000"))  # в проде Replit сам подставит PORT
+WEBHOOK_SYNC_RETRIES = int(os.getenv("WEBHOOK_SYNC_RETRIES", "5"))
 
-if PUBLIC_URL:
-    # ---- ПРОД / DEPLOY: режим WEBHOOK ----
-    print(f"Starting in WEBHOOK mode. PUBLIC_URL={PUBLIC_URL}")
-    # Чистим и выставляем новый вебхук на наш эндпоинт
-    try:
-        bot.remove_webhook()
-    except Exception as e:
-        print(f"remove_webhook error (ok to ignore): {e}")
+def _mask_token(text: str) -> str:
+    return text.replace(BOT_TOKEN, BOT_TOKEN.split(":")[0] + ":<token>")
 
-    webhook_url = f"{PUBLIC_URL}/webhook/{BOT_TOKEN}"
-    ok = bot.set_webhook(url=webhook_url, drop_pending_updates=True)
-    print(f"Webhook set to {webhook_url}: {ok}")
+def webhook_url() -> str:
+    return f"{PUBLIC_URL}/webhook/{BOT_TOKEN}"
 
-    # Запускаем только Flask — именно он нужен Replit Deploy
-    app.run(host="0.0.0.0", port=PORT, debug=False, use_reloader=False)
+def sync_webhook(url: str, secret: str = "") -> bool:
+    """
+    Выставить вебхук, только если сейчас в Telegram он другой. True — был вызван setWebhook.
+    secret_token getWebhookInfo не возвращает, поэтому отпечаток url+secret храним в app_meta.
+    """
+    fingerprint = hashlib.sha256(f"{url}\n{secret}".encode()).hexdigest()
+    info = bot.get_webhook_info()
+    if info.url == url and get_meta("webhook") == fingerprint:
+        log.info("Webhook already set to %s, pending=%s", _mask_token(url), info.pending_update_count)
+        return False
+    ok = bot.set_webhook(url=url, drop_pending_updates=True, secret_token=secret or None)
+    set_meta("webhook", fingerprint)
+    log.info("Webhook set to %s: %s", _mask_token(url), ok)
+    return True
+
+def clear_webhook() -> bool:
+    """Для polling: снять вебхук, если он выставлен. True — был вызван deleteWebhook."""
+    if not bot.get_webhook_info().url:
+        return False
+    bot.remove_webhook()
+    db.execute("DELETE FROM app_meta WHERE key='webhook'")
+    log.info("Webhook removed")
+    return True
+
+def _with_retries(fn, *args):
+    for attempt in range(WEBHOOK_SYNC_RETRIES):
+        try:
+            return fn(*args)
+        except Exception as e:
+            log.warning("%s failed (attempt %d/%d): %s", fn.__name__, attempt + 1, WEBHOOK_SYNC_RETRIES, e)
+            time.sleep(min(2 ** attempt, 30))
+    log.error("%s: giving up after %d attempts", fn.__name__, WEBHOOK_SYNC_RETRIES)
+
+_started = False
+_start_lock = threading.Lock()
+
+def _start_workers(pool: bool = True) -> bool:
+    """Логи, схема, запись сессий, пул UPDATES (для async-режима не нужен) и подхват рассылок —
+    один раз на процесс. False — уже запущено."""
+    global _started
+    with _start_lock:
+        if _started:
+            return False
+        init_logging()
+        init_db()
+        sessions.start()
+        if pool:
+            UPDATES.start()
+        Thread(target=_resume_broadcasts_loop, name="broadcast-resume", daemon=True).start()
+        _started = True
+        return True
 
-else:
-    # ---- ЛОКАЛЬНО / WORKSPACE: режим POLLING + мини-Flask (для /health) ----
-    print("Starting in POLLING mode (no PUBLIC_URL).")
-    try:
-        bot.remove_webhook()
-    except Exception as e:
-        print(f"remove_webhook error (ok to ignore): {e}")
+def create_app():
+    """Фабрика для gunicorn: gunicorn -k gthread "main:create_app()". Вебхук не трогает."""
+    t0 = time.perf_counter()
+    if _start_workers():
+        log.info("web worker ready in %.1f ms (pid %d, schema v%d)", (time.perf_counter() - t0) * 1000,
+                 os.getpid(), SCHEMA_VERSION)
+    return app
+
+def _poll():
+    _with_retries(clear_webhook)
+    run_polling(skip_pending=True)
+
+def start_bot():
+    """Всё в одном процессе: create_app() + вебхук или polling в фоновом потоке."""
+    t0 = time.perf_counter()
+    _start_workers()
+    if PUBLIC_URL:
+        log.info("Starting in WEBHOOK mode. PUBLIC_URL=%s", PUBLIC_URL)
+        Thread(target=_with_retries, args=(sync_webhook, webhook_url(), WEBHOOK_SECRET),
+               name="webhook-sync", daemon=True).start()
+    else:
+        log.info("Starting in POLLING mode (no PUBLIC_URL).")
+        Thread(target=_poll, name="polling", daemon=True).start()
+    log.info("bot started in %.1f ms (schema v%d)", (time.perf_counter() - t0) * 1000, SCHEMA_VERSION)
 
-    # Поднимем Flask в фоне, чтобы / health-check работал и тут
-    def _run_web_bg():
-        app.run(host="0.0.0.0", port=PORT, debug=False, use_reloader=False)
-    Thread(target=_run_web_bg, daemon=True).start()
+def _run_web():
+    app.run(host="0.0.0.0", port=PORT, debug=False, use_reloader=False)
 
-    # И запустим обычный long polling
-    bot.infinity_polling(skip_pending=True, timeout=30, long_polling_timeout=30)
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="main.py", description="TripBuddy bot")
+    parser.add_argument("command", nargs="?", default="serve",
+                        choices=["serve", "poll", "set-webhook", "delete-webhook", "webhook-info", "migrate"])
+    parser.add_argument("--runtime", choices=["sync", "async"], default=RUNTIME if RUNTIME == "async" else "sync",
+                        help="sync — TeleBot + Flask + пул потоков; async — AsyncTeleBot + aiohttp (по умолчанию $RUNTIME)")
+    args = parser.parse_args(argv)
+    cmd = args.command
+    init_logging()
+    if cmd in ("serve", "poll") and args.runtime == "async":
+        _start_workers(pool=False)
+        asyncio.run(ASYNC_RUNTIME.serve("0.0.0.0", PORT, webhook=cmd == "serve" and bool(PUBLIC_URL)))
+    elif cmd == "serve":
+        start_bot()
+        _run_web()
+    elif cmd == "poll":
+        _start_workers()
+        log.info("Starting poller (no webhook).")
+        Thread(target=_run_web, name="web", daemon=True).start()   # /health и /metrics
+        _poll()
+    elif cmd == "migrate":
+        init_db()
+        print(f"schema v{schema_version()}")
+    elif cmd == "set-webhook":
+        if not PUBLIC_URL:
+            print("PUBLIC_URL не задан — вебхук не на что ставить (для polling: python main.py poll)", file=sys.stderr)
+            return 2
+        init_db()
+        changed = sync_webhook(webhook_url(), WEBHOOK_SECRET)
+        print(f"webhook {'set' if changed else 'unchanged'}: {_mask_token(webhook_url())}")
+    elif cmd == "delete-webhook":
+        init_db()
+        print("webhook removed" if clear_webhook() else "webhook was not set")
+    elif cmd == "webhook-info":
+        info = bot.get_webhook_info()
+        print(json.dumps({"url": _mask_token(info.url or ""), "pending_update_count": info.pending_update_count,
+                          "last_error_date": info.last_error_date, "last_error_message": info.last_error_message,
+                          "max_connections": info.max_connections}, ensure_ascii=False, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,29 @@
+import os
+import sys
+import tempfile
+
+# main читает окружение при импорте: отдельная БД и лог на прогон тестов
+_tmp = tempfile.mkdtemp(prefix="tripbuddy-test-")
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("DB_PATH", os.path.join(_tmp, "test.db"))
+os.environ.setdefault("LOG_FILE", os.path.join(_tmp, "test.log"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def database():
+    """Схема в тестовой БД (main.init_db(), как при старте)."""
+    import main
+    main.init_db()
+    return main.db
+
+
+@pytest.fixture
+def fresh_db(tmp_path, monkeypatch):
+    """Пустая БД вместо main.db (PRAGMA user_version = 0) — для миграций и тестов схемы."""
+    import main
+    database = main.Database(str(tmp_path / "fresh.db"))
+    monkeypatch.setattr(main, "db", database)
+    return database
@@ -0,0 +1,61 @@
+import itertools
+
+import pytest
+
+import main
+
+ADMIN = -1001
+
+
+@pytest.fixture
+def api(database, monkeypatch):
+    """Bot API без сети: список вызовов (метод, что отправлено, reply_to_message_id)."""
+    calls, ids = [], itertools.count(1)
+
+    def message(chat_id):
+        return main.types.Message.de_json({"message_id": next(ids), "date": 0,
+                                           "chat": {"id": chat_id, "type": "supergroup"}})
+
+    def record(name):
+        def call(chat_id, what, **kw):
+            calls.append((name, chat_id, what, kw.get("reply_to_message_id")))
+            if name == "send_media_group":
+                return [message(chat_id) for _ in what]
+            return message(chat_id)
+        return call
+
+    for name in ("send_message", "send_photo", "send_document", "send_media_group"):
+        monkeypatch.setattr(main.bot, name, record(name))
+    monkeypatch.setattr(main, "ADMIN_GROUP_ID_INT", ADMIN)
+    return calls
+
+
+def test_card_attachments_go_in_full_albums(api):
+    photos = [["photo", f"P{i}", f"UP{i}"] for i in range(23)]
+    docs = [["doc", f"D{i}", f"UD{i}"] for i in range(11)]
+    card = main.send_admin_card(ADMIN, "Заявка #7", photos + docs, {"chat_id": 555, "request_id": 7})
+    assert [(name, len(what) if isinstance(what, list) else 1) for name, _, what, _ in api] == [
+        ("send_message", 1), ("send_media_group", 10), ("send_media_group", 10), ("send_media_group", 3),
+        ("send_media_group", 10), ("send_document", 1)]
+    assert {reply for _, _, _, reply in api[1:]} == {card.message_id}   # всё — ответом на карточку
+    assert [m.media for m in api[4][2]] == [f"D{i}" for i in range(10)]
+    mapped = main.db.query("SELECT COUNT(*) AS n FROM admin_messages WHERE admin_chat_id=? AND request_id=7", (ADMIN,))
+    assert mapped[0]["n"] == 1 + 23 + 11
+
+
+def test_fanout_sends_cards_in_order_and_reports_failure(api, monkeypatch):
+    fanout = main.AdminFanout()
+    real_send = main.bot.send_message
+
+    def send_message(chat_id, text, **kw):
+        if text == "boom":
+            raise RuntimeError("admin group unavailable")
+        return real_send(chat_id, text, **kw)
+
+    monkeypatch.setattr(main.bot, "send_message", send_message)
+    for body in ("card 1", "boom", "card 3"):
+        fanout.submit(body, [], user_chat_id=555, error_text="Не удалось отправить")
+    fanout.shutdown()
+    assert [(chat, what) for name, chat, what, _ in api] == [
+        (ADMIN, "card 1"), (555, "Не удалось отправить: admin group unavailable"), (ADMIN, "card 3")]
+    assert (fanout.sent, fanout.failed) == (2, 1)
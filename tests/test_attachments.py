@@ -0,0 +1,57 @@
+import threading
+
+import main
+
+
+def _photo(cid, n, media_group_id=None):
+    msg = {"message_id": n, "date": 0, "chat": {"id": cid, "type": "private"},
+           "photo": [{"file_id": f"F{n}", "file_unique_id": f"U{n}", "width": 1, "height": 1}]}
+    if media_group_id:
+        msg["media_group_id"] = media_group_id
+    return main.types.Message.de_json(msg)
+
+
+def test_slow_session_write_of_one_chat_does_not_block_others(database, monkeypatch):
+    intake = main.AttachmentIntake(0.05)
+    acks = []
+    monkeypatch.setattr(main.bot, "send_message", lambda cid, text, **kw: acks.append((cid, text)))
+    entered, release = threading.Event(), threading.Event()
+    real_extend = main.sessions.extend
+
+    def extend(cid, bucket, items):
+        if cid == 9001:   # как запись в SQLite, ждущая блокировку
+            entered.set()
+            release.wait(5)
+        real_extend(cid, bucket, items)
+
+    monkeypatch.setattr(main.sessions, "extend", extend)
+    slow = threading.Thread(target=intake.receive, args=(_photo(9001, 1), "attachments"))
+    slow.start()
+    try:
+        assert entered.wait(5)
+        done = threading.Thread(target=intake.receive, args=(_photo(9002, 2), "attachments"))
+        done.start()
+        done.join(2)
+        assert not done.is_alive()
+        assert [cid for cid, _ in acks] == [9002]
+    finally:
+        release.set()
+        slow.join(5)
+    assert [cid for cid, _ in acks] == [9002, 9001]
+    assert intake.stored == 2
+    assert intake._chats == {}
+    main.sessions.reset(9001)
+    main.sessions.reset(9002)
+
+
+def test_album_is_stored_once_with_one_ack(database, monkeypatch):
+    intake = main.AttachmentIntake(0.05)
+    acks = []
+    monkeypatch.setattr(main.bot, "send_message", lambda cid, text, **kw: acks.append((cid, text)))
+    main.sessions.set(9003, "attachments", {})
+    for n in (1, 2, 2, 3):   # повтор file_unique_id внутри альбома
+        intake.receive(_photo(9003, n, "ALB"), "attachments")
+    intake.flush(9003)
+    assert [a[2] for a in main.sessions.get_data(9003)["attachments"]] == ["U1", "U2", "U3"]
+    assert acks == [(9003, "📎 Принято 3 файла ✅, повторы пропущены: 1")]
+    main.sessions.reset(9003)
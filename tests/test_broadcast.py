@@ -0,0 +1,25 @@
+import main
+
+
+def test_failed_broadcast_is_paused_not_resumed(database, monkeypatch):
+    sent = []
+    monkeypatch.setattr(main.bot, "send_message", lambda chat_id, text, **kw: sent.append((chat_id, text)))
+
+    def broken_counts(bid):
+        raise RuntimeError("disk I/O error")
+
+    database.execute("INSERT INTO requests (chat_id, type) VALUES (501, 'Отель')")
+    bid, n = main.create_broadcast(1, 1, "hi", None, {})
+    assert n >= 1
+    database.execute("UPDATE broadcasts SET status='running', owner=?, lease_until=? WHERE id=?",
+                     (main._process_id(), main.time.time() + 60, bid))
+    monkeypatch.setattr(main, "broadcast_counts", broken_counts)
+    main._run_broadcast(bid)
+
+    row = database.query_one("SELECT status, owner FROM broadcasts WHERE id=?", (bid,))
+    assert (row["status"], row["owner"]) == ("paused", None)
+    notices = [t for _, t in sent if "прервана" in t]
+    assert len(notices) == 1
+    main.resume_broadcasts()
+    assert bid not in main._broadcast_threads
+    assert len([t for _, t in sent if "прервана" in t]) == 1
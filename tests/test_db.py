@@ -0,0 +1,63 @@
+import sqlite3
+import threading
+
+import pytest
+
+import main
+
+
+def test_transaction_commits_once_and_rolls_back_on_error(fresh_db):
+    fresh_db.execute("CREATE TABLE t (x INTEGER)")
+    commits = fresh_db.commits
+    with fresh_db.transaction():
+        fresh_db.execute("INSERT INTO t VALUES (1)")
+        with fresh_db.transaction():   # вложенный блок — часть внешней транзакции
+            fresh_db.executemany("INSERT INTO t VALUES (?)", [(2,), (3,)])
+    assert fresh_db.commits == commits + 1
+    with pytest.raises(RuntimeError):
+        with fresh_db.transaction():
+            fresh_db.execute("INSERT INTO t VALUES (4)")
+            raise RuntimeError
+    assert fresh_db.rollbacks == 1
+    assert [r[0] for r in fresh_db.query("SELECT x FROM t ORDER BY x")] == [1, 2, 3]
+
+
+def test_each_thread_has_its_own_connection_in_wal(fresh_db):
+    fresh_db.execute("CREATE TABLE t (x INTEGER)")
+    assert fresh_db.query_one("PRAGMA journal_mode")[0] == "wal"
+    seen = []
+
+    def reader():
+        seen.append((fresh_db.connection(), fresh_db.query_one("SELECT COUNT(*) FROM t")[0]))
+
+    with fresh_db.transaction():   # открытая запись этого потока не блокирует чтение в другом
+        fresh_db.execute("INSERT INTO t VALUES (1)")
+        t = threading.Thread(target=reader)
+        t.start()
+        t.join(2)
+        assert not t.is_alive()
+    conn, count = seen[0]
+    assert conn is not fresh_db.connection()
+    assert count == 0               # незакоммиченного другой поток не видит
+    assert fresh_db.query_one("SELECT COUNT(*) FROM t")[0] == 1
+
+
+def test_concurrent_writer_waits_instead_of_failing(fresh_db):
+    fresh_db.execute("CREATE TABLE t (x INTEGER)")
+    errors = []
+
+    def writer(n):
+        try:
+            for i in range(20):
+                with fresh_db.transaction():
+                    fresh_db.execute("INSERT INTO t VALUES (?)", (n * 100 + i,))
+        except sqlite3.OperationalError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(30)
+    assert errors == []
+    assert fresh_db.query_one("SELECT COUNT(*) FROM t")[0] == 80
@@ -0,0 +1,114 @@
+import csv
+import io
+import json
+import zipfile
+from datetime import datetime, timezone
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def export_db(fresh_db):
+    main.migrate()
+    for i in range(5):
+        main.save_request(100 + i, {"type": "Отель" if i % 2 else "Билеты", "route": f"Город {i}"})
+        main.save_payment(100 + i, str(1000 + i), "RUB", "карта", "01.05", [["photo", f"F{i}", f"U{i}"]])
+    return fresh_db
+
+
+def _today():
+    return datetime.now(timezone.utc).date()   # created_at — CURRENT_TIMESTAMP, UTC
+
+
+def _tables(buf):
+    with zipfile.ZipFile(buf) as zf:
+        return {name: zf.read(name).decode("utf-8") for name in zf.namelist()}
+
+
+def test_csv_export_is_read_in_chunks(export_db, monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "EXPORT_CHUNK_ROWS", 2)
+    workdir = tmp_path / "cwd"
+    workdir.mkdir()
+    monkeypatch.chdir(workdir)
+    progress = []
+    buf, counts, max_ids = main.build_export("csv", main.export_queries(main.parse_export_args([])),
+                                             lambda table, rows: progress.append((table, rows)))
+    assert counts == {"requests": 5, "payments": 5, "payment_files": 5}
+    assert max_ids == {"requests": 5, "payments": 5, "payment_files": 5}
+    assert [p for p in progress if p[0] == "requests"] == [("requests", 2), ("requests", 4), ("requests", 5)]
+    rows = list(csv.reader(io.StringIO(_tables(buf)["requests.csv"]), delimiter=";"))
+    assert rows[0][:3] == ["id", "chat_id", "type"]
+    assert [r[0] for r in rows[1:]] == ["5", "4", "3", "2", "1"]   # полная выгрузка — новые сверху
+    assert list(workdir.iterdir()) == []                          # в рабочую папку ничего не пишем
+
+
+def test_jsonl_export(export_db):
+    buf, counts, _ = main.build_export("jsonl", main.export_queries(main.parse_export_args(["jsonl"])))
+    lines = _tables(buf)["payment_files.jsonl"].splitlines()
+    assert len(lines) == counts["payment_files"] == 5
+    assert json.loads(lines[0])["file_id"] == "F4"
+
+
+@pytest.fixture
+def exports(export_db, monkeypatch):
+    """_run_export без Telegram: список выгруженных архивов {файл: текст}."""
+    sent, replies = [], []
+    monkeypatch.setattr(main.bot, "send_message",
+                        lambda chat_id, text, **kw: main.types.Message.de_json(
+                            {"message_id": 1, "date": 0, "chat": {"id": chat_id, "type": "private"}}))
+    monkeypatch.setattr(main.bot, "edit_message_text", lambda *a, **kw: None)
+    monkeypatch.setattr(main.bot, "send_document", lambda chat_id, doc, **kw: sent.append(_tables(doc)))
+    monkeypatch.setattr(main.bot, "reply_to", lambda message, text, **kw: replies.append(text))
+
+    def run(*args):
+        assert main._export_lock.acquire(blocking=False)
+        main._run_export(1, 42, main.parse_export_args(list(args)))
+        return sent[-1]
+
+    run.replies = replies
+    return run
+
+
+def _ids(tables, name, fmt="csv"):
+    return [r[0] for r in list(csv.reader(io.StringIO(tables[f"{name}.{fmt}"]), delimiter=";"))[1:]]
+
+
+def test_since_last_exports_only_new_rows(exports):
+    assert _ids(exports("since:last"), "requests") == ["1", "2", "3", "4", "5"]
+    assert main.get_export_marks(42) == {"requests": 5, "payments": 5, "payment_files": 5}
+    main.save_request(200, {"type": "Отель"})
+    main.save_payment(200, "10", "RUB", "карта", "01.05", [["doc", "D", "UD"]])
+    tables = exports("since:last")
+    assert (_ids(tables, "requests"), _ids(tables, "payments"), _ids(tables, "payment_files")) == (["6"], ["6"], ["6"])
+    assert _ids(exports("since:last"), "requests") == []   # нового нет
+    assert main.get_export_marks(42)["requests"] == 6
+
+
+def test_filtered_export_does_not_move_the_mark(exports):
+    exports("since:3")
+    exports("type:Отель")
+    exports(f"from:{_today():%d.%m.%Y}")
+    assert main.get_export_marks(42) == {}
+
+
+def test_since_last_with_filters_is_rejected(exports, monkeypatch):
+    message = main.types.Message.de_json({"message_id": 1, "date": 0, "text": "/export_csv since:last from:01.05.2024",
+                                          "chat": {"id": 1, "type": "private"},
+                                          "from": {"id": 42, "is_bot": False, "first_name": "A"}})
+    main.cmd_export_csv.__wrapped__(message)
+    assert "since:last нельзя совмещать" in exports.replies[0]
+    assert not main._export_lock.locked()
+
+
+def test_export_queries_filters(export_db):
+    spec = main.parse_export_args(["since:2", "type:hotel"])
+    (name, sql, params), = main.export_queries(spec)   # type: — только requests
+    assert name == "requests" and params == [2, "Отель"]
+    assert [r[0] for r in export_db.query(sql, params)] == [4]
+    today = _today()
+    queries = main.export_queries(main.parse_export_args([f"from:{today:%d.%m.%Y}", f"to:{today:%d.%m.%Y}"]))
+    assert {n: len(export_db.query(s, p)) for n, s, p in queries} == {"requests": 5, "payments": 5, "payment_files": 5}
+    plan = " ".join(r[3] for r in export_db.query("EXPLAIN QUERY PLAN " + queries[2][1], queries[2][2]))
+    assert "idx_payments_created_at" in plan and "idx_payment_files_payment_id" in plan
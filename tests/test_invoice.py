@@ -0,0 +1,40 @@
+import pytest
+
+import main
+
+
+def _reply(text, card):
+    return main.types.Message.de_json({
+        "message_id": 10, "date": 0, "text": text, "chat": {"id": -100, "type": "supergroup"},
+        "from": {"id": 1, "is_bot": False, "first_name": "A"},
+        "reply_to_message": {"message_id": 9, "date": 0, "chat": {"id": -100, "type": "supergroup"},
+                             "text": f"Заявка (id {card})"},
+    })
+
+
+@pytest.fixture
+def api(database, monkeypatch):
+    sent, replies = [], []
+    monkeypatch.setattr(main.bot, "send_message", lambda chat_id, text, **kw: sent.append((chat_id, text)))
+    monkeypatch.setattr(main.bot, "reply_to", lambda message, text, **kw: replies.append(text))
+    return sent, replies
+
+
+@pytest.mark.parametrize("text, chat_id, total", [
+    ("/invoice 777 65000", 777, "65000 RUB"),              # явный chat_id главнее карточки
+    ("/invoice 777 65000 RUB 500", 777, "65500 RUB"),
+    ("/invoice 65000", 555, "65000 RUB"),                  # одно число — сумма, клиент из карточки
+    ("/invoice 100 USD тур", 555, "100.0 USD"),
+])
+def test_invoice_in_reply_to_card(api, text, chat_id, total):
+    sent, replies = api
+    main.cmd_invoice.__wrapped__(_reply(text, 555))
+    assert {c for c, _ in sent} == {chat_id}
+    assert replies == [f"Инвойс отправлен клиенту: {total}."]
+
+
+def test_invoice_ambiguous_reply_is_rejected(api):
+    sent, replies = api
+    main.cmd_invoice.__wrapped__(_reply("/invoice 65000.50 500", 555))
+    assert sent == []
+    assert replies == [main.INVOICE_USAGE]
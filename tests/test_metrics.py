@@ -0,0 +1,25 @@
+import threading
+
+import main
+
+
+def test_dead_thread_shards_are_folded_into_totals():
+    m = main.Metrics()
+    m.counter("c", "")
+    m.histogram("h", "", (1, 2))
+
+    def work():
+        m.inc("c")
+        m.observe("h", 1.5)
+
+    for _ in range(200):
+        t = threading.Thread(target=work)
+        t.start()
+        t.join()
+        m.render()
+    m.inc("c")
+    data = m._collect()
+    assert len(m._shards) == 1   # только текущий поток
+    assert data[("c", ())] == 201
+    assert data[("h", ())] == [0, 200, 0, 300.0, 200]
+    assert m._collect() == data   # повторный сбор ничего не удваивает
@@ -0,0 +1,44 @@
+import sqlite3
+
+import main
+
+# Схема до версионирования (PRAGMA user_version = 0): без amount_minor, file_unique_id, daily_rollup и т.д.
+LEGACY_SCHEMA = """
+CREATE TABLE requests (id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER, type TEXT, route TEXT,
+                       dates TEXT, contact TEXT, created_at TEXT DEFAULT CURRENT_TIMESTAMP);
+CREATE TABLE request_attachments (id INTEGER PRIMARY KEY AUTOINCREMENT, request_id INTEGER, kind TEXT, file_id TEXT);
+CREATE TABLE payments (id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER, amount TEXT, currency TEXT,
+                       pay_method TEXT, pay_date TEXT, created_at TEXT DEFAULT CURRENT_TIMESTAMP);
+CREATE TABLE payment_files (id INTEGER PRIMARY KEY AUTOINCREMENT, payment_id INTEGER, kind TEXT, file_id TEXT);
+INSERT INTO requests (chat_id, type, route, created_at) VALUES (1, 'Отель', 'Прага', '2024-05-01 10:00:00');
+INSERT INTO payments (chat_id, amount, currency, created_at) VALUES (1, '1 500,50', 'usd', '2024-05-01 11:00:00');
+"""
+
+
+def test_migrate_legacy_database(fresh_db):
+    conn = sqlite3.connect(fresh_db.path)
+    conn.executescript(LEGACY_SCHEMA)
+    conn.close()
+    assert main.schema_version() == 0
+
+    assert main.migrate() == list(range(1, main.SCHEMA_VERSION + 1))
+    assert main.schema_version() == main.SCHEMA_VERSION
+    cols = {c["name"] for c in main.table_info("requests")}
+    assert {"fullname", "passport_no", "contact"} <= cols
+    assert "file_unique_id" in {c["name"] for c in main.table_info("payment_files")}
+    assert fresh_db.query_one("SELECT amount_minor FROM payments")[0] == 150050
+    rollup = {(r["metric"], r["dim"]): (r["cnt"], r["sum_minor"])
+              for r in fresh_db.query("SELECT * FROM daily_rollup")}
+    assert rollup == {("requests", "Отель"): (1, 0), ("payments", "USD"): (1, 150050)}
+    indexes = {r["name"] for r in fresh_db.query("SELECT name FROM sqlite_master WHERE type='index'")}
+    assert {"idx_requests_created_at", "idx_payment_files_payment_id"} <= indexes
+    if main.has_table("requests_fts"):   # старые заявки попали в поисковый индекс
+        assert [r["id"] for r in main.search_page("праг")[0]] == [1]
+
+    assert main.migrate() == []          # повторный старт — ничего не делает
+
+
+def test_migrate_empty_database(fresh_db):
+    assert main.migrate() == list(range(1, main.SCHEMA_VERSION + 1))
+    assert main.has_table("fsm_sessions") and main.has_table("app_meta")
+    assert fresh_db.query_one("SELECT COUNT(*) FROM daily_rollup")[0] == 0
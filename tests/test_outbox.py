@@ -0,0 +1,78 @@
+import time
+
+import pytest
+
+import main
+
+
+def _too_many_requests(retry_after):
+    return main.telebot.apihelper.ApiTelegramException("sendMessage", None, {
+        "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+        "parameters": {"retry_after": retry_after}})
+
+
+def _outbox(chat_rate=1000.0, chat_burst=1000.0, max_retries=3):
+    return main.Outbox(1000, chat_rate, chat_burst, 6000, max_retries=max_retries, senders=4)
+
+
+def test_429_is_retried_after_retry_after_keeping_chat_order():
+    outbox, calls = _outbox(), []
+
+    def send(name):
+        def fn():
+            calls.append((name, time.monotonic()))
+            if name == "a" and len(calls) == 1:
+                raise _too_many_requests(0.3)
+            return name
+        return fn
+
+    t0 = time.monotonic()
+    first, second = outbox.submit(1, send("a")), outbox.submit(1, send("b"))
+    assert (first.result(5), second.result(5)) == ("a", "b")
+    assert [name for name, _ in calls] == ["a", "a", "b"]   # «b» не обгоняет повтор «a»
+    assert calls[1][1] - t0 >= 0.3
+    assert outbox.retries == 1 and outbox.failed == 0
+
+
+def test_429_gives_up_after_max_retries():
+    outbox, calls = _outbox(max_retries=2), []
+
+    def fn():
+        calls.append(1)
+        raise _too_many_requests(0.01)
+
+    with pytest.raises(main.telebot.apihelper.ApiTelegramException):
+        outbox.call(1, fn)
+    assert len(calls) == 3
+    assert (outbox.retries, outbox.failed) == (2, 1)
+
+
+def test_429_pauses_only_the_chat_that_hit_its_limit():
+    outbox, done = _outbox(chat_rate=1, chat_burst=1), {}
+
+    def fn(chat_id):
+        def call():
+            done.setdefault(chat_id, time.monotonic())
+            if chat_id == 1 and outbox.retries == 0:
+                raise _too_many_requests(1)
+        return call
+
+    t0 = time.monotonic()
+    first = outbox.submit(1, fn(1), cost=2)   # альбом загнал бакет чата 1 в долг — 429 про его лимит
+    time.sleep(0.05)
+    outbox.submit(2, fn(2)).result(5)
+    assert done[2] - t0 < 0.5        # другой чат паузу не ждёт
+    first.result(5)
+
+
+def test_chats_keep_order_and_a_throttled_chat_does_not_hold_others():
+    outbox, sent = _outbox(chat_rate=10, chat_burst=1), []
+    futures = [outbox.submit(1, lambda i=i: sent.append((1, i, time.monotonic()))) for i in range(3)]
+    t0 = time.monotonic()
+    outbox.submit(2, lambda: sent.append((2, 0, time.monotonic()))).result(5)
+    assert time.monotonic() - t0 < 0.1
+    for f in futures:
+        f.result(5)
+    assert [i for chat, i, _ in sent if chat == 1] == [0, 1, 2]
+    stamps = [t for chat, _, t in sent if chat == 1]
+    assert stamps[2] - stamps[0] >= 0.15      # 10 сообщений/с в чат
@@ -0,0 +1,26 @@
+import main
+
+
+def _rollup(database):
+    return {(r["day"], r["metric"], r["dim"]): (r["cnt"], r["sum_minor"])
+            for r in database.query("SELECT * FROM daily_rollup")}
+
+
+def test_rebuild_matches_incremental_rollup(fresh_db):
+    main.migrate()
+    for cid, kind in ((1, "Отель"), (2, "Билеты"), (3, "Отель"), (4, None)):
+        main.save_request(cid, {"type": kind, "route": "Прага", "attachments": [["photo", "F", "U"]]})
+    for cid, amount, currency in ((1, "60000", "RUB"), (2, "70,5", "usd"), (3, "1 000", ""), (4, "abc", "USD"),
+                                  (5, "1e30", None)):
+        main.save_payment(cid, amount, currency, "карта", "01.05", [])
+    live = _rollup(fresh_db)
+    day = fresh_db.query_one("SELECT date(created_at) FROM requests LIMIT 1")[0]
+    assert live == {
+        (day, "requests", "Отель"): (2, 0),
+        (day, "requests", "Билеты"): (1, 0),
+        (day, "requests", ""): (1, 0),
+        (day, "payments", "RUB"): (3, 6000000 + 100000),   # пустая валюта — RUB, 1e30 — вне диапазона (0)
+        (day, "payments", "USD"): (2, 7050),
+    }
+    main.rebuild_daily_rollup()
+    assert _rollup(fresh_db) == live
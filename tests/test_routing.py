@@ -0,0 +1,28 @@
+import telebot
+
+import main
+
+
+def _text(cid, text):
+    return main.types.Message.de_json({"message_id": 1, "date": 0, "text": text,
+                                       "chat": {"id": cid, "type": "private"},
+                                       "from": {"id": cid, "is_bot": False, "first_name": "T"}})
+
+
+def test_step_is_read_once_per_message(database, monkeypatch):
+    calls, handled = [], []
+    real_get_step = main.sessions.get_step
+    monkeypatch.setattr(main.sessions, "get_step", lambda cid: calls.append(cid) or real_get_step(cid))
+    monkeypatch.setitem(main.MENU_ROUTES, "📝 Оставить заявку", handled.append)
+    bot = telebot.TeleBot("123456:TEST", threaded=False)
+    bot.message_handlers = [h for h in main.bot.message_handlers if h["function"].__wrapped__ is main.route_text]
+    message = _text(7001, "📝 Оставить заявку")
+    bot.process_new_messages([message])
+    assert handled == [message]
+    assert calls == [7001]
+    assert message._route == (None, handled.append)
+
+
+def test_command_without_route_is_left_to_command_handlers(database):
+    message = _text(7002, "/ping")
+    assert main._resolve_route(message) == (None, None)
@@ -0,0 +1,46 @@
+import pytest
+
+import main
+
+
+@pytest.fixture
+def search_db(fresh_db, monkeypatch):
+    main.migrate()
+    if not main.has_table("requests_fts"):
+        pytest.skip("SQLite без FTS5")
+    monkeypatch.setattr(main, "SEARCH_PAGE_SIZE", 10)
+    for i in range(25):   # одинаковый текст — одинаковый rank, порядок решает id
+        main.save_request(i, {"type": "Отель", "route": "Прага" if i % 5 else "Прага Прага центр",
+                              "fullname": f"IVANOV {i}"})
+    main.save_request(99, {"type": "Отель", "route": "Вена"})
+    return fresh_db
+
+
+def _pages(text):
+    pages, cursor = [], (float("-inf"), 0)
+    while True:
+        rows, nxt = main.search_page(text, cursor)
+        pages.append([r["id"] for r in rows])
+        if nxt is None:
+            return pages
+        # курсор проходит через callback_data кнопки «Дальше»
+        data = main._search_markup(nxt, len(pages)).keyboard[0][0].callback_data
+        _, _, rank, last_id = data.split(":")
+        cursor = (float(rank), int(last_id))
+
+
+def test_keyset_pages_cover_all_matches_once_in_rank_order(search_db):
+    pages = _pages("праг")   # префикс, без учёта регистра
+    assert [len(p) for p in pages] == [10, 10, 5]
+    ids = [i for p in pages for i in p]
+    expected = [r[0] for r in search_db.query(
+        "SELECT rowid FROM requests_fts WHERE requests_fts MATCH ? ORDER BY rank, rowid", ('"праг"*',))]
+    assert ids == expected
+    assert sorted(ids) == list(range(1, 26))
+    assert ids[:5] == [1, 6, 11, 16, 21]   # «Прага Прага центр» релевантнее
+
+
+def test_all_words_must_match(search_db):
+    assert _pages("прага ivanov 7") == [[8]]
+    assert _pages("вена ivanov") == [[]]
+    assert main.fts_query('прага" OR *') == '"прага"* "OR"*'   # операторы FTS — просто слова в кавычках
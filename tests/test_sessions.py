@@ -0,0 +1,66 @@
+import pytest
+
+import main
+
+
+class CountingDatabase:
+    """main.Database, который считает SELECT из fsm_sessions."""
+
+    def __init__(self, db):
+        self._db = db
+        self.loads = 0
+
+    def query_one(self, sql, params=()):
+        self.loads += "FROM fsm_sessions" in sql
+        return self._db.query_one(sql, params)
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+
+@pytest.fixture
+def store(database):
+    database.execute("DELETE FROM fsm_sessions")
+    return main.SessionStore(CountingDatabase(database), 0, max_entries=3)
+
+
+def _row(database, cid):
+    return database.query_one("SELECT step, data FROM fsm_sessions WHERE chat_id=?", (cid,))
+
+
+def test_writes_reach_db_only_on_flush(store, database):
+    store.set(1, "req_type", {"type": "Отель"})
+    store.update(1, "req_route", {"route": "Прага"})
+    store.append(1, "attachments", ["photo", "F", "U"])
+    assert store.get_step(1) == "req_route"
+    assert _row(database, 1) is None
+    store.flush()
+    row = _row(database, 1)
+    assert row["step"] == "req_route"
+    assert main.json.loads(row["data"]) == {"type": "Отель", "route": "Прага", "attachments": [["photo", "F", "U"]]}
+    store.reset(1)
+    store.flush()
+    assert _row(database, 1) is None
+    assert store.get_step(1) is None
+
+
+def test_cache_is_bounded_and_keeps_dirty_entries(store):
+    for cid in range(1, 6):
+        store.set(cid, "s", {"n": cid})
+    assert len(store._cache) == 5          # не записанные в БД не вытесняются
+    store.flush()
+    assert list(store._cache) == [3, 4, 5]  # после записи — только max_entries последних
+    assert store.get_data(1) == {"n": 1}    # вытесненный читается из БД
+    assert store.db.loads == 1
+
+
+def test_chat_without_session_is_cached(store):
+    for _ in range(5):
+        assert store.get_step(42) is None
+    assert store.db.loads == 1
+    store.set(42, "req_type", {})
+    assert store.get_step(42) == "req_type"
+    store.reset(42)
+    store.flush()
+    assert store.get_step(42) is None
+    assert store.db.loads == 1
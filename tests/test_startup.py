@@ -0,0 +1,16 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_import_starts_no_threads_and_touches_no_files(tmp_path):
+    # инструменты и тесты импортируют main — фоновые потоки и схема появляются только в create_app()/main()
+    code = ("import threading, main; "
+            "print(sorted(t.name for t in threading.enumerate()), main.LOG_LISTENER)")
+    env = dict(os.environ, BOT_TOKEN="123456:TEST", DB_PATH=str(tmp_path / "t.db"), LOG_FILE=str(tmp_path / "t.log"))
+    out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=env, capture_output=True, text=True, timeout=60)
+    assert out.returncode == 0, out.stderr
+    assert out.stdout.split() == ["['MainThread']", "None"]
+    assert list(tmp_path.iterdir()) == []
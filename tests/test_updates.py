@@ -0,0 +1,170 @@
+import threading
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def blocking_bot(monkeypatch):
+    """bot.process_new_updates, который держит воркер, пока не выставлен release."""
+    release, processed = threading.Event(), []
+
+    def process(updates):
+        release.wait(5)
+        processed.extend(u.update_id for u in updates)
+
+    monkeypatch.setattr(main.bot, "process_new_updates", process)
+    return release, processed
+
+
+def _wait(cond, timeout=5.0):
+    """Вызывать cond(), пока не вернёт True (не дольше timeout). Последний результат cond()."""
+    deadline = main.time.monotonic() + timeout
+    while True:
+        ok = cond()
+        if ok or main.time.monotonic() >= deadline:
+            return ok
+        main.time.sleep(0.01)
+
+
+@pytest.mark.parametrize("block", [False, True])
+def test_rejected_update_is_not_remembered_as_duplicate(blocking_bot, block):
+    # webhook (block=False) отвечает 429, polling (block=True) повторяет submit — повтор должен дойти до обработки
+    release, processed = blocking_bot
+    pool = main.UpdatePool(1, 1, main.UpdateDedupe(100, 3600))
+    pool.start()
+    timeout = 0.05 if block else None
+    try:
+        assert pool.submit({"update_id": 1}, block=block, timeout=timeout)
+        assert not pool.submit({"update_id": 2}, block=block, timeout=timeout)   # очередь полна
+        assert not pool.submit({"update_id": 2}, block=block, timeout=timeout)   # и повтор — всё ещё не дубль
+        release.set()
+        assert _wait(lambda: processed == [1])
+        assert _wait(lambda: pool.submit({"update_id": 2}, block=block, timeout=timeout))
+        assert _wait(lambda: processed == [1, 2])
+        assert pool.submit({"update_id": 2}, block=block, timeout=timeout)       # настоящий дубль — молча True
+        assert _wait(lambda: pool.submit({"update_id": 3}, block=block, timeout=timeout))   # место вернулось
+        assert _wait(lambda: processed == [1, 2, 3])
+        assert pool.dedupe.hits == 1
+    finally:
+        release.set()
+        pool.shutdown(5)
+
+
+def test_async_rejected_update_is_not_remembered_as_duplicate(monkeypatch):
+    # то же для RUNTIME=async: _poll повторяет submit, пока не примут
+    monkeypatch.setattr(main, "WEBHOOK_QUEUE_MAX", 1)
+    monkeypatch.setattr(main.UPDATES, "dedupe", main.UpdateDedupe(100, 3600))
+    rt = main.AsyncRuntime(main.bot, 1, 1)
+    processed = []
+
+    async def scenario():
+        release = main.asyncio.Event()
+
+        async def process(raw):
+            try:
+                await release.wait()
+                processed.append(raw["update_id"])
+            finally:
+                rt.inflight -= 1
+
+        rt.process = process
+        rt.accepting = True
+        assert await rt.submit({"update_id": 1})
+        assert not await rt.submit({"update_id": 2})   # очередь полна
+        assert not await rt.submit({"update_id": 2})   # и повтор — всё ещё не дубль
+        release.set()
+        while rt.inflight:
+            await main.asyncio.sleep(0)
+        assert await rt.submit({"update_id": 2})
+        while rt.inflight:
+            await main.asyncio.sleep(0)
+        assert await rt.submit({"update_id": 2})       # настоящий дубль — молча True
+        assert rt.inflight == 0
+
+    main.asyncio.run(scenario())
+    assert processed == [1, 2]
+    assert main.UPDATES.dedupe.hits == 1
+
+
+def test_async_send_raises_at_call_site_unless_deferred():
+    # try/except ApiTelegramException вокруг отправки (StaticAssets и т.п.) должен работать и в async-режиме
+    rt = main.AsyncRuntime(main.bot, 1, 1)
+    calls = []
+
+    async def api(name, chat_id, args, kwargs, cost=1, ordered=True):
+        calls.append(name)
+        raise main.telebot.apihelper.ApiTelegramException(
+            main._camel(name), None, {"error_code": 400, "description": "Bad Request: wrong file identifier"})
+
+    rt.api = api
+    rt.loop = main.asyncio.new_event_loop()
+    loop_thread = threading.Thread(target=rt.loop.run_forever, daemon=True)
+    loop_thread.start()
+    main._async_local.runtime, main._async_local.chat_id = rt, 42
+    try:
+        with pytest.raises(main.telebot.apihelper.ApiTelegramException):
+            main.bot.send_document(42, "stale-file-id")
+        pending = main.bot.send_message(42, "hi", defer=True)
+        assert isinstance(pending, main.PendingCall)
+        with pytest.raises(main.telebot.apihelper.ApiTelegramException):
+            pending.result(5)
+        assert calls == ["send_document", "send_message"]
+    finally:
+        main._async_local.runtime = main._async_local.chat_id = None
+        rt.loop.call_soon_threadsafe(rt.loop.stop)
+        loop_thread.join(5)
+        rt.loop.close()
+
+
+def test_delayed_chat_work_waits_for_chat_update(blocking_bot, monkeypatch):
+    # дописывание альбома по таймеру не должно идти параллельно с апдейтом того же чата
+    release, processed = blocking_bot
+    pool = main.UpdatePool(2, 10)
+    monkeypatch.setattr(main, "UPDATES", pool)
+    pool.start()
+    message = main.types.Message.de_json({"message_id": 1, "date": 0, "chat": {"id": 7, "type": "private"}})
+    try:
+        assert pool.submit({"update_id": 1, "message": {"message_id": 1, "date": 0,
+                                                        "chat": {"id": 7, "type": "private"}}})
+        main._call_later(0.01, lambda m: processed.append(("timer", m.chat.id)), message)
+        main.time.sleep(0.2)
+        assert processed == []   # таймер сработал, но ждёт в очереди чата
+        release.set()
+        assert _wait(lambda: processed == [1, ("timer", 7)])
+    finally:
+        release.set()
+        pool.shutdown(5)
+
+
+def test_async_route_filter_does_not_read_sessions_on_loop(database, monkeypatch):
+    # фильтр route_text AsyncTeleBot выполняет в event loop — шаг FSM к этому моменту уже прочитан в пуле
+    rt = main.AsyncRuntime(main.bot, 1, 1)
+    loop_reads, routes = [], []
+    real_get_step = main.sessions.get_step
+
+    def get_step(cid):
+        try:
+            main.asyncio.get_running_loop()
+            loop_reads.append(cid)
+        except RuntimeError:
+            pass
+        return real_get_step(cid)
+
+    class FakeAsyncBot:
+        async def process_new_updates(self, updates):
+            routes.extend(main._resolve_route(u.message) for u in updates)
+
+    async def scenario():
+        import contextvars
+        rt._update_id = contextvars.ContextVar("update_id", default=None)
+        rt.abot = FakeAsyncBot()
+        rt.inflight = 1
+        await rt.process({"update_id": 77, "message": {"message_id": 1, "date": 0, "text": "привет",
+                                                       "chat": {"id": 8001, "type": "private"}}})
+
+    monkeypatch.setattr(main.sessions, "get_step", get_step)
+    main.asyncio.run(scenario())
+    assert routes == [(None, main.fallback)]
+    assert loop_reads == []